@@ -0,0 +1,222 @@
+# admission.py
+"""
+Contrôle d'admission des requêtes de conversation (/mcp/chat, /mcp/chat/stream).
+
+Trois filtres, du moins coûteux au plus coûteux :
+  1. limite de débit par client (seau à jetons) : 429 ;
+  2. sérialisation par session : un seul tour à la fois par `session_id`,
+     les suivants attendent leur tour (historique cohérent entre deux onglets) ;
+     trop de tours en attente ou attente trop longue : 429 ;
+  3. plafond global de requêtes en vol, avec une file d'attente bornée et un
+     délai maximal : 503.
+Un refus est immédiat et porte un en-tête Retry-After : une surcharge coûte
+une réponse rapide au client plutôt qu'un ralentissement de tout le service.
+
+Les primitives sont celles de la boucle asyncio du worker : les limites
+s'appliquent par processus. Avec plusieurs workers (SERVER_MODE=prod,
+WEB_CONCURRENCY > 1), les connexions sont réparties par le noyau : la
+sérialisation par session ne tient que si toutes les requêtes d'une session
+arrivent au même worker. Il faut alors un routage « collant » devant le
+serveur (proxy qui répartit sur plusieurs ports selon `session_id` ou un
+cookie) ; sans lui, deux tours d'une même session peuvent tourner en même
+temps sur deux workers. Débit par client et plafond global se multiplient de
+même par le nombre de workers.
+
+Le client est identifié par son adresse IP ; derrière un proxy, uvicorn la
+reprend de X-Forwarded-For pour les adresses listées dans FORWARDED_ALLOW_IPS.
+"""
+import os
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Tours en attente derrière le tour en cours d'une même session
+SESSION_MAX_PENDING = int(os.getenv("SESSION_MAX_PENDING", "2"))
+SESSION_QUEUE_TIMEOUT = float(os.getenv("SESSION_QUEUE_TIMEOUT", "60"))
+# 0 désactive la limite par client
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "60"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+# Retry-After proposé quand le service est saturé (secondes)
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+
+
+class AdmissionRejected(Exception):
+    """Requête refusée : `status_code` (429 ou 503) et délai conseillé avant un nouvel essai."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, int(retry_after))
+
+
+class _Gate:
+    """Sémaphore asyncio à file d'attente bornée et servie dans l'ordre d'arrivée."""
+
+    def __init__(self, capacity: int, queue_size: int):
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.active = 0
+        self._waiters: deque = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def idle(self) -> bool:
+        return self.active == 0 and not self._waiters
+
+    async def acquire(self, timeout: float) -> bool:
+        """True si une place est obtenue, False si la file est pleine ou le délai écoulé."""
+        if self.active < self.capacity and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=timeout)
+        except BaseException:
+            # Requête annulée (client parti) : rendre la place si elle venait d'être attribuée
+            if waiter.done():
+                self.release()
+            else:
+                self._leave(waiter)
+            raise
+        if not waiter.done():
+            self._leave(waiter)
+            return False
+        return True
+
+    def _leave(self, waiter):
+        waiter.cancel()
+        self._waiters.remove(waiter)
+
+    def release(self):
+        # La place passe directement au premier en attente : `active` ne change pas
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class _RateLimiter:
+    """Seau à jetons par client : `burst` requêtes d'affilée, puis `per_minute` en régime établi."""
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self._buckets: dict = {}  # client -> (jetons, horodatage)
+        self._next_sweep = time.monotonic() + 60
+
+    def check(self, client: str) -> float:
+        """Consomme un jeton ; renvoie 0 si accepté, sinon le délai (s) avant le prochain jeton."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        tokens, last = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[client] = (tokens - 1, now)
+        return 0.0
+
+    def _sweep(self, now: float):
+        # Un seau redevenu plein équivaut à un client inconnu : mémoire bornée par les clients actifs
+        full_after = self.burst / self.rate
+        self._buckets = {c: b for c, b in self._buckets.items() if now - b[1] < full_after}
+        self._next_sweep = now + 60
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT, session_max_pending: int = SESSION_MAX_PENDING,
+                 session_timeout: float = SESSION_QUEUE_TIMEOUT, rate_per_minute: float = RATE_LIMIT_PER_MINUTE,
+                 rate_burst: int = RATE_LIMIT_BURST, retry_after: int = ADMISSION_RETRY_AFTER):
+        self.queue_timeout = queue_timeout
+        self.session_max_pending = session_max_pending
+        self.session_timeout = session_timeout
+        self.retry_after = retry_after
+        self._global = _Gate(max_in_flight, queue_size)
+        self._sessions: dict = {}  # session_id -> _Gate(1), supprimée dès qu'elle est libre
+        self._rate = _RateLimiter(rate_per_minute, rate_burst)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._global.active,
+            "max_in_flight": self._global.capacity,
+            "queued": self._global.queued,
+            "active_sessions": len(self._sessions),
+        }
+
+    def _reject(self, reason: str, status_code: int, detail: str, retry_after: float):
+        ADMISSION_REJECTED.inc(reason)
+        raise AdmissionRejected(status_code, detail, math.ceil(retry_after))
+
+    def _release_session(self, session_id: str, gate: _Gate):
+        gate.release()
+        if gate.idle and self._sessions.get(session_id) is gate:
+            del self._sessions[session_id]
+
+    @asynccontextmanager
+    async def admit(self, session_id: str, client: Optional[str] = None):
+        """`async with admission.admit(session_id, client): ...` ; lève `AdmissionRejected`."""
+        delay = self._rate.check(client or "inconnu")
+        if delay:
+            self._reject("rate_limit", 429, "Trop de requêtes pour ce client, réessayez plus tard.", delay)
+
+        started = time.perf_counter()
+        gate = self._sessions.get(session_id)
+        if gate is None:
+            gate = self._sessions[session_id] = _Gate(1, self.session_max_pending)
+        try:
+            acquired = await gate.acquire(self.session_timeout)
+        finally:
+            if gate.idle and self._sessions.get(session_id) is gate:
+                del self._sessions[session_id]
+        if not acquired:
+            self._reject("session_busy", 429, "Une réponse est déjà en cours pour cette conversation.",
+                         self.retry_after)
+
+        try:
+            if not await self._global.acquire(self.queue_timeout):
+                self._reject("overloaded", 503, "Service saturé, réessayez dans quelques instants.",
+                             self.retry_after)
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started)
+            try:
+                yield
+            finally:
+                self._global.release()
+        finally:
+            self._release_session(session_id, gate)
+
+
+_admission: Optional[AdmissionController] = None
+
+
+def get_admission() -> Optional[AdmissionController]:
+    """Contrôleur du worker, ou None si ADMISSION_ENABLED=false."""
+    global _admission
+    if not ADMISSION_ENABLED:
+        return None
+    if _admission is None:
+        # Créé et utilisé uniquement depuis la boucle asyncio : pas de verrou nécessaire
+        _admission = AdmissionController()
+    return _admission
@@ -1,20 +1,63 @@
 # agent_core.py
-from smolagents import ToolCallingAgent, LiteLLMModel
+from smolagents import LiteLLMModel
 import os
-import json
 from typing import Optional
-from tools import BuildWord, BuildPDF, BuildExcelPro, SendMail
-from langfuse import Langfuse
+from tools import BuildWord, BuildWordBatch, BuildPDF, BuildExcelPro, SendMail, SendMailBatch
+from artifacts import current_session_id
+from agent_pool import AgentPool
+from async_runner import AsyncAgentRunner
+from tool_scheduler import ParallelToolCallingAgent
+from streaming import iter_agent_events
+from history_store import get_history_store
+from conversation_context import ConversationContext
+from response_cache import create_response_cache
+from router import route_message
+from contextlib import contextmanager
+from jobs import JOBS_ENABLED, BackgroundTool
+from search_cache import CachedSearchTool
+from metrics import (stage, instrument_model, instrument_tool, record_tokens,
+                     LLM_CALL_SECONDS, STEPS_PER_RUN, MEMORY_TOKENS_SAVED)
+from agent_memory import MEMORY_COMPACTION_ENABLED, compact_step, run_savings
+from smolagents.memory import ActionStep
+from tracing import trace, get_tracer, current_trace, record_agent_steps, trace_tool
+import asyncio
+import contextvars
+import threading
 
 
-langfuse = Langfuse(
-    host="https://cloud.langfuse.com",
-    secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
-    public_key=os.getenv("LANGFUSE_PUBLIC_KEY")
-)
+MAX_STEPS = 10  # Augmente un peu si besoin
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", "4"))
+AGENT_POOL_ACQUIRE_TIMEOUT = float(os.getenv("AGENT_POOL_ACQUIRE_TIMEOUT", "30"))
 
-def create_agent():
-    custom_instructions = """
+_shared_model = None
+_shared_model_lock = threading.Lock()
+
+
+def get_shared_model():
+    """Client LiteLLM unique, partagé par tous les agents du processus."""
+    global _shared_model
+    if _shared_model is None:
+        with _shared_model_lock:
+            if _shared_model is None:
+                _shared_model = instrument_model(LiteLLMModel(
+                    model_id="mistral/mistral-large-latest",
+                    api_key=os.getenv("MISTRAL_API_KEY")
+                ))
+    return _shared_model
+
+
+def set_shared_model(model, async_runner=None):
+    """
+    Remplace le modèle partagé (et le runner asynchrone, qui appelle litellm
+    directement), par exemple par un modèle scripté hors ligne. À appeler
+    avant `warm_up` : les agents déjà construits gardent l'ancien modèle.
+    """
+    global _shared_model, _async_runner
+    _shared_model = model
+    _async_runner = async_runner
+
+
+CUSTOM_INSTRUCTIONS = """
 RÔLE :
 Tu es un assistant conversationnel professionnel et prudent.
 
@@ -24,67 +67,227 @@ RÈGLES STRICTES (À RESPECTER ABSOLUMENT) :
 3. Par défaut, réponds UNIQUEMENT en texte clair, professionnel et concis.
 4. Réponds TOUJOURS en français.
 5. N'appelle les outils que si c'est strictement nécessaire et autorisé par l'utilisateur.
+6. N'utilise la recherche web que pour des informations récentes ou que tu ne connais pas, et cite tes sources.
 
 OBJECTIF :
 Converser normalement, répondre aux questions, expliquer – sans actions automatiques.
 """
 
-    return ToolCallingAgent(
-        model=LiteLLMModel(
-            model_id="mistral/mistral-large-latest",
-            api_key=os.getenv("MISTRAL_API_KEY")
-        ),
-        tools=[
-            BuildWord(),
-            BuildPDF(),
-            BuildExcelPro(),
-            SendMail()
-        ],
-        max_steps=10,  # Augmente un peu si besoin
-        instructions=custom_instructions
-    )
 
-KEYWORDS_FILES = [
-    "génère", "crée", "produis", "exporte",
-    "fichier", "pdf", "word", "excel", "envoyer", "mail"
-]
+def create_tools():
+    tools = [
+        BuildWord(),
+        BuildWordBatch(),
+        BuildPDF(),
+        BuildExcelPro(),
+        SendMail(),
+        SendMailBatch()
+    ]
+    if JOBS_ENABLED:
+        # Rendu et envoi délégués à la file de travaux : l'outil renvoie un identifiant de travail
+        tools = [BackgroundTool(tool) for tool in tools]
+    # Recherche web synchrone (son résultat sert à l'étape suivante), cache partagé entre sessions
+    tools.append(CachedSearchTool())
+    return [instrument_tool(trace_tool(tool)) for tool in tools]
 
 
-def user_explicitly_requested_file(message: str) -> bool:
-    msg = message.lower()
-    return any(k in msg for k in KEYWORDS_FILES)
+def create_agent(model=None):
+    # Les appels d'outils indépendants d'une même étape tournent en parallèle
+    return ParallelToolCallingAgent(
+        model=model or get_shared_model(),
+        tools=create_tools(),
+        max_steps=MAX_STEPS,
+        instructions=CUSTOM_INSTRUCTIONS,
+        # Arguments et observations volumineux condensés une fois l'outil exécuté
+        step_callbacks=[compact_step] if MEMORY_COMPACTION_ENABLED else None,
+    )
+
 
+def create_async_runner(model=None) -> AsyncAgentRunner:
+    """Boucle d'agent asynchrone (LLM via `litellm.acompletion`, outils sur un executor dédié)."""
+    model = model or get_shared_model()
+    return AsyncAgentRunner(
+        model_id=model.model_id,
+        api_key=model.api_key,
+        api_base=model.api_base,
+        tools=create_tools(),
+        instructions=CUSTOM_INSTRUCTIONS,
+        max_steps=MAX_STEPS,
+    )
 
 # --- Conversation helper API ---
 # Fournit `chat_with_agent(session_id, message)` pour gérer l'historique par session
-_agent_cache = None
+_agent_pool = None
+_agent_pool_lock = threading.Lock()
+
+
+def get_agent_pool() -> AgentPool:
+    """Pool d'agents du processus : un agent par session en cours, éviction LRU."""
+    global _agent_pool
+    if _agent_pool is None:
+        with _agent_pool_lock:
+            if _agent_pool is None:
+                _agent_pool = AgentPool(
+                    create_agent,
+                    max_size=AGENT_POOL_SIZE,
+                    acquire_timeout=AGENT_POOL_ACQUIRE_TIMEOUT,
+                )
+    return _agent_pool
 
 
-def _get_agent_cached():
-    global _agent_cache
-    if _agent_cache is None:
-        _agent_cache = create_agent()
-    return _agent_cache
+_async_runner = None
+_async_runner_lock = threading.Lock()
 
 
-def _history_path(session_id: str) -> str:
-    return f"history_{session_id}.json"
+def get_async_runner() -> AsyncAgentRunner:
+    # Le runner ne garde aucun état entre deux tours : une instance suffit pour tout le processus
+    global _async_runner
+    if _async_runner is None:
+        with _async_runner_lock:
+            if _async_runner is None:
+                _async_runner = create_async_runner()
+    return _async_runner
+
+
+def warm_up(async_mode: bool = False):
+    """
+    Construit au démarrage du worker ce que servira le premier tour : modèle
+    partagé, puis runner asynchrone ou premier agent du pool. C'est l'unique
+    chemin de construction des agents du processus.
+    """
+    get_shared_model()
+    if async_mode:
+        get_async_runner()
+    else:
+        get_agent_pool().prefill(1)
 
 
 def _load_history(session_id: str):
-    p = _history_path(session_id)
-    if not os.path.exists(p):
-        return []
+    with stage("history_load"):
+        return get_history_store().load(session_id)
+
+
+def _route(message: str, history: list) -> Optional[list]:
+    with stage("routing"):
+        return route_message(message, history)
+
+
+def _record_steps(agent):
+    STEPS_PER_RUN.observe(sum(1 for step in agent.memory.steps if isinstance(step, ActionStep)))
+    if MEMORY_COMPACTION_ENABLED:
+        MEMORY_TOKENS_SAVED.observe(run_savings(agent.memory.steps), "sync")
+
+
+def _summarize(prompt: str) -> str:
+    message = get_shared_model().generate([{"role": "user", "content": [{"type": "text", "text": prompt}]}])
+    return message.content
+
+
+conversation_context = ConversationContext(summarize=_summarize)
+
+
+def _build_task(session_id: str, history: list, message: str) -> str:
+    """Entrée de l'agent : résumé glissant + derniers tours + nouveau message, dans un budget de tokens."""
+    return conversation_context.build(session_id, history, message)
+
+
+def _direct_messages(task: str) -> list:
+    return [
+        {"role": "system", "content": [{"type": "text", "text": CUSTOM_INSTRUCTIONS}]},
+        {"role": "user", "content": [{"type": "text", "text": task}]},
+    ]
+
+
+def _direct_answer(task: str) -> str:
+    """Voie rapide : une seule complétion, sans boucle d'agent ni schéma d'outil."""
+    return get_shared_model().generate(_direct_messages(task)).content or ""
+
+
+async def _direct_answer_async(task: str) -> str:
+    model = get_shared_model()
+    if not isinstance(model, LiteLLMModel):
+        return await asyncio.to_thread(_direct_answer, task)
+    import litellm
+
+    with LLM_CALL_SECONDS.time("async"):
+        response = await litellm.acompletion(
+            model=model.model_id,
+            api_key=model.api_key,
+            api_base=model.api_base,
+            messages=[
+                {"role": "system", "content": CUSTOM_INSTRUCTIONS},
+                {"role": "user", "content": task},
+            ],
+        )
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record_tokens(usage.prompt_tokens, usage.completion_tokens)
+    return response.choices[0].message.content or ""
+
+
+def _direct_answer_stream(task: str):
+    for delta in get_shared_model().generate_stream(_direct_messages(task)):
+        if delta.content:
+            yield delta.content
+
+
+@contextmanager
+def _restricted_tools(agent, tool_names: list):
+    """Ne propose à l'agent que `tool_names` (plus `final_answer`) le temps d'un run."""
+    all_tools = agent.tools
+    agent.tools = {
+        name: tool for name, tool in all_tools.items()
+        if name in tool_names or name == "final_answer"
+    }
     try:
-        with open(p, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return []
+        yield agent
+    finally:
+        agent.tools = all_tools
+
+
+# Cache de réponses (opt-in, RESPONSE_CACHE_ENABLED) : None s'il est désactivé
+response_cache = create_response_cache(CUSTOM_INSTRUCTIONS)
+
+
+def _used_tools(agent) -> bool:
+    """Vrai si le dernier run de l'agent a appelé un autre outil que `final_answer`."""
+    for step in agent.memory.steps:
+        for call in getattr(step, "tool_calls", None) or []:
+            if call.name != "final_answer":
+                return True
+    return False
+
 
+# Nom de trace historique, conservé pour les tableaux de bord existants
+TRACE_NAME = "forlangraph"
 
-def _save_history(session_id: str, history):
-    with open(_history_path(session_id), "w", encoding="utf-8") as f:
-        json.dump(history, f, indent=2, ensure_ascii=False)
+
+def _cached_response(session_id: str, history: list, message: str) -> Optional[str]:
+    # Seuls les tours sans contexte de conversation sont déterministes
+    if response_cache is None or history:
+        return None
+    output = response_cache.get(message)
+    if output is not None:
+        with trace(TRACE_NAME, session_id, input={"user": message}) as t:
+            t.update(
+                output={"agent": output},
+                metadata={"response_cache": "hit", "response_cache_hit_rate": response_cache.stats()["hit_rate"]},
+            )
+    return output
+
+
+def _cache_metadata(history: list) -> dict:
+    # Tour non servi par le cache alors qu'il était éligible : marqué « miss » dans la trace
+    if response_cache is None or history:
+        return {}
+    return {"response_cache": "miss"}
+
+
+def _cache_response(history: list, message: str, output: str, used_tools: bool):
+    # Jamais de mise en cache d'un tour qui a généré un fichier ou envoyé un email
+    if response_cache is None or history or used_tools or "||" in output:
+        return
+    response_cache.put(message, output)
 
 
 def chat_with_agent(session_id: str, message: str) -> dict:
@@ -93,26 +296,157 @@ def chat_with_agent(session_id: str, message: str) -> dict:
       { "content": "...", "file_path": "..." }  (file_path optionnel)
     """
     history = _load_history(session_id)
-    history.append({"role": "user", "content": message})
+    cached = _cached_response(session_id, history, message)
+    if cached is not None:
+        return _record_turn(session_id, message, cached)
+
+    tool_names = _route(message, history)
+    session_token = current_session_id.set(session_id)
+    try:
+        if tool_names is None:
+            # Voie rapide : question sans intention d'outil
+            task = _build_task(session_id, history, message)
+            with trace(TRACE_NAME, session_id, input={"user": message}, metadata={"route": "direct", **_cache_metadata(history)}) as t:
+                output = _direct_answer(task)
+                t.update(output={"agent": output})
+            used_tools = False
+        else:
+            # 🔒 GARDE-FOU : un agent du pool n'est jamais partagé entre deux requêtes simultanées
+            with get_agent_pool().checkout(session_id) as agent, _restricted_tools(agent, tool_names):
+                task = _build_task(session_id, history, message)
+                with trace(TRACE_NAME, session_id, input={"user": message},
+                           metadata={"route": "agent", "tools": tool_names, **_cache_metadata(history)}) as t:
+                    try:
+                        output = str(agent.run(task))
+                        t.update(output={"agent": output})
+                    finally:
+                        record_agent_steps(t, agent.memory.steps)
+                _record_steps(agent)
+                used_tools = _used_tools(agent)
+        _cache_response(history, message, output, used_tools)
+    finally:
+        current_session_id.reset(session_token)
+
+    return _record_turn(session_id, message, output)
+
+
+async def chat_with_agent_async(session_id: str, message: str) -> dict:
+    """
+    Variante asynchrone de `chat_with_agent` : n'occupe aucun thread pendant
+    l'attente du modèle. Même format de retour.
+    """
+    history = await asyncio.to_thread(_load_history, session_id)
+    cached = _cached_response(session_id, history, message)
+    if cached is not None:
+        return await asyncio.to_thread(_record_turn, session_id, message, cached)
+
+    tool_names = _route(message, history)
+    task = await asyncio.to_thread(_build_task, session_id, history, message)
+    called_tools = []
+    session_token = current_session_id.set(session_id)
+    try:
+        metadata = {"route": "direct"} if tool_names is None else {"route": "agent", "tools": tool_names}
+        metadata.update(_cache_metadata(history))
+        with trace(TRACE_NAME, session_id, input={"user": message}, metadata=metadata) as t:
+            if tool_names is None:
+                output = await _direct_answer_async(task)
+            else:
+                output = str(await get_async_runner().run(task, called_tools=called_tools, tool_names=tool_names))
+            t.update(output={"agent": output})
+    finally:
+        current_session_id.reset(session_token)
+
+    _cache_response(history, message, output, bool(called_tools))
+    return await asyncio.to_thread(_record_turn, session_id, message, output)
+
+
+def stream_chat_with_agent(session_id: str, message: str):
+    """
+    Variante en streaming de `chat_with_agent` : générateur d'événements
+    {"event": ..., "data": ...} (étapes, appels d'outils, deltas de la réponse),
+    terminé par {"event": "final", "data": {"content": ..., "file_path": ...}}.
+    """
+    history = _load_history(session_id)
+    cached = _cached_response(session_id, history, message)
+    if cached is not None:
+        yield {"event": "delta", "data": {"text": cached}}
+        yield {"event": "final", "data": _record_turn(session_id, message, cached)}
+        return
+
+    tool_names = _route(message, history)
+    if tool_names is None:
+        # Voie rapide : les tokens de la complétion sont relayés directement
+        task = _build_task(session_id, history, message)
+        t = get_tracer().start_trace(TRACE_NAME, session_id, input={"user": message}, metadata={"route": "direct", **_cache_metadata(history)})
+        parts = []
+        error = None
+        try:
+            for text in _direct_answer_stream(task):
+                parts.append(text)
+                yield {"event": "delta", "data": {"text": text}}
+            t.update(output={"agent": "".join(parts)})
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            t.end(error=error)
+        output = "".join(parts)
+        _cache_response(history, message, output, False)
+        yield {"event": "final", "data": _record_turn(session_id, message, output)}
+        return
+
+    # Le générateur peut être avancé depuis des threads différents (StreamingResponse) :
+    # l'exécution de l'agent est épinglée dans un contexte dédié qui porte la session.
+    ctx = contextvars.copy_context()
+    ctx.run(current_session_id.set, session_id)
+
+    t = get_tracer().start_trace(TRACE_NAME, session_id, input={"user": message},
+                                 metadata={"route": "agent", "tools": tool_names, **_cache_metadata(history)})
+    ctx.run(current_trace.set, t)
+    output = ""
+    error = None
+    try:
+        with get_agent_pool().checkout(session_id) as agent, _restricted_tools(agent, tool_names):
+            task = _build_task(session_id, history, message)
+            agent.stream_outputs = True
+            try:
+                for event in iter_agent_events(agent, task, next_item=lambda it: ctx.run(next, it)):
+                    if event["event"] == "answer":
+                        output = str(event["data"]["output"])
+                    else:
+                        yield event
+            finally:
+                agent.stream_outputs = False
+                record_agent_steps(t, agent.memory.steps)
+            _record_steps(agent)
+            _cache_response(history, message, output, _used_tools(agent))
+        t.update(output={"agent": output})
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        t.end(error=error)
+
+    yield {"event": "final", "data": _record_turn(session_id, message, output)}
 
-    agent = _get_agent_cached()
-    # 🔒 GARDE-FOU
 
-    with langfuse.start_as_current_observation(as_type="span", name="forlangraph") as obs:
-        obs.update(input={"user": message})
-        output = str(agent.run(message))
-        obs.update(output={"agent": output})
+def _record_turn(session_id: str, message: str, output: str) -> dict:
+    # Seuls les deux messages du tour sont ajoutés : coût d'E/S constant par tour
+    user_message = {"role": "user", "content": message}
 
     # Gestion fichier éventuel
     if "||" in output:
         text, file_path = output.split("||", 1)
-        history.append({"role": "assistant", "content": text.strip()})
-        _save_history(session_id, history)
+        with stage("history_save"):
+            get_history_store().append(session_id, [
+                user_message,
+                {"role": "assistant", "content": text.strip(), "file_path": file_path.strip()},
+            ])
         return {
             "content": text.strip(),
             "file_path": file_path.strip()
         }
 
-    history.append({"role": "assistant", "content": output})
-    _save_history(session_id, history)
+    with stage("history_save"):
+        get_history_store().append(session_id, [user_message, {"role": "assistant", "content": output}])
     return {"content": output}
@@ -0,0 +1,143 @@
+# agent_memory.py
+"""
+Compaction de la mémoire de l'agent après l'exécution des outils.
+
+Les arguments d'un appel d'outil (les milliers de `rows` de BuildExcelPro, le
+`body` complet de BuildWord) et les observations restent dans la mémoire du
+`ToolCallingAgent` et sont renvoyés au modèle à chaque étape suivante : le
+nombre de tokens d'entrée croît alors avec le carré du nombre d'étapes.
+
+Une fois l'outil exécuté, chaque valeur volumineuse est remplacée par un
+condensé : début du texte ou premier élément de la liste, taille et empreinte.
+Le chemin du fichier produit (« texte||chemin ») est toujours conservé. Une
+étape en erreur garde ses arguments intacts, pour que le modèle puisse les
+corriger.
+
+Le gain d'un run est la somme, pour chaque étape compactée, des tokens retirés
+multipliés par le nombre d'appels au modèle qui ont suivi.
+"""
+import os
+import json
+import hashlib
+from typing import Optional
+
+from conversation_context import estimate_tokens
+
+
+MEMORY_COMPACTION_ENABLED = os.getenv("MEMORY_COMPACTION_ENABLED", "true").lower() in ("1", "true", "yes")
+# Taille (caractères JSON) à partir de laquelle une valeur est condensée
+MEMORY_COMPACT_MIN_CHARS = int(os.getenv("MEMORY_COMPACT_MIN_CHARS", "400"))
+MEMORY_PREVIEW_CHARS = int(os.getenv("MEMORY_PREVIEW_CHARS", "120"))
+
+
+def _dumps(value) -> str:
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _fingerprint(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+def compact_value(value):
+    """Condensé d'une valeur d'argument, ou la valeur elle-même si elle est petite."""
+    text = _dumps(value)
+    if len(text) < MEMORY_COMPACT_MIN_CHARS:
+        return value
+    if isinstance(value, (list, tuple)) and value:
+        first = _dumps(value[0])[:MEMORY_PREVIEW_CHARS]
+        return (f"[{len(value)} éléments omis après exécution de l'outil — premier : {first} — "
+                f"empreinte {_fingerprint(text)}]")
+    return (f"{text[:MEMORY_PREVIEW_CHARS]}… [{len(text)} caractères omis après exécution de l'outil, "
+            f"empreinte {_fingerprint(text)}]")
+
+
+def compact_arguments(arguments):
+    """Arguments d'un appel d'outil (dict ou chaîne JSON), même type en sortie."""
+    if isinstance(arguments, str):
+        try:
+            decoded = json.loads(arguments)
+        except ValueError:
+            return compact_value(arguments)
+        if not isinstance(decoded, dict):
+            return arguments
+        return json.dumps(compact_arguments(decoded), ensure_ascii=False)
+    if isinstance(arguments, dict):
+        return {name: compact_value(value) for name, value in arguments.items()}
+    return arguments
+
+
+def compact_observation(observation: Optional[str]) -> Optional[str]:
+    """Observation d'un outil : début du texte et chemin du fichier produit."""
+    if observation is None or len(observation) < MEMORY_COMPACT_MIN_CHARS:
+        return observation
+    text, _, file_path = observation.partition("||")
+    if len(text) >= MEMORY_COMPACT_MIN_CHARS:
+        text = f"{text[:MEMORY_PREVIEW_CHARS * 2]}… [{len(text)} caractères omis]"
+    return f"{text}||{file_path}" if file_path else text
+
+
+def _saved_tokens(before, after) -> int:
+    return max(0, estimate_tokens(_dumps(before)) - estimate_tokens(_dumps(after)))
+
+
+def compact_step(step, agent=None):
+    """
+    Callback d'étape du `ToolCallingAgent` (`step_callbacks`) : condense les
+    arguments et l'observation d'une étape terminée. Les tokens retirés sont
+    notés dans `step.compacted_tokens`.
+    """
+    if getattr(step, "error", None) is not None or getattr(step, "is_final_answer", False):
+        return
+    tool_calls = getattr(step, "tool_calls", None) or []
+    saved = 0
+    for call in tool_calls:
+        if call.name == "final_answer":
+            continue
+        compacted = compact_arguments(call.arguments)
+        saved += _saved_tokens(call.arguments, compacted)
+        call.arguments = compacted
+    if tool_calls and step.observations:
+        compacted = compact_observation(step.observations)
+        saved += _saved_tokens(step.observations, compacted)
+        step.observations = compacted
+    if isinstance(step.model_output, str):
+        # Certains modèles écrivent l'appel d'outil en JSON dans le texte
+        compacted = compact_observation(step.model_output)
+        saved += _saved_tokens(step.model_output, compacted)
+        step.model_output = compacted
+    step.compacted_tokens = saved
+
+
+def compact_tool_exchange(assistant_message: dict, tool_messages: list) -> int:
+    """
+    Variante pour la boucle asynchrone (messages au format OpenAI) : condense
+    les arguments du message assistant et le contenu des réponses d'outils
+    réussies. Retourne le nombre de tokens retirés.
+    """
+    failed = {m["tool_call_id"] for m in tool_messages if str(m["content"]).startswith("Erreur")}
+    saved = 0
+    for call in assistant_message.get("tool_calls", []):
+        if call["id"] in failed:
+            continue
+        function = call["function"]
+        compacted = compact_arguments(function["arguments"])
+        saved += _saved_tokens(function["arguments"], compacted)
+        function["arguments"] = compacted
+    for message in tool_messages:
+        if message["tool_call_id"] in failed:
+            continue
+        compacted = compact_observation(message["content"])
+        saved += _saved_tokens(message["content"], compacted)
+        message["content"] = compacted
+    return saved
+
+
+def run_savings(steps) -> int:
+    """Tokens d'entrée économisés sur un run : tokens retirés × appels au modèle suivants."""
+    numbers = [s.step_number for s in steps if hasattr(s, "step_number") and hasattr(s, "tool_calls")]
+    total = 0
+    for step in steps:
+        saved = getattr(step, "compacted_tokens", 0)
+        if saved:
+            total += saved * sum(1 for n in numbers if n > step.step_number)
+    return total
@@ -0,0 +1,119 @@
+# agent_pool.py
+"""
+Pool borné d'agents réutilisables, attribués par session.
+
+Un `ToolCallingAgent` porte un état mutable (mémoire, numéro d'étape) : il ne
+doit servir qu'une conversation à la fois. Le pool attribue un agent à chaque
+session le temps d'un tour, garde l'association session → agent tant que
+l'agent est libre, et réattribue l'agent inactif le moins récemment utilisé
+lorsque la taille maximale est atteinte.
+"""
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable
+
+
+class AgentPoolTimeout(Exception):
+    """Aucun agent n'a pu être obtenu dans le délai imparti."""
+
+
+class AgentPool:
+    def __init__(self, factory: Callable, max_size: int = 4, acquire_timeout: float = 30.0):
+        if max_size < 1:
+            raise ValueError("max_size doit être >= 1")
+        self._factory = factory
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        # session_id -> agent libre, du moins récemment utilisé au plus récent
+        self._idle: OrderedDict = OrderedDict()
+        # sessions dont l'agent est en cours d'utilisation
+        self._busy: set = set()
+        # agents construits à l'avance, pas encore attribués à une session
+        self._spare: list = []
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"size": self._size, "max_size": self.max_size,
+                    "busy": len(self._busy), "idle": len(self._idle) + len(self._spare)}
+
+    def prefill(self, count: int = 1):
+        """Construit à l'avance jusqu'à `count` agents, attribués ensuite aux premières sessions."""
+        for _ in range(count):
+            with self._cond:
+                if self._size >= self.max_size:
+                    return
+                self._size += 1
+            try:
+                agent = self._factory()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._spare.append(agent)
+                self._cond.notify_all()
+
+    @contextmanager
+    def checkout(self, session_id: str, timeout: float = None):
+        """Réserve un agent pour `session_id` pendant la durée du bloc `with`."""
+        agent = self._acquire(session_id, self.acquire_timeout if timeout is None else timeout)
+        try:
+            yield agent
+        finally:
+            self._release(session_id, agent)
+
+    def _acquire(self, session_id: str, timeout: float):
+        deadline = time.monotonic() + timeout
+        create = False
+        with self._cond:
+            while True:
+                # Une même session attend la fin de son tour précédent
+                if session_id not in self._busy:
+                    if session_id in self._idle:
+                        agent = self._idle.pop(session_id)
+                        break
+                    if self._spare:
+                        agent = self._spare.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        agent, create = None, True
+                        break
+                    if self._idle:
+                        # Éviction LRU : l'agent change de session, sa mémoire est vidée
+                        _, agent = self._idle.popitem(last=False)
+                        agent.memory.reset()
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AgentPoolTimeout(
+                        f"Aucun agent disponible après {timeout:.0f}s (taille du pool: {self.max_size})"
+                    )
+                self._cond.wait(remaining)
+            self._busy.add(session_id)
+
+        if create:
+            try:
+                agent = self._factory()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._busy.discard(session_id)
+                    self._cond.notify_all()
+                raise
+        return agent
+
+    def _release(self, session_id: str, agent):
+        with self._cond:
+            self._busy.discard(session_id)
+            self._idle[session_id] = agent
+            self._idle.move_to_end(session_id)
+            self._cond.notify_all()
@@ -1,30 +1,37 @@
-from smolagents import CodeAgent,LiteLLMModel,Tool , DuckDuckGoSearchTool
-import gradio as gr
-import os
-from tools import BuildWord,BuildPDF, BuildExcelPro,SendMail
-
-import json
+# app.py
+"""
+Interface Gradio de démonstration, branchée sur le même cœur que le serveur MCP
+(`agent_core.stream_chat_with_agent`) : pool d'agents, routage, cache de
+réponses, historique par session en ajout seul et traces.
+
+  - une session par utilisateur authentifié, sinon par onglet du navigateur ;
+  - réponse affichée au fil de la génération, avec l'outil en cours ;
+  - recherche web (`web_search`) servie par le cache partagé de `search_cache` ;
+  - file d'attente Gradio bornée et au plus GRADIO_CONCURRENCY_LIMIT tours
+    simultanés (par défaut la taille du pool d'agents) : au-delà, les
+    utilisateurs attendent leur tour au lieu de saturer le processus ;
+  - aucun historique global en mémoire : le contexte de chaque tour est relu
+    (et borné) par `agent_core`, les fichiers servis par Gradio sont purgés de
+    son cache après GRADIO_CACHE_TTL secondes.
+
+Lancement : `python app.py`
+"""
 import os
+from contextlib import closing
+from typing import Optional
 
-HISTORY_FILE = "history.json"
-
-def load_history_local():
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return []
-
-def save_history_local(history):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f, indent=4, ensure_ascii=False)
+import gradio as gr
+from dotenv import load_dotenv
 
+load_dotenv()
 
+from agent_core import stream_chat_with_agent, warm_up
+from artifacts import ARTIFACTS_DIR, start_sweeper
 
-history_memory = load_history_local()
 
+GRADIO_CONCURRENCY_LIMIT = int(os.getenv("GRADIO_CONCURRENCY_LIMIT", os.getenv("AGENT_POOL_SIZE", "4")))
+GRADIO_QUEUE_SIZE = int(os.getenv("GRADIO_QUEUE_SIZE", "64"))
+GRADIO_CACHE_TTL = int(os.getenv("GRADIO_CACHE_TTL", "86400"))
 
 
 # class RagTool(Tool):
@@ -38,63 +45,70 @@ history_memory = load_history_local()
 #     def forward(self, query: str):
 #         # Charger l'index déjà stocké
 #         index = loadIndex()
-        
+
 #         query_engine = index.as_query_engine()
 #         response = query_engine.query(query)
 #         return str(response)
 
-# NOTE: This local `buildAgent()` helper is used by the Gradio UI in `app.py`.
-# For production / server usage prefer `agent_core.chat_with_agent(session_id, message)`
-def buildAgent():
-    agent = CodeAgent(
-        model= LiteLLMModel(
-            model_id= "mistral/mistral-large-latest",
-            api_key=os.getenv("MISTRAL_API_KEY")
-        ),
-        tools=[DuckDuckGoSearchTool(),BuildWord(),BuildPDF(), BuildExcelPro(),SendMail()],
-        max_steps = 5
-    )
-    
-    return agent
-
-
-agent = buildAgent()
+def _session_id(request: Optional[gr.Request]) -> str:
+    # Utilisateur authentifié, sinon onglet du navigateur
+    if request is None:
+        return "gradio"
+    return f"gradio-{request.username or request.session_hash}"
 
 
 # function for chat with agent
-def chatwithAgent(message, history):
-    # Ajouter message utilisateur
-    history_memory.append({"role": "user", "content": message})
-    
-    # Obtenir réponse agent
-    output = agent.run(message)
-
-    # Si l'agent fournit un fichier (séparateur "||"), renvoyer un dict compatible Gradio
-    if "||" in output:
-        text, file_path = output.split("||")
-        text = text.strip()
-        file_path = file_path.strip()
-
-        # Enregistrer la réponse (texte) dans l'historique
-        history_memory.append({"role": "assistant", "content": text})
-        save_history_local(history_memory)
-
-        try:
-            f = open(file_path, "rb")
-            return {"content": text, "files": [{"name": os.path.basename(file_path), "data": f}]}
-        except Exception as e:
-            return f"{text} (fichier généré: {file_path}, mais impossible de l'attacher: {e})"
-
-    # Pas de fichier : renvoyer simplement le texte
-    history_memory.append({"role": "assistant", "content": output})
-    save_history_local(history_memory)
-    return output
-
-
-
-
-# gr.ChatInterface(
-#     fn=chatwithAgent,
-#     description= "Agent IA assistant qui génère (pdf,excel et word)",
-#     title= "Agent2",
-# ).launch()
+def chatwithAgent(message, history, request: gr.Request):
+    """
+    Générateur Gradio : texte partiel au fil de la réponse, puis le fichier
+    produit s'il y en a un. `history` (côté navigateur) n'est pas utilisé :
+    le contexte vient de l'historique de la session.
+    """
+    session_id = _session_id(request)
+    text, status = "", ""
+    try:
+        # Onglet fermé ou bouton « Stop » : le générateur est fermé, l'agent retourne au pool
+        with closing(stream_chat_with_agent(session_id, message)) as events:
+            for event in events:
+                kind, data = event["event"], event["data"]
+                if kind == "delta":
+                    text += data["text"]
+                elif kind == "tool_call":
+                    status = f"🔧 {data['label']}"
+                elif kind == "final":
+                    text = data["content"]
+                    file_path = data.get("file_path")
+                    if file_path and os.path.isfile(file_path):
+                        # Gradio sert le fichier depuis son cache : aucun descripteur gardé ouvert ici
+                        yield [text, gr.File(value=file_path, label=os.path.basename(file_path))]
+                    elif file_path:
+                        yield f"{text}\n\n(fichier généré : {os.path.basename(file_path)}, introuvable sur le disque)"
+                    else:
+                        yield text
+                    return
+                else:
+                    continue
+                yield text or status
+    except Exception as e:
+        print(f"❌ Erreur interface Gradio ({session_id}) : {type(e).__name__}: {e}")
+        raise gr.Error("Une erreur est survenue pendant la réponse, réessayez.")
+
+
+def build_ui() -> gr.Blocks:
+    # Fichiers copiés dans le cache de Gradio : vérification toutes les heures
+    with gr.Blocks(title="Agent2", delete_cache=(3600, GRADIO_CACHE_TTL)) as demo:
+        gr.ChatInterface(
+            fn=chatwithAgent,
+            type="messages",
+            description= "Agent IA assistant qui génère (pdf,excel et word)",
+            title= "Agent2",
+        )
+    demo.queue(default_concurrency_limit=GRADIO_CONCURRENCY_LIMIT, max_size=GRADIO_QUEUE_SIZE)
+    return demo
+
+
+if __name__ == "__main__":
+    # Modèle et premier agent prêts avant la première question
+    warm_up()
+    start_sweeper()
+    build_ui().launch(allowed_paths=[os.path.abspath(ARTIFACTS_DIR)])
@@ -0,0 +1,350 @@
+# artifacts.py
+"""
+Stockage et registre des fichiers générés par les outils (Word, PDF, Excel).
+
+Chaque fichier est écrit dans un répertoire qui lui est propre, sous celui de
+sa session : ARTIFACTS_DIR/<session>/<id>/<nom>. Deux sessions (ou deux
+appels) qui choisissent le même nom ne s'écrasent donc plus, et l'identifiant
+unique sert d'URL de téléchargement.
+
+Le registre (id, session, chemin, taille, type MIME, date de création) vit en
+mémoire et est persisté dans un fichier JSONL en ajout seul, rechargé au
+démarrage ; les autres workers y lisent au besoin les lignes ajoutées depuis
+leur dernière lecture. Un thread supprime en arrière-plan les artefacts plus
+vieux que ARTIFACTS_TTL puis, du plus ancien au plus récent, ceux qui font
+dépasser ARTIFACTS_MAX_BYTES.
+
+Seuls les fichiers enregistrés et situés sous ARTIFACTS_DIR sont servis ou
+joints à un email ; une recherche par nom ne sort jamais de la session.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import mimetypes
+import threading
+from contextvars import ContextVar
+from typing import Optional
+
+
+ARTIFACTS_INDEX_FILE = os.getenv("ARTIFACTS_INDEX_FILE", "artifacts_index.jsonl")
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR", "artifacts")
+ARTIFACTS_TTL = float(os.getenv("ARTIFACTS_TTL", str(7 * 24 * 3600)))
+ARTIFACTS_MAX_BYTES = int(os.getenv("ARTIFACTS_MAX_BYTES", str(2 * 1024 ** 3)))
+ARTIFACTS_GC_INTERVAL = float(os.getenv("ARTIFACTS_GC_INTERVAL", "600"))
+
+# Session en cours, positionnée par `agent_core.chat_with_agent` autour de l'exécution
+# de l'agent pour que les outils puissent rattacher leurs fichiers à la bonne session.
+current_session_id: ContextVar[Optional[str]] = ContextVar("current_session_id", default=None)
+# Tenant de la clé d'API de la requête : seuls ses modèles Word sont accessibles aux outils
+current_tenant: ContextVar[Optional[str]] = ContextVar("current_tenant", default=None)
+
+mimetypes.add_type("application/vnd.openxmlformats-officedocument.wordprocessingml.document", ".docx")
+mimetypes.add_type("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", ".xlsx")
+
+_SAFE_SESSION = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _session_dir_name(session_id: Optional[str]) -> str:
+    if not session_id:
+        return "_sans_session"
+    if _SAFE_SESSION.match(session_id):
+        return session_id
+    # Identifiant libre (email, espaces…) : nom de répertoire dérivé, sans risque de traversée
+    return hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32]
+
+
+def artifact_path(filename: str, session_id: Optional[str] = None) -> str:
+    """
+    Chemin où écrire un nouveau fichier : ARTIFACTS_DIR/<session>/<id>/<filename>.
+    Le répertoire est créé ; `register_artifact(chemin)` reprend ensuite l'id.
+    """
+    if session_id is None:
+        session_id = current_session_id.get()
+    name = os.path.basename(filename.replace("\\", "/")).strip() or "fichier"
+    directory = os.path.join(ARTIFACTS_DIR, _session_dir_name(session_id), uuid.uuid4().hex)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+class ArtifactRegistry:
+    """Index mémoire des artefacts, adossé à un fichier JSONL en ajout seul."""
+
+    def __init__(self, index_path: str = ARTIFACTS_INDEX_FILE, root: str = ARTIFACTS_DIR):
+        self.index_path = index_path
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        self._by_id: dict = {}
+        self._by_name: dict = {}
+        self._by_path: dict = {}
+        # Position de lecture de l'index (inode, octets lus) : rattrapage des écritures des autres workers
+        self._index_inode = None
+        self._index_offset = 0
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        self._by_id.clear()
+        self._by_name.clear()
+        self._by_path.clear()
+        self._index_inode, self._index_offset = None, 0
+        lines = self._read_new_lines()
+        # Les ré-enregistrements d'un même nom laissent des lignes mortes : on compacte
+        if lines > 2 * max(len(self._by_id), 1):
+            self._compact()
+
+    def _read_new_lines(self) -> int:
+        try:
+            with open(self.index_path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._index_inode:
+                    # Index réécrit (compaction, nettoyage) par un autre processus : relecture complète
+                    if self._index_inode is not None:
+                        self._by_id.clear()
+                        self._by_name.clear()
+                        self._by_path.clear()
+                    self._index_inode, self._index_offset = inode, 0
+                f.seek(self._index_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            print(f"⚠️ Lecture de l'index des artefacts impossible: {e}")
+            return 0
+        # Une ligne incomplète (écriture en cours) sera relue la prochaine fois
+        complete = data[:data.rfind(b"\n") + 1]
+        self._index_offset += len(complete)
+        lines = 0
+        for line in complete.decode("utf-8", errors="replace").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            lines += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Ligne tronquée (arrêt brutal pendant une écriture) : on l'ignore
+                continue
+            self._index(record)
+        return lines
+
+    def _index(self, record: dict):
+        previous = self._by_name.get(record["name"])
+        if previous is not None and previous["id"] != record["id"] and previous["path"] == record["path"]:
+            # Même fichier ré-enregistré (anciens fichiers du répertoire courant)
+            self._unindex(previous)
+        self._by_id[record["id"]] = record
+        self._by_name[record["name"]] = record
+        self._by_path[record["path"]] = record
+
+    def _unindex(self, record: Optional[dict]):
+        if record is None:
+            return
+        self._by_id.pop(record["id"], None)
+        if self._by_name.get(record["name"]) is record:
+            del self._by_name[record["name"]]
+        if self._by_path.get(record["path"]) is record:
+            del self._by_path[record["path"]]
+
+    def _compact(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self._by_id.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.index_path)
+        self._index_inode = os.stat(self.index_path).st_ino
+        self._index_offset = os.path.getsize(self.index_path)
+
+    def _append(self, record: dict):
+        self._read_new_lines()
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._read_new_lines()
+
+    def register(self, path: str, session_id: Optional[str] = None) -> dict:
+        """Enregistre un fichier généré et retourne son enregistrement."""
+        path = os.path.abspath(path)
+        if session_id is None:
+            session_id = current_session_id.get()
+        directory = os.path.dirname(path)
+        # Fichier écrit par `artifact_path` : l'id est le nom de son répertoire
+        in_store = os.path.dirname(os.path.dirname(directory)) == self.root
+        record = {
+            "id": os.path.basename(directory) if in_store else uuid.uuid4().hex,
+            "session_id": session_id,
+            "name": os.path.basename(path),
+            "path": path,
+            "size": os.path.getsize(path),
+            "mime_type": mimetypes.guess_type(path)[0] or "application/octet-stream",
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._append(record)
+        return record
+
+    def _inside(self, path: str, directory: str) -> bool:
+        # Liens symboliques résolus : un lien qui pointe hors du stockage est refusé
+        real, directory = os.path.realpath(path), os.path.realpath(directory)
+        return real != directory and os.path.commonpath([real, directory]) == directory
+
+    def _servable(self, record: Optional[dict]) -> Optional[dict]:
+        # Anciennes entrées hors du stockage (fichiers du répertoire courant) : jamais servies
+        if record is not None and self._inside(record["path"], self.root) and os.path.isfile(record["path"]):
+            return record
+        return None
+
+    def get(self, artifact_id: str) -> Optional[dict]:
+        record = self._by_id.get(artifact_id)
+        if record is None:
+            # Peut-être produit par un autre worker depuis notre dernière lecture
+            with self._lock:
+                self._read_new_lines()
+                record = self._by_id.get(artifact_id)
+        return self._servable(record)
+
+    def resolve_path(self, path: str) -> Optional[dict]:
+        """Enregistrement d'un chemin renvoyé par un outil (relatif au répertoire courant ou absolu)."""
+        path = os.path.abspath(path)
+        record = self._by_path.get(path)
+        if record is None:
+            with self._lock:
+                self._read_new_lines()
+                record = self._by_path.get(path)
+        return self._servable(record)
+
+    def resolve(self, name: str, session_id: Optional[str]) -> Optional[dict]:
+        """Dernier fichier de la session portant ce nom (basename), None s'il n'y en a pas."""
+        with self._lock:
+            self._read_new_lines()
+            candidates = [r for r in self._by_id.values()
+                          if r["name"] == name and r["session_id"] == session_id]
+        candidates = [r for r in candidates if self._servable(r)]
+        return max(candidates, key=lambda r: r["created_at"]) if candidates else None
+
+    def locate(self, path_or_name: str, session_id: Optional[str] = None) -> Optional[str]:
+        """
+        Chemin d'un fichier de la session, désigné par son chemin ou par son seul nom.
+        Un chemin explicite doit se trouver dans le répertoire de la session sous ARTIFACTS_DIR.
+        """
+        if session_id is None:
+            session_id = current_session_id.get()
+        session_dir = os.path.join(self.root, _session_dir_name(session_id))
+        if os.path.dirname(path_or_name):
+            path = os.path.abspath(path_or_name)
+            return path if self._inside(path, session_dir) and os.path.isfile(path) else None
+        record = self.resolve(path_or_name, session_id)
+        return record["path"] if record else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            records = list(self._by_id.values())
+        return {"artifacts": len(records), "bytes": sum(r["size"] for r in records)}
+
+    def sweep(self, ttl: float = ARTIFACTS_TTL, max_bytes: int = ARTIFACTS_MAX_BYTES) -> int:
+        """Supprime les artefacts expirés puis les plus anciens au-delà de `max_bytes`."""
+        now = time.time()
+        with self._lock:
+            self._read_new_lines()
+            records = sorted(self._by_id.values(), key=lambda r: r["created_at"])
+            expired = [r for r in records if now - r["created_at"] > ttl or not os.path.isfile(r["path"])]
+            kept = [r for r in records if r not in expired]
+            total = sum(r["size"] for r in kept)
+            while kept and total > max_bytes:
+                oldest = kept.pop(0)
+                expired.append(oldest)
+                total -= oldest["size"]
+            for record in expired:
+                self._unindex(record)
+                self._delete_file(record)
+            if expired:
+                self._compact()
+            known = {os.path.dirname(r["path"]) for r in self._by_id.values()}
+        return len(expired) + self._sweep_orphans(known, now - ttl)
+
+    def _sweep_orphans(self, known: set, cutoff: float) -> int:
+        # Répertoires absents de l'index (enregistrement perdu, processus arrêté pendant un rendu)
+        removed = 0
+        try:
+            sessions = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return 0
+        for session in sessions:
+            if not session.is_dir():
+                continue
+            for entry in os.scandir(session.path):
+                if entry.is_dir() and entry.path not in known and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+            try:
+                os.rmdir(session.path)
+            except OSError:
+                pass
+        return removed
+
+    def _delete_file(self, record: dict):
+        path = record["path"]
+        directory = os.path.dirname(path)
+        if os.path.dirname(os.path.dirname(directory)) != self.root:
+            # Hors du stockage (anciens fichiers du répertoire courant) : on oublie l'entrée sans supprimer
+            return
+        shutil.rmtree(directory, ignore_errors=True)
+        try:
+            # Répertoire de session vide : supprimé aussi
+            os.rmdir(os.path.dirname(directory))
+        except OSError:
+            pass
+
+
+_registry: Optional[ArtifactRegistry] = None
+_registry_lock = threading.Lock()
+_registration_enabled = True
+_sweeper: Optional[threading.Thread] = None
+
+
+def disable_registration():
+    """Désactive l'enregistrement dans ce processus (processus de rendu des travaux en arrière-plan)."""
+    global _registration_enabled
+    _registration_enabled = False
+
+
+def get_registry() -> ArtifactRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ArtifactRegistry()
+    return _registry
+
+
+def register_artifact(path: str, session_id: Optional[str] = None) -> Optional[dict]:
+    if not _registration_enabled:
+        return None
+    return get_registry().register(path, session_id)
+
+
+def locate_artifact(path_or_name: str) -> Optional[str]:
+    return get_registry().locate(path_or_name)
+
+
+def _sweep_forever(interval: float):
+    while True:
+        try:
+            removed = get_registry().sweep()
+            if removed:
+                print(f"🧹 {removed} artefact(s) supprimé(s) (expirés ou au-delà du quota)")
+        except Exception as e:
+            print(f"⚠️ Nettoyage des artefacts impossible: {e}")
+        time.sleep(interval)
+
+
+def start_sweeper(interval: float = ARTIFACTS_GC_INTERVAL):
+    """Lance le nettoyage périodique (un seul thread par processus)."""
+    global _sweeper
+    with _registry_lock:
+        if _sweeper is not None or interval <= 0:
+            return
+        _sweeper = threading.Thread(target=_sweep_forever, args=(interval,), name="artifacts-gc", daemon=True)
+        _sweeper.start()
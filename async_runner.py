@@ -0,0 +1,171 @@
+# async_runner.py
+"""
+Exécution asynchrone d'un tour de conversation avec appels d'outils.
+
+Boucle équivalente à celle du `ToolCallingAgent`, mais :
+  - les appels au LLM passent par `litellm.acompletion` (aucun thread bloqué
+    pendant l'attente du modèle) ;
+  - les `forward` des outils (génération de documents, coûteuse en CPU) sont
+    exécutés sur un executor dédié, borné par `TOOL_EXECUTOR_WORKERS` ; les
+    appels indépendants d'une même étape tournent en parallèle (`tool_scheduler`).
+Un seul worker uvicorn peut ainsi garder des centaines de conversations en vol.
+"""
+import json
+import time
+import asyncio
+import contextvars
+from functools import partial
+from typing import Optional
+
+from smolagents.models import get_tool_json_schema
+
+from metrics import LLM_CALL_SECONDS, STEPS_PER_RUN, MEMORY_TOKENS_SAVED, record_tokens
+from agent_memory import MEMORY_COMPACTION_ENABLED, compact_tool_exchange
+from tracing import current_trace
+from tool_scheduler import get_tool_executor, plan_waves
+
+
+class AsyncAgentRunner:
+    def __init__(self, model_id: str, tools: list, instructions: str,
+                 api_key: Optional[str] = None, api_base: Optional[str] = None, max_steps: int = 10):
+        self.model_id = model_id
+        self.api_key = api_key
+        self.api_base = api_base
+        self.instructions = instructions
+        self.max_steps = max_steps
+        self.tools = {tool.name: tool for tool in tools}
+        self.tool_schemas = [get_tool_json_schema(tool) for tool in tools]
+
+    async def _complete(self, messages: list, tool_schemas: Optional[list] = None):
+        import litellm  # ~1 s à l'import : chargé au premier appel, pas au démarrage du serveur
+
+        kwargs = {"model": self.model_id, "messages": messages,
+                  "api_key": self.api_key, "api_base": self.api_base}
+        if tool_schemas:
+            kwargs["tools"] = tool_schemas
+            kwargs["tool_choice"] = "auto"
+        with LLM_CALL_SECONDS.time("async"):
+            response = await litellm.acompletion(**kwargs)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            record_tokens(usage.prompt_tokens, usage.completion_tokens)
+        return response.choices[0].message
+
+    async def _call_tool(self, name: str, raw_arguments) -> str:
+        tool = self.tools.get(name)
+        if tool is None:
+            return f"Erreur : outil inconnu '{name}', outils disponibles : {', '.join(self.tools)}."
+        try:
+            arguments = json.loads(raw_arguments) if isinstance(raw_arguments, str) else (raw_arguments or {})
+        except ValueError as e:
+            return f"Erreur : arguments JSON invalides pour '{name}' : {e}"
+        loop = asyncio.get_running_loop()
+        # Copier le contexte pour conserver la session courante dans le thread de l'outil
+        ctx = contextvars.copy_context()
+        try:
+            result = await loop.run_in_executor(
+                get_tool_executor(), partial(ctx.run, tool, **arguments, sanitize_inputs_outputs=True)
+            )
+        except Exception as e:
+            return f"Erreur lors de l'exécution de l'outil '{name}' : {type(e).__name__}: {e}"
+        return str(result).strip()
+
+    async def _call_tools(self, tool_calls: list) -> list:
+        """Observations dans l'ordre des appels ; les appels indépendants tournent en parallèle."""
+        calls = []
+        for call in tool_calls:
+            try:
+                arguments = json.loads(call.function.arguments) if isinstance(call.function.arguments, str) \
+                    else call.function.arguments
+            except ValueError:
+                arguments = None
+            calls.append((call.function.name, arguments))
+        observations = [None] * len(tool_calls)
+        for wave in plan_waves(calls):
+            results = await asyncio.gather(*(
+                self._call_tool(tool_calls[i].function.name, tool_calls[i].function.arguments) for i in wave
+            ))
+            for i, observation in zip(wave, results):
+                observations[i] = observation
+        return observations
+
+    async def run(self, task: str, called_tools: Optional[list] = None,
+                  tool_names: Optional[list] = None) -> str:
+        """
+        Exécute le tour ; les noms des outils appelés sont ajoutés à `called_tools` si fourni.
+        `tool_names` restreint les outils proposés au modèle (tous par défaut).
+        """
+        tool_schemas = [
+            schema for schema in self.tool_schemas
+            if tool_names is None or schema["function"]["name"] in tool_names
+        ]
+        messages = [
+            {"role": "system", "content": self.instructions},
+            {"role": "user", "content": task},
+        ]
+        file_path = None
+        trace = current_trace.get()
+        # Tokens retirés des messages par la compaction, économisés à chaque appel suivant
+        compacted = saved = 0
+
+        for step in range(1, self.max_steps + 1):
+            step_started = time.time()
+            saved += compacted
+            message = await self._complete(messages, tool_schemas)
+            tool_calls = message.tool_calls or []
+            if not tool_calls:
+                STEPS_PER_RUN.observe(step)
+                self._record_savings(saved)
+                if trace is not None:
+                    trace.add_span(f"step {step}", step_started, time.time(), kind="step")
+                return self._with_file(message.content or "", file_path)
+
+            assistant_message = {
+                "role": "assistant",
+                "content": message.content or "",
+                "tool_calls": [
+                    {"id": call.id, "type": "function",
+                     "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                    for call in tool_calls
+                ],
+            }
+            messages.append(assistant_message)
+            if called_tools is not None:
+                called_tools.extend(call.function.name for call in tool_calls)
+            observations = await self._call_tools(tool_calls)
+            tool_messages = []
+            for call, observation in zip(tool_calls, observations):
+                if "||" in observation:
+                    file_path = observation.split("||", 1)[1].strip()
+                tool_messages.append({
+                    "role": "tool",
+                    "tool_call_id": call.id,
+                    "name": call.function.name,
+                    "content": observation,
+                })
+            messages.extend(tool_messages)
+            if MEMORY_COMPACTION_ENABLED:
+                # Les outils ont tourné : arguments et observations volumineux sont condensés
+                compacted += compact_tool_exchange(assistant_message, tool_messages)
+            if trace is not None:
+                trace.add_span(f"step {step}", step_started, time.time(), kind="step",
+                               metadata={"tool_calls": [call.function.name for call in tool_calls]})
+
+        # Nombre maximal d'étapes atteint : demander une réponse finale sans outil
+        messages.append({"role": "user", "content": "Donne maintenant ta réponse finale à l'utilisateur."})
+        STEPS_PER_RUN.observe(self.max_steps + 1)
+        message = await self._complete(messages)
+        self._record_savings(saved + compacted)
+        return self._with_file(message.content or "", file_path)
+
+    @staticmethod
+    def _record_savings(saved: int):
+        if MEMORY_COMPACTION_ENABLED:
+            MEMORY_TOKENS_SAVED.observe(saved, "async")
+
+    @staticmethod
+    def _with_file(text: str, file_path: Optional[str]) -> str:
+        # Même convention que les outils : "texte||chemin_du_fichier"
+        if file_path and "||" not in text:
+            return f"{text}||{file_path}"
+        return text
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+Banc d'essai hors ligne : débit et latence sans appeler Mistral.
+
+Un modèle scripté (`ScriptedModel`) remplace `LiteLLMModel` : réponses
+déterministes, appels d'outils écrits à l'avance par scénario et latence
+configurable par appel. Les outils, eux, tournent réellement (PDF, Excel,
+Word générés dans un répertoire temporaire).
+
+    python benchmark.py                                   # charge (agent) + micro-benchmarks
+    python benchmark.py load --target http -c 16 -n 400   # /mcp/chat en concurrence
+    python benchmark.py tools --repeat 5
+    python benchmark.py --save main                       # enregistre une référence
+    python benchmark.py --compare main                    # compare à la référence (code 1 si régression)
+
+Rapport : latence p50/p95/p99, requêtes par seconde, mémoire (RSS) et durée
+de chaque outil. Les références sont des fichiers JSON dans BENCH_BASELINE_DIR.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+
+from smolagents.models import Model, ChatMessage, ChatMessageToolCall, ChatMessageToolCallFunction
+from smolagents.monitoring import TokenUsage
+
+
+BENCH_BASELINE_DIR = os.getenv(
+    "BENCH_BASELINE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines")
+)
+# Dégradation relative au-delà de laquelle une métrique est signalée comme régression
+BENCH_REGRESSION_THRESHOLD = float(os.getenv("BENCH_REGRESSION_THRESHOLD", "0.10"))
+
+# Le banc d'essai doit tourner sans réseau ni effet de bord
+os.environ.setdefault("AGENT_WARMUP", "blocking")
+os.environ.setdefault("TRACING_EXPORTER", "none")
+os.environ.setdefault("JOBS_ENABLED", "false")
+# Toutes les requêtes viennent du même client : pas de limite de débit par client
+os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+_TAG = re.compile(r"\[bench-(\w+)-(\d+)\]")
+
+
+# --- Scénarios : message envoyé + appels d'outils que le modèle va « décider » ---
+def _pdf_call(n: str) -> tuple:
+    return ("BuildPDF", {"name": f"bench_rapport_{n}", "title": f"Rapport {n}",
+                         "content": "# Synthèse\n" + "\n".join(f"- Point {i} du rapport {n}" for i in range(20))})
+
+
+def _excel_call(n: str) -> tuple:
+    return ("BuildExcelPro", {"name": f"bench_tableau_{n}", "headers": ["Produit", "Quantité", "Prix"],
+                              "rows": [[f"Article {i}", i, i * 1.5] for i in range(200)]})
+
+
+def _word_call(n: str) -> tuple:
+    return ("BuildWord", {"title": "Lettre", "recipient": "Service client\n1 rue de Paris",
+                          "sender": "Jean Dupont\njean@example.com", "date": "Paris, le 1er janvier 2026",
+                          "subject": f"Demande {n}", "body": "Madame, Monsieur,\n\n" + "Paragraphe de la lettre. " * 40,
+                          "filename": f"bench_lettre_{n}"})
+
+
+SCENARIOS = {
+    "direct": ("Quelle est la différence entre un devis et une facture ?", lambda n: []),
+    "pdf": ("Génère un pdf du rapport d'activité", lambda n: [_pdf_call(n)]),
+    "excel": ("Crée un fichier excel des ventes", lambda n: [_excel_call(n)]),
+    "word": ("Rédige une lettre word de réclamation", lambda n: [_word_call(n)]),
+    # Plusieurs étapes : les arguments volumineux de la première sont renvoyés aux suivantes
+    "excel_pdf": ("Crée un fichier excel des ventes puis un pdf de synthèse",
+                  lambda n: [_excel_call(n), _pdf_call(n)]),
+    # Une liste = plusieurs appels émis dans la même étape
+    "pdf_word": ("Génère le pdf du rapport et la lettre word", lambda n: [[_pdf_call(n), _word_call(n)]]),
+}
+# Répartition par défaut : surtout des questions simples, quelques documents
+MIXES = {
+    "mixed": ["direct", "direct", "pdf", "direct", "excel", "direct", "word", "direct"],
+    **{name: [name] for name in SCENARIOS},
+}
+
+
+def _text_of(message) -> str:
+    content = message.get("content") if isinstance(message, dict) else message.content
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _role_of(message) -> str:
+    role = message.get("role") if isinstance(message, dict) else message.role
+    return str(getattr(role, "value", role))
+
+
+def _has_tool_calls(message) -> bool:
+    calls = message.get("tool_calls") if isinstance(message, dict) else getattr(message, "tool_calls", None)
+    return bool(calls)
+
+
+class ScriptedModel(Model):
+    """
+    Modèle smolagents déterministe : l'étape courante se déduit des appels
+    d'outils déjà présents dans les messages, sans état partagé entre requêtes
+    (utilisable par plusieurs agents en parallèle).
+    """
+
+    def __init__(self, latency: float = 0.05, model_id: str = "scripted/bench"):
+        super().__init__(model_id=model_id)
+        self.latency = latency
+
+    def respond(self, messages: list, final_as_tool: bool) -> ChatMessage:
+        prompt = " ".join(_text_of(m) for m in messages)
+        done = sum(1 for m in messages if _role_of(m) == "tool-call"
+                   or (_role_of(m) == "assistant" and _has_tool_calls(m)))
+        match = None
+        for m in messages:
+            if _role_of(m) == "user":
+                match = _TAG.search(_text_of(m)) or match
+        script = SCENARIOS[match.group(1)][1](match.group(2)) if match else []
+        usage = TokenUsage(input_tokens=len(prompt) // 4, output_tokens=40)
+        # Comme le vrai modèle : la réponse finale reprend le fichier produit ("texte||chemin")
+        answer = "Réponse."
+        for m in messages:
+            text = _text_of(m)
+            if script and _role_of(m) in ("tool", "tool-response") and "||" in text:
+                answer = "Voici le document demandé.||" + text.rsplit("||", 1)[1].strip()
+
+        if done < len(script):
+            step = script[done] if isinstance(script[done], list) else [script[done]]
+        elif final_as_tool:
+            step = [("final_answer", {"answer": answer})]
+        else:
+            return ChatMessage(role="assistant", content=answer, token_usage=usage)
+        calls = [
+            ChatMessageToolCall(id=f"call_{done}_{i}", type="function",
+                                function=ChatMessageToolCallFunction(name=name, arguments=arguments))
+            for i, (name, arguments) in enumerate(step)
+        ]
+        return ChatMessage(role="assistant", content="", tool_calls=calls, token_usage=usage)
+
+    def generate(self, messages, stop_sequences=None, response_format=None, tools_to_call_from=None, **kwargs):
+        time.sleep(self.latency)
+        return self.respond(messages, final_as_tool=tools_to_call_from is not None)
+
+
+def create_scripted_runner(model: ScriptedModel):
+    """Runner asynchrone dont les complétions viennent du modèle scripté au lieu de litellm."""
+    from agent_core import CUSTOM_INSTRUCTIONS, MAX_STEPS, create_tools
+    from async_runner import AsyncAgentRunner
+    from metrics import LLM_CALL_SECONDS, record_tokens
+
+    class ScriptedAsyncRunner(AsyncAgentRunner):
+        async def _complete(self, messages: list, tool_schemas: Optional[list] = None):
+            with LLM_CALL_SECONDS.time("async"):
+                await asyncio.sleep(model.latency)
+                message = model.respond(messages, final_as_tool=False)
+            record_tokens(message.token_usage.input_tokens, message.token_usage.output_tokens)
+            return message
+
+    return ScriptedAsyncRunner(model_id=model.model_id, tools=create_tools(),
+                               instructions=CUSTOM_INSTRUCTIONS, max_steps=MAX_STEPS)
+
+
+# --- Mesures ---
+def percentile(values: list, q: float) -> float:
+    """Percentile au rang le plus proche (q entre 0 et 100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilo-octets sous Linux, octets sous macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def _input_tokens() -> float:
+    from metrics import LLM_TOKENS
+
+    return LLM_TOKENS.value("input")
+
+
+def _summary(latencies: list, errors: int, elapsed: float, rss_start: float, tokens_start: float) -> dict:
+    count = len(latencies) + errors
+    return {
+        "requests": count,
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        # Tokens envoyés au modèle (scripté : ≈ 4 caractères par token)
+        "input_tokens_per_request": round((_input_tokens() - tokens_start) / count) if count else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 1),
+        "rss_start_mb": round(rss_start, 1),
+        "rss_end_mb": round(rss_mb(), 1),
+        "rss_peak_mb": round(peak_rss_mb(), 1),
+    }
+
+
+@contextlib.contextmanager
+def _quiet(enabled: bool):
+    # Les journaux de l'agent (un panneau par étape) noieraient le rapport
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _requests(count: int, mix: str, sessions: int, offset: int = 0):
+    scenarios = MIXES[mix]
+    for i in range(offset, offset + count):
+        scenario = scenarios[i % len(scenarios)]
+        yield f"bench-{i % sessions if sessions else i}", f"{SCENARIOS[scenario][0]} [bench-{scenario}-{i}]"
+
+
+def _is_error(response: dict) -> bool:
+    text = str(response.get("answer", response.get("content", "")))
+    return text.startswith("Erreur")
+
+
+def run_agent_load(concurrency: int, count: int, mix: str, sessions: int, warmup: int) -> dict:
+    """`chat_with_agent` appelé depuis `concurrency` threads, comme le fait /mcp/chat en mode sync."""
+    from agent_core import chat_with_agent
+
+    def one(item):
+        session_id, message = item
+        started = time.perf_counter()
+        try:
+            response = chat_with_agent(session_id, message)
+        except Exception:
+            return None
+        return None if _is_error(response) else time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, _requests(warmup, mix, sessions, offset=count)))
+        rss_start, tokens_start = rss_mb(), _input_tokens()
+        started = time.perf_counter()
+        results = list(pool.map(one, _requests(count, mix, sessions)))
+        elapsed = time.perf_counter() - started
+    latencies = [r for r in results if r is not None]
+    return _summary(latencies, len(results) - len(latencies), elapsed, rss_start, tokens_start)
+
+
+async def _http_load(concurrency: int, count: int, mix: str, sessions: int, warmup: int) -> dict:
+    import httpx
+    from mcp_server import app
+
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    # Démarrage et arrêt de l'application comme sous uvicorn (préchauffage de l'agent compris)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600) as client:
+            async def one(item):
+                session_id, message = item
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post("/mcp/chat", json={"session_id": session_id, "message": message})
+                    except httpx.HTTPError:
+                        return None
+                    if response.status_code != 200 or _is_error(response.json()):
+                        return None
+                    return time.perf_counter() - started
+
+            await asyncio.gather(*(one(item) for item in _requests(warmup, mix, sessions, offset=count)))
+            rss_start, tokens_start = rss_mb(), _input_tokens()
+            started = time.perf_counter()
+            results = await asyncio.gather(*(one(item) for item in _requests(count, mix, sessions)))
+            elapsed = time.perf_counter() - started
+    latencies = [r for r in results if r is not None]
+    return _summary(latencies, len(results) - len(latencies), elapsed, rss_start, tokens_start)
+
+
+def run_http_load(concurrency: int, count: int, mix: str, sessions: int, warmup: int) -> dict:
+    """POST /mcp/chat sur l'application en mémoire (ASGI, sans socket) avec `concurrency` requêtes en vol."""
+    return asyncio.run(_http_load(concurrency, count, mix, sessions, warmup))
+
+
+# --- Micro-benchmarks des outils ---
+def _pdf_content(pages: int) -> str:
+    # ~5 sections par page A4 avec les styles par défaut (le titre occupe la première)
+    sections = []
+    for i in range(max(1, pages * 5 - 2)):
+        sections.append(f"## Section {i + 1}\n" + "Texte du paragraphe, suffisamment long pour remplir la ligne. " * 6
+                        + "\n" + "\n".join(f"- Élément {j}" for j in range(4)))
+    return "\n\n".join(sections)
+
+
+def _search_burst(r: int) -> str:
+    """200 recherches (20 requêtes, casse et ponctuation variables) sur 8 threads, cache hors ligne neuf."""
+    from search_cache import SearchCache
+
+    path = os.path.abspath("bench_search_fixtures.json")
+    if not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({f"prix du produit {i}": f"## Search Results\n\n[Produit {i}](https://example.com/{i})\n"
+                       + "Description du produit. " * 20 for i in range(20)}, f, ensure_ascii=False)
+    cache = SearchCache(mode="offline", fixtures_path=path)
+    queries = [f"Prix du produit {i % 20}{' ?' * (i % 3)}".upper() if i % 2 else f"prix du produit {i % 20}"
+               for i in range(200)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(cache.search, queries))
+    return f"{cache.stats()['misses']} recherches"
+
+
+def tool_cases() -> dict:
+    from tools import BuildExcelPro, BuildPDF, BuildWord
+
+    headers = ["Date", "Client", "Produit", "Quantité", "Prix unitaire", "Total"]
+
+    def rows(count):
+        return [[f"2026-01-{i % 28 + 1:02d}", f"Client {i % 97}", f"Produit {i % 13}", i % 50, 9.99, (i % 50) * 9.99]
+                for i in range(count)]
+
+    excel, pdf, word = BuildExcelPro(), BuildPDF(), BuildWord()
+    return {
+        "excel_1k": lambda r: excel.forward(f"bench_excel_1k_{r}", headers, rows(1_000)),
+        "excel_100k": lambda r: excel.forward(f"bench_excel_100k_{r}", headers, rows(100_000)),
+        "pdf_1p": lambda r: pdf.forward(f"bench_pdf_1p_{r}", f"Rapport {r}", _pdf_content(1)),
+        "pdf_50p": lambda r: pdf.forward(f"bench_pdf_50p_{r}", f"Rapport {r}", _pdf_content(50)),
+        "word": lambda r: word.forward("Lettre", "Service client\n1 rue de Paris", "Jean Dupont\njean@example.com",
+                                       "Paris, le 1er janvier 2026", f"Demande {r}",
+                                       "Madame, Monsieur,\n\n" + "\n\n".join(["Paragraphe de la lettre. " * 12] * 8)
+                                       + "\n\n- premier point\n- second point",
+                                       f"bench_word_{r}"),
+        "search_200": _search_burst,
+    }
+
+
+def run_tool_benchmarks(repeat: int, only: Optional[list] = None) -> dict:
+    """Chaque cas est rendu `repeat` fois avec un contenu distinct (aucun hit du cache de documents)."""
+    results = {}
+    for name, case in tool_cases().items():
+        if only and name not in only:
+            continue
+        timings = []
+        for r in range(repeat):
+            started = time.perf_counter()
+            output = case(r)
+            timings.append(time.perf_counter() - started)
+            if str(output).startswith("Erreur"):
+                raise RuntimeError(f"{name} : {output}")
+        results[name] = {"median_s": round(percentile(timings, 50), 4), "min_s": round(min(timings), 4)}
+    return results
+
+
+# --- Références ---
+def _metrics_of(report: dict) -> dict:
+    """{"load.agent.p95_ms": (valeur, plus_haut_est_mieux), ...}"""
+    flat = {}
+    for target, summary in report.get("load", {}).items():
+        for key in ("p50_ms", "p95_ms", "p99_ms", "rss_peak_mb", "input_tokens_per_request"):
+            flat[f"load.{target}.{key}"] = (summary[key], False)
+        flat[f"load.{target}.rps"] = (summary["rps"], True)
+    for name, summary in report.get("tools", {}).items():
+        flat[f"tools.{name}.median_s"] = (summary["median_s"], False)
+    return flat
+
+
+def baseline_path(name: str) -> str:
+    return os.path.join(BENCH_BASELINE_DIR, f"{name}.json")
+
+
+def save_baseline(name: str, report: dict) -> str:
+    os.makedirs(BENCH_BASELINE_DIR, exist_ok=True)
+    path = baseline_path(name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def compare(baseline: dict, report: dict, threshold: float = BENCH_REGRESSION_THRESHOLD) -> tuple:
+    """Retourne les lignes du comparatif et les métriques dégradées de plus de `threshold`."""
+    before, after = _metrics_of(baseline), _metrics_of(report)
+    lines, regressions = [f"{'métrique':<32} {'référence':>12} {'actuel':>12} {'écart':>8}"], []
+    for key, (value, higher_is_better) in after.items():
+        if key not in before or not before[key][0]:
+            continue
+        reference = before[key][0]
+        change = (value - reference) / reference
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > threshold:
+            flag = "  ❌ régression"
+            regressions.append(key)
+        elif worse < -threshold:
+            flag = "  ✅"
+        lines.append(f"{key:<32} {reference:>12} {value:>12} {change:>+7.0%}{flag}")
+    return lines, regressions
+
+
+# --- Point d'entrée ---
+def _print_load(target: str, summary: dict):
+    print(f"  {target:<6} {summary['requests']} requêtes ({summary['errors']} erreurs)  "
+          f"{summary['rps']} req/s  p50 {summary['p50_ms']}ms  p95 {summary['p95_ms']}ms  "
+          f"p99 {summary['p99_ms']}ms  {summary['input_tokens_per_request']} tokens/req  RSS {summary['rss_start_mb']}→{summary['rss_end_mb']}MB "
+          f"(pic {summary['rss_peak_mb']}MB)")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Banc d'essai hors ligne (modèle scripté)")
+    parser.add_argument("suite", nargs="?", choices=("all", "load", "tools"), default="all")
+    parser.add_argument("--target", choices=("agent", "http", "both"), default="agent",
+                        help="agent : chat_with_agent ; http : POST /mcp/chat")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=None, help="requêtes non mesurées (défaut : concurrence)")
+    parser.add_argument("--sessions", type=int, default=0, help="sessions distinctes (0 : une par requête)")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--latency", type=float, default=0.05, help="latence simulée d'un appel au LLM (s)")
+    parser.add_argument("--repeat", type=int, default=3, help="répétitions par micro-benchmark")
+    parser.add_argument("--tool", action="append", help="micro-benchmark à lancer (répétable)")
+    parser.add_argument("--save", metavar="NOM", help="enregistre le rapport comme référence")
+    parser.add_argument("--compare", metavar="NOM", help="compare le rapport à une référence")
+    parser.add_argument("--threshold", type=float, default=BENCH_REGRESSION_THRESHOLD)
+    parser.add_argument("--json", metavar="FICHIER", help="écrit le rapport complet en JSON")
+    parser.add_argument("--verbose", action="store_true", help="garde les journaux de l'agent")
+    parser.add_argument("--keep", action="store_true", help="conserve le répertoire de travail temporaire")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(baseline_path(args.compare), encoding="utf-8") as f:
+            baseline = json.load(f)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # Historique, artefacts, caches et documents dans un répertoire jetable
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {"concurrency": args.concurrency, "requests": args.requests, "mix": args.mix,
+                   "latency": args.latency, "repeat": args.repeat,
+                   "execution_mode": os.getenv("AGENT_EXECUTION_MODE", "sync")},
+    }
+    try:
+        if args.suite in ("all", "load"):
+            from agent_core import set_shared_model
+            from metrics import instrument_model
+
+            model = ScriptedModel(latency=args.latency)
+            set_shared_model(instrument_model(model), create_scripted_runner(model))
+            warmup = args.concurrency if args.warmup is None else args.warmup
+            targets = ("agent", "http") if args.target == "both" else (args.target,)
+            print(f"🏋️ Charge : {args.requests} requêtes, concurrence {args.concurrency}, "
+                  f"LLM simulé {args.latency * 1000:.0f}ms, mix {args.mix}")
+            report["load"] = {}
+            for target in targets:
+                run = run_agent_load if target == "agent" else run_http_load
+                with _quiet(not args.verbose):
+                    summary = run(args.concurrency, args.requests, args.mix, args.sessions, warmup)
+                report["load"][target] = summary
+                _print_load(target, summary)
+        if args.suite in ("all", "tools"):
+            print(f"🧰 Outils ({args.repeat} répétitions) :")
+            with _quiet(not args.verbose):
+                tools_report = run_tool_benchmarks(args.repeat, args.tool)
+            for name, summary in tools_report.items():
+                print(f"  {name:<12} médiane {summary['median_s'] * 1000:>9.1f}ms   min {summary['min_s'] * 1000:>9.1f}ms")
+            report["tools"] = tools_report
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        if args.keep:
+            print(f"📁 Répertoire de travail conservé : {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save:
+        print(f"💾 Référence enregistrée : {save_baseline(args.save, report)}")
+    if baseline is not None:
+        lines, regressions = compare(baseline, report, args.threshold)
+        print(f"\n📊 Comparaison avec « {args.compare} » (seuil {args.threshold:.0%}) :")
+        print("\n".join(lines))
+        if regressions:
+            print(f"\n❌ {len(regressions)} régression(s) : {', '.join(regressions)}")
+            return 1
+        print("\n✅ Aucune régression")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+# conversation_context.py
+"""
+Construction de l'entrée de l'agent à partir de l'historique, dans un budget de tokens.
+
+  - les N derniers tours sont repris mot pour mot ;
+  - les tours plus anciens sont condensés dans un résumé glissant, mis à jour
+    par lots (un appel au LLM tous les CONTEXT_SUMMARY_BATCH_TURNS tours) et
+    gardé en cache par session ; après un redémarrage ou une éviction, le
+    rattrapage ne soumet au LLM que les échanges les plus récents, dans la
+    limite de CONTEXT_SUMMARY_INPUT_TOKENS ;
+  - les fichiers générés pendant la conversation restent toujours cités.
+
+Le nombre de tokens envoyés au modèle reste ainsi stable même pour de très
+longues sessions.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "4"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_SUMMARY_BATCH_TURNS = int(os.getenv("CONTEXT_SUMMARY_BATCH_TURNS", "4"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "400"))
+CONTEXT_CACHE_SESSIONS = int(os.getenv("CONTEXT_CACHE_SESSIONS", "256"))
+# Taille maximale des échanges envoyés en une fois au LLM pour mettre à jour le résumé
+CONTEXT_SUMMARY_INPUT_TOKENS = int(os.getenv("CONTEXT_SUMMARY_INPUT_TOKENS", "4000"))
+
+SUMMARY_PROMPT = """Tu maintiens le résumé d'une conversation entre un utilisateur et un assistant.
+Mets à jour le résumé existant avec les nouveaux échanges ci-dessous.
+Garde les faits, décisions, préférences et demandes en cours ; supprime les formules de politesse.
+Réponds uniquement par le nouveau résumé, en français, en {max_words} mots maximum.
+
+Résumé existant :
+{summary}
+
+Nouveaux échanges :
+{exchanges}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    # Approximation suffisante pour un budget (≈ 4 caractères par token), sans tokenizer
+    return len(text) // 4 + 1
+
+
+def _format_message(message: dict) -> str:
+    speaker = "Utilisateur" if message.get("role") == "user" else "Assistant"
+    line = f"{speaker} : {message.get('content', '')}"
+    if message.get("file_path"):
+        line += f" [fichier : {os.path.basename(message['file_path'])}]"
+    return line
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    return text if len(text) <= max_chars else text[:max_chars].rsplit(" ", 1)[0] + "…"
+
+
+class ConversationContext:
+    def __init__(self, summarize: Optional[Callable[[str], str]] = None,
+                 recent_turns: int = CONTEXT_RECENT_TURNS,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 summary_batch_turns: int = CONTEXT_SUMMARY_BATCH_TURNS,
+                 summary_max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS,
+                 max_cached_sessions: int = CONTEXT_CACHE_SESSIONS,
+                 summary_input_tokens: int = CONTEXT_SUMMARY_INPUT_TOKENS):
+        self.summarize = summarize
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summary_batch_turns = summary_batch_turns
+        self.summary_max_tokens = summary_max_tokens
+        self.max_cached_sessions = max_cached_sessions
+        self.summary_input_tokens = summary_input_tokens
+        # session_id -> {"covered": nb de messages résumés, "summary": str, "artifacts": [noms], "lock": Lock}
+        self._summaries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _state(self, session_id: str) -> dict:
+        with self._lock:
+            state = self._summaries.get(session_id)
+            if state is None:
+                state = self._summaries[session_id] = {"covered": 0, "summary": "", "artifacts": [],
+                                                       "lock": threading.Lock()}
+            self._summaries.move_to_end(session_id)
+            while len(self._summaries) > self.max_cached_sessions:
+                self._summaries.popitem(last=False)
+            return state
+
+    def _update_summary(self, state: dict, history: list, upto: int):
+        """Intègre history[covered:upto] au résumé glissant."""
+        new_messages = history[state["covered"]:upto]
+        for m in new_messages:
+            if m.get("file_path"):
+                name = os.path.basename(m["file_path"])
+                if name not in state["artifacts"]:
+                    state["artifacts"].append(name)
+        # Rattrapage borné (résumé perdu au redémarrage ou évincé) : les échanges les plus
+        # récents d'abord, dans la limite du budget ; les plus anciens sont abandonnés
+        lines, remaining = [], self.summary_input_tokens
+        for m in reversed(new_messages):
+            line = _format_message(m)
+            cost = estimate_tokens(line)
+            if cost > remaining:
+                if not lines:
+                    lines.append(_truncate_to_tokens(line, remaining))
+                break
+            lines.append(line)
+            remaining -= cost
+        lines.reverse()
+        exchanges = "\n".join(lines)
+        summary = None
+        if self.summarize is not None:
+            prompt = SUMMARY_PROMPT.format(
+                max_words=self.summary_max_tokens * 3 // 4,
+                summary=state["summary"] or "(aucun)",
+                exchanges=exchanges,
+            )
+            try:
+                summary = self.summarize(prompt)
+            except Exception as e:
+                print(f"⚠️ Résumé de conversation impossible, repli extractif: {e}")
+        if not summary:
+            # Repli sans LLM : on garde le début de chaque échange
+            condensed = "\n".join(_truncate_to_tokens(line, 40) for line in lines)
+            summary = f"{state['summary']}\n{condensed}".strip()
+        state["summary"] = _truncate_to_tokens(summary.strip(), self.summary_max_tokens)
+        state["covered"] = upto
+
+    def build(self, session_id: str, history: list, message: str) -> str:
+        """Retourne la tâche à donner à l'agent pour `message`, compte tenu de `history`."""
+        if not history:
+            return message
+
+        state = self._state(session_id)
+        # Verrou par session pendant l'appel au LLM : la voie directe (router) ne passe
+        # pas par le pool d'agents, deux tours d'une même session peuvent arriver ensemble
+        with state["lock"]:
+            if state["covered"] > len(history):
+                # Historique plus court que prévu (session recréée) : on repart de zéro
+                state.update(covered=0, summary="", artifacts=[])
+
+            # Fenêtre verbatim : N derniers tours, plus les tours pas encore résumés.
+            # Le résumé n'est recalculé que par lots pour ne pas payer un appel LLM à chaque tour.
+            recent_start = max(0, len(history) - 2 * self.recent_turns)
+            if recent_start - state["covered"] >= 2 * self.summary_batch_turns:
+                self._update_summary(state, history, recent_start)
+            summary, covered, artifacts = state["summary"], state["covered"], list(state["artifacts"])
+        verbatim = history[covered:]
+
+        for m in verbatim:
+            if m.get("file_path"):
+                name = os.path.basename(m["file_path"])
+                if name not in artifacts:
+                    artifacts.append(name)
+
+        header = []
+        if summary:
+            header.append(f"[Résumé de la conversation précédente]\n{summary}")
+        if artifacts:
+            header.append("[Fichiers déjà générés dans cette conversation]\n" + "\n".join(f"- {a}" for a in artifacts))
+        footer = f"[Nouveau message de l'utilisateur]\n{message}"
+
+        # Les échanges les plus récents sont prioritaires dans le budget restant
+        remaining = self.token_budget - estimate_tokens("\n\n".join(header + [footer]))
+        lines = []
+        for m in reversed(verbatim):
+            line = _format_message(m)
+            cost = estimate_tokens(line)
+            if cost > remaining:
+                break
+            lines.append(line)
+            remaining -= cost
+        lines.reverse()
+
+        parts = header
+        if lines:
+            parts = parts + ["[Derniers échanges]\n" + "\n".join(lines)]
+        return "\n\n".join(parts + [footer])
@@ -0,0 +1,162 @@
+# document_cache.py
+"""
+Cache adressé par contenu des documents générés (Word, PDF, Excel).
+
+La clé est un hash du nom de l'outil et de ses entrées normalisées (hors nom
+de fichier). Sur un hit, l'outil ne refait aucun rendu : le fichier déjà
+produit est exposé sous le nom demandé par la requête (lien physique, ou
+copie si le système de fichiers ne le permet pas).
+
+Les fichiers de référence vivent dans DOCUMENT_CACHE_DIR, partagé par tous
+les workers : un document rendu par l'un est un hit pour les autres. Leur
+taille totale est bornée par DOCUMENT_CACHE_MAX_BYTES, avec éviction LRU
+(date d'accès, mise à jour à chaque hit). L'éviction se fait après chaque
+ajout, sur la taille réelle du répertoire et non sur ce qu'un seul processus
+y a écrit.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import unicodedata
+from typing import Optional
+
+from metrics import DOCUMENT_CACHE_REQUESTS
+
+
+DOCUMENT_CACHE_ENABLED = os.getenv("DOCUMENT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+DOCUMENT_CACHE_DIR = os.getenv("DOCUMENT_CACHE_DIR", "document_cache")
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        text = unicodedata.normalize("NFC", value.replace("\r\n", "\n"))
+        return "\n".join(line.rstrip() for line in text.strip().split("\n"))
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def document_key(tool_name: str, inputs: dict) -> str:
+    """Hash du nom de l'outil et de ses entrées normalisées (les None sont ignorés)."""
+    payload = {k: _normalize(v) for k, v in inputs.items() if v is not None}
+    raw = json.dumps([tool_name, payload], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class DocumentCache:
+    def __init__(self, directory: str = DOCUMENT_CACHE_DIR, max_bytes: int = DOCUMENT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _scan(self) -> list:
+        """Fichiers de référence présents (tous processus confondus) : [(accès, nom, taille)]."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_atime_ns, entry.name, stat.st_size))
+        return files
+
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self.directory, blob)
+
+    @staticmethod
+    def _touch(path: str, stat: os.stat_result):
+        # Date d'accès posée explicitement (montages noatime) ; mtime inchangée : ETag des artefacts liés stable
+        try:
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _link(src: str, dest: str):
+        """Expose `src` sous le nom `dest`, en remplaçant atomiquement un fichier existant."""
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+
+    def fetch(self, key: str, ext: str, dest: str) -> bool:
+        """Sur un hit, place le document en cache à `dest` et retourne True."""
+        # Le répertoire fait foi : les documents stockés par les autres workers sont des hits
+        path = self._blob_path(f"{key}{ext}")
+        try:
+            stat = os.stat(path)
+            self._link(path, dest)
+        except FileNotFoundError:
+            # Jamais rendu, ou évincé entre-temps (par un autre processus par exemple)
+            with self._lock:
+                self.misses += 1
+            DOCUMENT_CACHE_REQUESTS.inc(ext.lstrip("."), "miss")
+            return False
+        self._touch(path, stat)
+        with self._lock:
+            self.hits += 1
+        DOCUMENT_CACHE_REQUESTS.inc(ext.lstrip("."), "hit")
+        return True
+
+    def store(self, key: str, ext: str, src: str):
+        """Ajoute au cache le document tout juste rendu à `src`, puis évince selon la taille réelle du répertoire."""
+        blob = f"{key}{ext}"
+        size = os.path.getsize(src)
+        if size > self.max_bytes:
+            return
+        path = self._blob_path(blob)
+        self._link(src, path)
+        self._touch(path, os.stat(path))
+        with self._lock:
+            files = sorted(self._scan())
+            total = sum(file_size for _, _, file_size in files)
+            for _, name, old_size in files:
+                if total <= self.max_bytes:
+                    break
+                if name == blob:
+                    continue
+                try:
+                    os.remove(self._blob_path(name))
+                except FileNotFoundError:
+                    pass  # Déjà évincé par un autre worker
+                total -= old_size
+
+    def stats(self) -> dict:
+        files = self._scan()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(files),
+                "bytes": sum(size for _, _, size in files),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_cache: Optional[DocumentCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_document_cache() -> Optional[DocumentCache]:
+    """Retourne le cache partagé, ou None s'il est désactivé."""
+    global _cache
+    if not DOCUMENT_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = DocumentCache()
+    return _cache
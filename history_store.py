@@ -0,0 +1,263 @@
+# history_store.py
+"""
+Stockage de l'historique des conversations, en ajout seul.
+
+Chaque tour ajoute ses messages à la fin du stockage au lieu de réécrire tout
+l'historique : le coût d'E/S d'un tour reste constant quelle que soit la
+longueur de la conversation.
+
+Backends disponibles (variable HISTORY_BACKEND) :
+  - "jsonl"  (défaut) : un fichier `history_{session}.jsonl` par session
+  - "sqlite" : une base unique `history.sqlite3` (mode WAL)
+
+Les sessions récemment utilisées sont gardées en mémoire (LRU) avec la
+position atteinte dans le stockage (taille lue du fichier, dernier id SQLite).
+Chaque lecture revalide l'entrée : seuls les messages ajoutés depuis sont lus,
+y compris ceux écrits par un autre worker (SERVER_MODE=prod). Un fichier
+remplacé ou tronqué est relu en entier. Les écritures d'une même session sont
+sérialisées par un verrou dans le processus, ce qui évite les fichiers
+déchirés lorsque deux requêtes écrivent la même session.
+"""
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "jsonl").lower()
+HISTORY_DIR = os.getenv("HISTORY_DIR", ".")
+HISTORY_CACHE_SESSIONS = int(os.getenv("HISTORY_CACHE_SESSIONS", "256"))
+HISTORY_FSYNC = os.getenv("HISTORY_FSYNC", "false").lower() in ("1", "true", "yes")
+
+
+def _safe_session_name(session_id: str) -> str:
+    safe = re.sub(r"[^A-Za-z0-9_-]", "_", session_id)
+    if safe != session_id:
+        # Éviter les collisions entre identifiants qui se ressemblent une fois nettoyés
+        safe += "-" + hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:8]
+    return safe
+
+
+class HistoryBackend:
+    """Interface commune des backends d'historique."""
+
+    def load(self, session_id: str) -> list:
+        raise NotImplementedError
+
+    def load_since(self, session_id: str, cursor=None) -> tuple:
+        """
+        Messages ajoutés après `cursor` (tous si None) et nouvelle position.
+        Retourne (None, None) si la position n'est plus valable : relire depuis le début.
+        Un curseur None en retour signifie que le backend ne sait pas lire par morceaux.
+        """
+        if cursor is not None:
+            return None, None
+        return self.load(session_id), None
+
+    def append(self, session_id: str, messages: list) -> None:
+        raise NotImplementedError
+
+
+class JsonlHistoryBackend(HistoryBackend):
+    def __init__(self, directory: str = HISTORY_DIR, fsync: bool = HISTORY_FSYNC):
+        self.directory = directory
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"history_{_safe_session_name(session_id)}.jsonl")
+
+    def _legacy_path(self, session_id: str) -> str:
+        # Ancien format : tout l'historique dans un seul tableau JSON
+        return os.path.join(self.directory, f"history_{session_id}.json")
+
+    def load(self, session_id: str) -> list:
+        return self.load_since(session_id)[0]
+
+    def load_since(self, session_id: str, cursor=None) -> tuple:
+        # Position : (inode, octets lus jusqu'à la dernière ligne complète)
+        path = self._path(session_id)
+        if cursor is None and not os.path.exists(path):
+            self._migrate_legacy(session_id)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return ([], None) if cursor is None else (None, None)
+        with f:
+            stat = os.fstat(f.fileno())
+            inode, offset = cursor or (stat.st_ino, 0)
+            if inode != stat.st_ino or stat.st_size < offset:
+                # Fichier remplacé ou tronqué depuis la dernière lecture
+                return None, None
+            f.seek(offset)
+            data = f.read()
+        # Ligne en cours d'écriture : lue au prochain passage, une fois complète
+        end = data.rfind(b"\n") + 1
+        messages = []
+        for line in data[:end].split(b"\n"):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                # Ligne tronquée par un arrêt brutal : on l'ignore
+                continue
+        return messages, (inode, offset + end)
+
+    def append(self, session_id: str, messages: list) -> None:
+        if not messages:
+            return
+        data = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8")
+        # Une seule écriture en O_APPEND : les lignes d'un tour arrivent d'un bloc
+        fd = os.open(self._path(session_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _migrate_legacy(self, session_id: str):
+        legacy = self._legacy_path(session_id)
+        if not os.path.exists(legacy):
+            return
+        try:
+            with open(legacy, "r", encoding="utf-8") as f:
+                messages = json.load(f)
+        except Exception:
+            return
+        path = self._path(session_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for m in messages:
+                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+
+
+class SqliteHistoryBackend(HistoryBackend):
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(HISTORY_DIR, "history.sqlite3")
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " session_id TEXT NOT NULL,"
+            " message TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # Une connexion par thread (sqlite3 refuse le partage entre threads par défaut)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, session_id: str) -> list:
+        return self.load_since(session_id)[0]
+
+    def load_since(self, session_id: str, cursor=None) -> tuple:
+        # Position : dernier id lu (ids croissants, table en ajout seul)
+        last_id = cursor or 0
+        rows = self._conn().execute(
+            "SELECT id, message FROM messages WHERE session_id = ? AND id > ? ORDER BY id",
+            (session_id, last_id),
+        ).fetchall()
+        if rows:
+            last_id = rows[-1][0]
+        return [json.loads(row[1]) for row in rows], last_id
+
+    def append(self, session_id: str, messages: list) -> None:
+        if not messages:
+            return
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+                [(session_id, json.dumps(m, ensure_ascii=False)) for m in messages],
+            )
+
+
+class HistoryStore:
+    """
+    Cache LRU des sessions chaudes et verrou par session, devant un backend.
+    Le cache est propre au processus : chaque lecture le complète avec ce que
+    les autres workers ont ajouté depuis (`load_since`).
+    """
+
+    def __init__(self, backend: HistoryBackend, max_cached_sessions: int = HISTORY_CACHE_SESSIONS):
+        self.backend = backend
+        self.max_cached_sessions = max_cached_sessions
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Verrous « rayés » : nombre fixe de verrous, une session tombe toujours sur le même
+        self._session_locks = [threading.RLock() for _ in range(64)]
+
+    def lock(self, session_id: str) -> threading.RLock:
+        return self._session_locks[hash(session_id) % len(self._session_locks)]
+
+    def _cached(self, session_id: str) -> Optional[tuple]:
+        with self._cache_lock:
+            entry = self._cache.get(session_id)
+            if entry is not None:
+                self._cache.move_to_end(session_id)
+            return entry
+
+    def _remember(self, session_id: str, cursor, messages: list):
+        with self._cache_lock:
+            self._cache[session_id] = (cursor, messages)
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.max_cached_sessions:
+                self._cache.popitem(last=False)
+
+    def load(self, session_id: str) -> list:
+        """Retourne une copie de l'historique de la session, à jour du stockage."""
+        with self.lock(session_id):
+            entry = self._cached(session_id)
+            if entry is not None and entry[0] is not None:
+                cursor, messages = entry
+                added, cursor = self.backend.load_since(session_id, cursor)
+                if added is not None:
+                    messages.extend(added)
+                    self._remember(session_id, cursor, messages)
+                    return list(messages)
+            messages, cursor = self.backend.load_since(session_id)
+            self._remember(session_id, cursor, messages)
+            return list(messages)
+
+    def append(self, session_id: str, messages: list) -> None:
+        # Le cache n'est pas complété ici : la prochaine lecture reprend à sa position
+        # et voit ces messages dans l'ordre du stockage, avec ceux des autres workers
+        with self.lock(session_id):
+            self.backend.append(session_id, messages)
+
+
+def create_backend(name: str = HISTORY_BACKEND) -> HistoryBackend:
+    if name == "sqlite":
+        return SqliteHistoryBackend()
+    if name == "jsonl":
+        return JsonlHistoryBackend()
+    raise ValueError(f"Backend d'historique inconnu: {name} (attendu: jsonl ou sqlite)")
+
+
+_store: Optional[HistoryStore] = None
+_store_lock = threading.Lock()
+
+
+def get_history_store() -> HistoryStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = HistoryStore(create_backend())
+    return _store
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Rapport du temps d'import d'un module (par défaut `mcp_server`).
+
+Lance un interpréteur neuf avec `python -X importtime`, puis affiche le temps
+total et les modules les plus coûteux (temps cumulé, sous-imports compris).
+
+    python import_profile.py                 # mcp_server, 25 modules
+    python import_profile.py agent_core 40
+"""
+import os
+import re
+import sys
+import subprocess
+
+
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile_imports(module: str) -> list:
+    """Retourne [(cumul_us, propre_us, profondeur, module)] pour l'import de `module`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=os.environ.copy(),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import de {module} impossible :\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((int(cumulative_us), int(self_us), len(indent) // 2, name))
+    return rows
+
+
+def report(module: str = "mcp_server", top: int = 25) -> str:
+    rows = profile_imports(module)
+    total = next((r[0] for r in rows if r[3] == module and r[2] == 0), max(r[0] for r in rows))
+    lines = [f"⏱️ Import de {module} : {total / 1e6:.2f}s", "", f"{'cumulé':>10} {'propre':>10}  module"]
+    # Premiers niveaux uniquement : un paquet lourd n'apparaît pas une fois par sous-module
+    candidates = [r for r in rows if r[2] <= 3 and r[3] != module]
+    for cumulative_us, self_us, depth, name in sorted(candidates, reverse=True)[:top]:
+        lines.append(f"{cumulative_us / 1000:>8.0f}ms {self_us / 1000:>8.0f}ms  {'  ' * depth}{name}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    module = sys.argv[1] if len(sys.argv) > 1 else "mcp_server"
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    print(report(module, top))
@@ -0,0 +1,340 @@
+# jobs.py
+"""
+File de travaux en arrière-plan pour la génération de documents et l'envoi d'emails.
+
+Avec JOBS_ENABLED=true, les outils BuildPDF, BuildWord, BuildExcelPro et
+send_mail ne s'exécutent plus dans l'étape de l'agent : ils enregistrent un
+travail et renvoient immédiatement son identifiant. Le client suit ensuite
+l'avancement via `GET /mcp/jobs/{id}`.
+
+  - rendu (PDF, Word, Excel) : pool de processus, JOB_RENDER_WORKERS en parallèle,
+    démarrés par forkserver (spawn à défaut) : le worker uvicorn a déjà des
+    threads, un fork hériterait de verrous tenus ;
+  - envoi (email) : worker asyncio dédié, JOB_SEND_CONCURRENCY envois simultanés.
+
+Un envoi qui joint un document attend la fin du travail de rendu de la même
+session qui le produit (ou de tous ceux en cours si le fichier ne peut pas
+être rattaché) ; si le rendu échoue, l'envoi échoue aussi.
+
+Les travaux sont persistés dans une base SQLite : ceux qui étaient en attente
+ou en cours lors d'un arrêt sont relancés au redémarrage, sauf les envois
+déjà tentés (l'email est peut-être parti) : ils passent en `needs_review`
+plutôt que de risquer un doublon.
+"""
+import os
+import json
+import time
+import uuid
+import importlib
+import asyncio
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from smolagents import Tool
+
+from tool_scheduler import attachment_stem, match_producers
+
+
+JOBS_ENABLED = os.getenv("JOBS_ENABLED", "false").lower() in ("1", "true", "yes")
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.sqlite3")
+JOB_RENDER_WORKERS = int(os.getenv("JOB_RENDER_WORKERS", "2"))
+JOB_SEND_CONCURRENCY = int(os.getenv("JOB_SEND_CONCURRENCY", "4"))
+# Avec plusieurs workers, un seul relance les travaux interrompus (positionné par start_server.py)
+JOBS_RESUME = os.getenv("JOBS_RESUME", "true").lower() in ("1", "true", "yes")
+# Attente maximale (s) des rendus dont dépend un envoi
+JOB_DEPENDENCY_TIMEOUT = float(os.getenv("JOB_DEPENDENCY_TIMEOUT", "600"))
+JOB_DEPENDENCY_POLL = 0.2
+
+RENDER_TOOLS = ("BuildPDF", "BuildWord", "BuildWordBatch", "BuildExcelPro")
+SEND_TOOLS = ("send_mail", "send_mail_batch")
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+# Envoi interrompu après avoir été tenté : à vérifier à la main avant de relancer
+NEEDS_REVIEW = "needs_review"
+
+
+# --- Exécution dans les processus de rendu ---
+_worker_tools = {}
+
+
+def _render_pool_context():
+    """Démarrage des processus de rendu sans fork du serveur (aucun verrou ni thread hérité)."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _init_render_worker():
+    # Processus neuf : modules réimportés, état du serveur (verrous, connexions SQLite,
+    # threads) absent. Le registre des artefacts appartient au processus serveur :
+    # il enregistre lui-même le résultat.
+    import artifacts
+    artifacts.disable_registration()
+    _worker_tools.clear()
+    # Outils importés une fois au démarrage du processus plutôt qu'au premier travail
+    importlib.import_module("tools")
+
+
+def _run_tool(tool_name: str, arguments: dict, session_id: Optional[str] = None,
+              tenant: Optional[str] = None) -> str:
+    """Exécute un outil (instancié une fois par processus) et retourne sa sortie texte."""
+    from artifacts import current_session_id, current_tenant
+
+    tool = _worker_tools.get(tool_name)
+    if tool is None:
+        import tools
+        classes = {
+            cls.name: cls
+            for cls in (tools.BuildPDF, tools.BuildWord, tools.BuildWordBatch, tools.BuildExcelPro,
+                        tools.SendMail, tools.SendMailBatch)
+        }
+        tool = _worker_tools[tool_name] = classes[tool_name]()
+    # Les fichiers sont écrits dans le répertoire de la session du travail,
+    # avec les modèles Word du tenant qui l'a demandé
+    token = current_session_id.set(session_id)
+    tenant_token = current_tenant.set(tenant)
+    try:
+        return str(tool(**arguments)).strip()
+    finally:
+        current_tenant.reset(tenant_token)
+        current_session_id.reset(token)
+
+
+class JobStore:
+    """Persistance SQLite des travaux (une connexion par thread)."""
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT NOT NULL, tool TEXT NOT NULL,"
+                " arguments TEXT NOT NULL, session_id TEXT, status TEXT NOT NULL,"
+                " result TEXT, file_path TEXT, error TEXT,"
+                " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+            # Colonnes ajoutées après la première version de la base
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "depends_on" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN depends_on TEXT")
+            if "send_attempted_at" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN send_attempted_at REAL")
+            if "tenant" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN tenant TEXT")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def insert(self, job: dict):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, tool, arguments, session_id, tenant, status, depends_on,"
+                " created_at, updated_at)"
+                " VALUES (:id, :kind, :tool, :arguments, :session_id, :tenant, :status, :depends_on,"
+                " :created_at, :updated_at)",
+                job,
+            )
+
+    def update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{k} = :{k}" for k in fields)
+        with self._conn() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = :id", {**fields, "id": job_id})
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def unfinished_renders(self, session_id: Optional[str]) -> list:
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE kind = 'render' AND session_id IS ? AND status IN (?, ?)",
+            (session_id, PENDING, RUNNING),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def unfinished(self) -> list:
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (PENDING, RUNNING)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+
+class JobManager:
+    def __init__(self, store: Optional[JobStore] = None,
+                 render_workers: int = JOB_RENDER_WORKERS, send_concurrency: int = JOB_SEND_CONCURRENCY):
+        self.store = store or JobStore()
+        self._render_pool = ProcessPoolExecutor(max_workers=render_workers, initializer=_init_render_worker,
+                                                mp_context=_render_pool_context())
+        self._send_concurrency = send_concurrency
+        # Boucle asyncio dédiée aux envois, dans son propre thread
+        self._loop = asyncio.new_event_loop()
+        self._send_semaphore = None
+        self._loop_thread = threading.Thread(target=self._run_loop, name="jobs-send-loop", daemon=True)
+        self._loop_thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._send_semaphore = asyncio.Semaphore(self._send_concurrency)
+        self._loop.run_forever()
+
+    def _dependencies(self, tool_name: str, arguments: dict, session_id: Optional[str]) -> list:
+        """Rendus en cours de la session dont l'envoi doit attendre la fin (pièce jointe)."""
+        stem = attachment_stem(tool_name, arguments)
+        if stem is None:
+            return []
+        producers = {job["id"]: (job["tool"], json.loads(job["arguments"]))
+                     for job in self.store.unfinished_renders(session_id)}
+        return sorted(match_producers(stem, producers)) if producers else []
+
+    def submit(self, tool_name: str, arguments: dict, session_id: Optional[str] = None,
+               tenant: Optional[str] = None) -> str:
+        kind = "render" if tool_name in RENDER_TOOLS else "send"
+        depends_on = self._dependencies(tool_name, arguments, session_id) if kind == "send" else []
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "tool": tool_name,
+            "arguments": json.dumps(arguments, ensure_ascii=False),
+            "session_id": session_id,
+            "tenant": tenant,
+            "status": PENDING,
+            "depends_on": json.dumps(depends_on) if depends_on else None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        self.store.insert(job)
+        self._dispatch(job)
+        return job["id"]
+
+    def _dispatch(self, job: dict):
+        arguments = json.loads(job["arguments"])
+        if job["kind"] == "render":
+            self.store.update(job["id"], status=RUNNING)
+            future = self._render_pool.submit(_run_tool, job["tool"], arguments, job["session_id"],
+                                              job["tenant"])
+            future.add_done_callback(lambda f, job=job: self._finish(job, f))
+        else:
+            asyncio.run_coroutine_threadsafe(self._send(job, arguments), self._loop)
+
+    async def _wait_dependencies(self, job: dict, arguments: dict) -> Optional[str]:
+        """Attend les rendus dont dépend l'envoi ; retourne un message d'erreur s'il ne peut pas partir."""
+        depends_on = json.loads(job.get("depends_on") or "[]")
+        deadline = time.monotonic() + JOB_DEPENDENCY_TIMEOUT
+        while True:
+            dependencies = [self.store.get(job_id) for job_id in depends_on]
+            failed = [d for d in dependencies if d is None or d["status"] in (FAILED, NEEDS_REVIEW)]
+            if failed:
+                return f"Pièce jointe non générée : travail {failed[0]['id'] if failed[0] else '?'} en échec"
+            if all(d["status"] == DONE for d in dependencies):
+                break
+            if time.monotonic() >= deadline:
+                return "Pièce jointe non générée : délai d'attente du rendu dépassé"
+            await asyncio.sleep(JOB_DEPENDENCY_POLL)
+        # Un seul rendu correspondant : joindre exactement le fichier qu'il a produit
+        if len(dependencies) == 1 and dependencies[0]["file_path"]:
+            arguments["attachment_path"] = dependencies[0]["file_path"]
+        return None
+
+    async def _send(self, job: dict, arguments: dict):
+        error = await self._wait_dependencies(job, arguments)
+        if error:
+            self.store.update(job["id"], status=FAILED, error=error)
+            return
+        async with self._send_semaphore:
+            # Marqueur posé avant l'appel à Brevo : un envoi tenté n'est jamais rejoué au redémarrage
+            self.store.update(job["id"], status=RUNNING, send_attempted_at=time.time())
+            future = self._loop.run_in_executor(None, _run_tool, job["tool"], arguments,
+                                                job["session_id"], job["tenant"])
+            try:
+                await future
+            finally:
+                self._finish(job, future)
+
+    def _finish(self, job: dict, future):
+        try:
+            output = future.result()
+        except Exception as e:
+            self.store.update(job["id"], status=FAILED, error=f"{type(e).__name__}: {e}")
+            return
+        # Les outils signalent leurs erreurs dans le texte de sortie
+        if output.startswith("Erreur"):
+            self.store.update(job["id"], status=FAILED, result=output, error=output)
+            return
+        file_path = None
+        if "||" in output:
+            output, file_path = (part.strip() for part in output.split("||", 1))
+            from artifacts import register_artifact
+            register_artifact(file_path, session_id=job["session_id"])
+        self.store.update(job["id"], status=DONE, result=output, file_path=file_path)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.store.get(job_id)
+
+    def resume_unfinished(self) -> int:
+        """Relance les travaux interrompus par un arrêt du serveur (sauf les envois déjà tentés)."""
+        resumed = 0
+        for job in self.store.unfinished():
+            if job["kind"] == "send" and job["send_attempted_at"] is not None:
+                self.store.update(job["id"], status=NEEDS_REVIEW,
+                                  error="Envoi interrompu par un arrêt du serveur : l'email est peut-être "
+                                        "déjà parti, vérifier avant de relancer.")
+                print(f"⚠️ Envoi {job['id']} interrompu : marqué « {NEEDS_REVIEW} » au lieu d'être relancé")
+                continue
+            self._dispatch(job)
+            resumed += 1
+        return resumed
+
+    def shutdown(self):
+        self._render_pool.shutdown(wait=True)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+_manager: Optional[JobManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = JobManager()
+                if JOBS_RESUME:
+                    resumed = _manager.resume_unfinished()
+                    if resumed:
+                        print(f"🔁 {resumed} travail(aux) en attente relancé(s)")
+    return _manager
+
+
+class BackgroundTool(Tool):
+    """Enveloppe un outil : même nom et mêmes entrées, mais l'appel crée un travail en arrière-plan."""
+
+    skip_forward_signature_validation = True
+    output_type = "string"
+
+    def __init__(self, tool: Tool):
+        self.name = tool.name
+        self.description = tool.description + " (exécution en arrière-plan : renvoie un identifiant de travail)"
+        self.inputs = tool.inputs
+        super().__init__()
+
+    def forward(self, **kwargs):
+        from artifacts import current_session_id, current_tenant
+        arguments = {k: v for k, v in kwargs.items() if v is not None}
+        job_id = get_job_manager().submit(self.name, arguments, session_id=current_session_id.get(),
+                                          tenant=current_tenant.get())
+        return (
+            f"Travail {job_id} lancé en arrière-plan pour {self.name}. "
+            f"Suivi et fichier résultat : /mcp/jobs/{job_id}"
+        )
@@ -0,0 +1,102 @@
+# mail_client.py
+"""
+Client Brevo (Sendinblue) partagé par tout le processus.
+
+Un seul `ApiClient` est créé par clé API : son pool de connexions urllib3
+garde les connexions HTTPS ouvertes (keep-alive) d'un email à l'autre, au lieu
+de refaire la poignée de main TLS à chaque envoi. Le nombre d'envois
+simultanés est borné par BREVO_MAX_CONCURRENCY.
+"""
+import os
+import base64
+import threading
+from typing import Optional
+
+
+BREVO_MAX_CONCURRENCY = int(os.getenv("BREVO_MAX_CONCURRENCY", "8"))
+# Taille maximale d'une pièce jointe (avant encodage base64)
+BREVO_MAX_ATTACHMENT_BYTES = int(os.getenv("BREVO_MAX_ATTACHMENT_BYTES", str(10 * 1024 * 1024)))
+# Nombre maximal de destinataires par appel « messageVersions »
+BREVO_BATCH_SIZE = 1000
+
+# Multiple de 3 : chaque bloc s'encode en base64 sans remplissage intermédiaire
+_ATTACHMENT_CHUNK_BYTES = 3 * 64 * 1024
+
+
+class AttachmentTooLarge(ValueError):
+    pass
+
+
+class BrevoClient:
+    def __init__(self, api_key: str, max_concurrency: int = BREVO_MAX_CONCURRENCY):
+        import sib_api_v3_sdk
+
+        configuration = sib_api_v3_sdk.Configuration()
+        configuration.api_key['api-key'] = api_key
+        # Autant de connexions gardées ouvertes que d'envois simultanés autorisés
+        configuration.connection_pool_maxsize = max_concurrency
+        self.api = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def send(self, email_data: dict):
+        with self._slots:
+            return self.api.send_transac_email(email_data)
+
+
+_clients: dict = {}
+_clients_lock = threading.Lock()
+
+
+def get_brevo_client(api_key: str) -> BrevoClient:
+    client = _clients.get(api_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(api_key)
+            if client is None:
+                client = _clients[api_key] = BrevoClient(api_key)
+    return client
+
+
+def encode_attachment(path: str, max_bytes: int = BREVO_MAX_ATTACHMENT_BYTES) -> dict:
+    """Encode un fichier en base64 par blocs, après vérification de sa taille."""
+    size = os.path.getsize(path)
+    if size > max_bytes:
+        raise AttachmentTooLarge(
+            f"pièce jointe trop volumineuse ({size // 1024} Ko, maximum {max_bytes // 1024} Ko)"
+        )
+    parts = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(_ATTACHMENT_CHUNK_BYTES)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk).decode())
+    return {"content": "".join(parts), "name": os.path.basename(path)}
+
+
+def batch_email_data(sender: dict, recipients: list, subject: str, html_template: str,
+                     attachment: Optional[dict] = None) -> list:
+    """
+    Découpe un envoi groupé en appels Brevo de BREVO_BATCH_SIZE destinataires,
+    chacun avec ses `params` (sujet et contenu personnalisés via messageVersions).
+    """
+    payloads = []
+    for start in range(0, len(recipients), BREVO_BATCH_SIZE):
+        chunk = recipients[start:start + BREVO_BATCH_SIZE]
+        payload = {
+            "sender": sender,
+            "subject": subject,
+            "htmlContent": html_template,
+            "messageVersions": [
+                {
+                    "to": [{"email": r["email"]}],
+                    "params": r.get("params", {}),
+                    **({"subject": r["subject"]} if r.get("subject") else {}),
+                }
+                for r in chunk
+            ],
+        }
+        if attachment:
+            payload["attachment"] = [attachment]
+        payloads.append(payload)
+    return payloads
@@ -1,10 +1,24 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import HTTPException
-from fastapi.responses import FileResponse
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, Response
 from pydantic import BaseModel
-from agent_core import create_agent, chat_with_agent
+from fastapi.concurrency import run_in_threadpool
+from agent_core import warm_up, chat_with_agent, chat_with_agent_async, stream_chat_with_agent, response_cache
+from agent_pool import AgentPoolTimeout
+from admission import AdmissionRejected, get_admission
+from artifacts import current_tenant, get_registry, start_sweeper
+from jobs import JOBS_ENABLED, get_job_manager
+from tracing import get_tracer
+from document_cache import get_document_cache
+from metrics import METRICS_ENABLED, REQUEST_SECONDS, stage, render_metrics, start_snapshots, write_snapshot
 from urllib.parse import quote
+from contextlib import asynccontextmanager
+from typing import Optional
+import hmac
+import json
+import time
+import threading
 
 # Charger les variables d'environnement depuis le fichier .env (si présent)
 from dotenv import load_dotenv
@@ -38,35 +52,84 @@ app.add_middleware(
     allow_credentials=allow_credentials,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition", "Content-Type"],  # Important pour download
+    # Important pour download (reprise par Range, revalidation par ETag)
+    expose_headers=["Content-Disposition", "Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "ETag"],
 )
 
 
-agent = None
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    if not METRICS_ENABLED:
+        return await call_next(request)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Gabarit de la route (/mcp/download/{filename}) plutôt que le chemin : cardinalité bornée
+        route = request.scope.get("route")
+        path = getattr(route, "path", "inconnue")
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, path, status)
 
-def get_agent():
-    global agent
-    if agent is None:
-        print("⚙️ Initialisation de l'agent IA...")
-        agent = create_agent()
-    return agent
 
 # Initialiser l'état de disponibilité de l'agent
 agent_ready = False
+agent_warming = False
 
-@app.on_event("startup")
-def startup_event():
-    """Crée l'agent au démarrage de l'application et définit `agent_ready`."""
-    global agent, agent_ready
+# Avec AGENT_WARMUP=background, le worker accepte les requêtes pendant que l'agent
+# (et litellm, long à importer) se prépare dans un thread ; /health le signale.
+AGENT_WARMUP = os.getenv("AGENT_WARMUP", "background").lower()
+
+
+def _warm_up_agent():
+    global agent_ready, agent_warming
+    started = time.perf_counter()
     try:
-        print("⚙️ Initialisation de l'agent IA lors du démarrage...")
-        agent = create_agent()
+        print(f"⚙️ Initialisation de l'agent IA (worker {os.getpid()})...")
+        warm_up(async_mode=AGENT_EXECUTION_MODE == "async")
         agent_ready = True
-        print("✅ Agent initialisé avec succès")
+        print(f"✅ Agent initialisé avec succès en {time.perf_counter() - started:.1f}s")
     except Exception as e:
-        agent = None
         agent_ready = False
         print(f"⚠️ Erreur lors de l'initialisation de l'agent: {e}")
+    finally:
+        agent_warming = False
+
+
+@app.on_event("startup")
+def startup_event():
+    """Prépare l'agent du worker (pool ou runner asynchrone) et définit `agent_ready`."""
+    global agent_warming
+    agent_warming = True
+    if AGENT_WARMUP == "background":
+        threading.Thread(target=_warm_up_agent, name="agent-warmup", daemon=True).start()
+    else:
+        _warm_up_agent()
+    if JOBS_ENABLED:
+        # Relance les travaux restés en attente lors du dernier arrêt
+        get_job_manager()
+    # Un seul worker nettoie le stockage des artefacts
+    if os.getenv("SERVER_WORKER_INDEX", "0") == "0":
+        start_sweeper()
+    # Plusieurs workers : instantanés des métriques fusionnés par /metrics
+    start_snapshots()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    # Les requêtes en cours ont été drainées par uvicorn ; /health signale l'arrêt
+    global agent_ready
+    agent_ready = False
+    if JOBS_ENABLED:
+        get_job_manager().shutdown()
+    # Exporter les traces encore en file avant la fin du processus
+    get_tracer().flush()
+    try:
+        write_snapshot()
+    except Exception as e:
+        print(f"⚠️ Instantané des métriques impossible: {e}")
 
 # Endpoint racine pour vérifier que le serveur fonctionne
 @app.get("/")
@@ -80,10 +143,28 @@ def root():
 # Endpoint de santé pour la vérification de connexion
 @app.get("/health")
 def health():
-    return {
-        "status": "healthy" if agent_ready else "unhealthy",
+    status = {
+        "status": "healthy" if agent_ready else ("starting" if agent_warming else "unhealthy"),
         "agent_ready": agent_ready
     }
+    if response_cache is not None:
+        # Taux de succès du cache de réponses (hits / consultations)
+        status["response_cache"] = response_cache.stats()
+    document_cache = get_document_cache()
+    if document_cache is not None:
+        status["document_cache"] = document_cache.stats()
+    admission = get_admission()
+    if admission is not None:
+        status["admission"] = admission.stats()
+    status["artifacts"] = get_registry().stats()
+    return status
+
+# Mode d'exécution de /mcp/chat :
+# - "sync"  : l'agent smolagents tourne sur le threadpool de FastAPI (un thread par conversation)
+# - "async" : boucle asynchrone (litellm.acompletion), un worker garde des centaines de conversations en vol
+AGENT_EXECUTION_MODE = os.getenv("AGENT_EXECUTION_MODE", "sync").lower()
+print(f"🧠 Mode d'exécution de l'agent: {AGENT_EXECUTION_MODE}")
+
 
 class MCPRequest(BaseModel):
     session_id: str
@@ -93,16 +174,86 @@ class MCPResponse(BaseModel):
     answer: str
 
 
-def _find_file_by_basename(basename: str):
-    for root, dirs, files in os.walk(os.getcwd()):
-        if basename in files:
-            return os.path.join(root, basename)
-    return None
-    
+def _find_artifact(file_path: str, session_id: Optional[str]):
+    # Recherche dans le registre des artefacts, limitée aux fichiers de la session
+    with stage("file_lookup"):
+        registry = get_registry()
+        found = registry.resolve_path(file_path)
+        if found is not None:
+            return found if found["session_id"] == session_id else None
+        return registry.resolve(os.path.basename(file_path), session_id)
+
+
+def _file_fields(file_path: str, session_id: Optional[str]) -> dict:
+    found = _find_artifact(file_path, session_id)
+    if not found:
+        # si le fichier n'a pas été trouvé (chemin absolu, etc.), renvoyer le chemin brut
+        return {"file_path": file_path}
+    # renvoyer une URL relative que le frontend peut concaténer avec le host
+    return {
+        "file_url": f"/mcp/download/{found['id']}/{quote(found['name'])}",
+        "file_name": found["name"],
+    }
+
+
+def _build_response(resp: dict, session_id: str) -> dict:
+    response = {"answer": resp.get("content")}
+    file_path = resp.get("file_path")
+    if file_path:
+        response.update(_file_fields(file_path, session_id))
+    return response
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@asynccontextmanager
+async def _admitted(session_id: str, request: Request):
+    """Place d'admission pour un tour de conversation ; refus -> 429/503 avec Retry-After."""
+    admission = get_admission()
+    if admission is None:
+        yield
+        return
+    client = request.client.host if request.client else None
+    try:
+        async with admission.admit(session_id, client):
+            yield
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """Réponse SSE qui garde sa place d'admission jusqu'à la fin de l'envoi, déconnexion comprise."""
+
+    def __init__(self, content, admitted, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admitted = admitted
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.admitted.__aexit__(None, None, None)
+
+
 @app.post("/mcp/chat")
-def chat(req: MCPRequest):
+async def chat(req: MCPRequest, request: Request):
+    # Modèles Word accessibles pendant le tour : ceux du tenant de la clé d'API
+    token = current_tenant.set(_request_tenant(request))
+    try:
+        async with _admitted(req.session_id, request):
+            return await _chat(req)
+    finally:
+        current_tenant.reset(token)
+
+
+async def _chat(req: MCPRequest):
     try:
-        resp = chat_with_agent(req.session_id, req.message)
+        if AGENT_EXECUTION_MODE == "async":
+            resp = await chat_with_agent_async(req.session_id, req.message)
+        else:
+            resp = await run_in_threadpool(chat_with_agent, req.session_id, req.message)
 
         # Normaliser la réponse au format attendu (dict avec 'content' et éventuellement 'file_path')
         if isinstance(resp, str):
@@ -117,19 +268,10 @@ def chat(req: MCPRequest):
         # Log utile pour debug (type et contenu limités)
         print(f"/mcp/chat: response type={type(resp).__name__}, keys={list(resp.keys())}")
 
-        response = {"answer": resp.get("content")}
-        file_path = resp.get("file_path")
-        if file_path:
-            basename = os.path.basename(file_path)
-            found = _find_file_by_basename(basename)
-            if found:
-                # renvoyer une URL relative que le frontend peut concaténer avec le host
-                response["file_url"] = f"/mcp/download/{quote(basename)}"
-                response["file_name"] = basename
-            else:
-                # si le fichier n'a pas été trouvé (chemin absolu, etc.), renvoyer le chemin brut
-                response["file_path"] = file_path
-        return response
+        return _build_response(resp, req.session_id)
+    except AgentPoolTimeout as e:
+        # Tous les agents du pool sont occupés : inutile de faire patienter davantage
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         # Afficher la trace d'erreur côté serveur pour diagnostic
         import traceback
@@ -137,15 +279,184 @@ def chat(req: MCPRequest):
         return {"answer": f"Erreur agent: {str(e)}"}
 
 
+@app.post("/mcp/chat/stream")
+async def chat_stream(req: MCPRequest, request: Request):
+    """
+    Même requête que /mcp/chat, réponse en Server-Sent Events :
+    step, tool_call, tool_result, delta puis final (réponse + URL du fichier) ou error.
+    """
+    # Le refus (429/503) doit partir avant le début du flux : admission dans le handler
+    admitted = _admitted(req.session_id, request)
+    # Fixé dans la tâche de la requête : le flux, lu depuis des threads, en hérite
+    current_tenant.set(_request_tenant(request))
+    await admitted.__aenter__()
+
+    def events():
+        try:
+            for event in stream_chat_with_agent(req.session_id, req.message):
+                if event["event"] == "final":
+                    yield _sse("final", _build_response(event["data"], req.session_id))
+                else:
+                    yield _sse(event["event"], event["data"])
+        except AgentPoolTimeout as e:
+            yield _sse("error", {"status": 503, "detail": str(e)})
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield _sse("error", {"status": 500, "detail": f"Erreur agent: {str(e)}"})
+
+    return AdmittedStreamingResponse(
+        events(),
+        admitted,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+def metrics():
+    # Format texte Prometheus (version 0.0.4)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/mcp/jobs/{job_id}")
+def job_status(job_id: str):
+    if not JOBS_ENABLED:
+        raise HTTPException(status_code=404, detail="File de travaux désactivée")
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Travail introuvable")
+    response = {
+        "id": job["id"],
+        "tool": job["tool"],
+        "status": job["status"],
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+    if job["file_path"]:
+        response.update(_file_fields(job["file_path"], job["session_id"]))
+    return response
+
+
+# Clés d'API des tenants : "tenant1:clé1,tenant2:clé2" (vide : modèles des tenants désactivés)
+TENANT_API_KEYS = [
+    (key.strip(), tenant.strip())
+    for tenant, _, key in (item.partition(":") for item in os.getenv("TENANT_API_KEYS", "").split(","))
+    if tenant.strip() and key.strip()
+]
+
+
+def _request_tenant(request: Request) -> Optional[str]:
+    """Tenant de la clé d'API de la requête (`Authorization: Bearer <clé>`), None sans clé valide."""
+    scheme, _, key = request.headers.get("authorization", "").partition(" ")
+    key = key.strip()
+    if scheme.lower() != "bearer" or not key:
+        return None
+    tenant = None
+    # Toutes les clés sont comparées, en temps constant
+    for known, known_tenant in TENANT_API_KEYS:
+        if hmac.compare_digest(known.encode(), key.encode()):
+            tenant = known_tenant
+    return tenant
+
+
+def _require_tenant(request: Request, tenant: str):
+    caller = _request_tenant(request)
+    if caller is None:
+        raise HTTPException(status_code=401, detail="Clé d'API requise",
+                            headers={"WWW-Authenticate": "Bearer"})
+    if caller != tenant:
+        raise HTTPException(status_code=403, detail="Accès refusé aux modèles de ce tenant")
+
+
+async def _read_body(request: Request, limit: int) -> bytes:
+    # Content-Length annoncé trop grand : refus sans rien lire ; sinon lecture plafonnée
+    try:
+        declared = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Content-Length invalide")
+    too_large = HTTPException(status_code=413, detail=f"Fichier trop volumineux (maximum {limit} octets)")
+    if declared > limit:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+@app.put("/mcp/templates/{tenant}/{name}")
+async def upload_word_template(tenant: str, name: str, request: Request):
+    # Corps de la requête : le fichier .docx brut, avec ses champs {{...}}
+    from word_templates import WORD_TEMPLATE_MAX_BYTES, register_word_template, TemplateNotFound
+
+    _require_tenant(request, tenant)
+    data = await _read_body(request, WORD_TEMPLATE_MAX_BYTES)
+    try:
+        reference = await run_in_threadpool(register_word_template, tenant, name, data)
+    except (ValueError, TemplateNotFound) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"template": reference}
+
+
+@app.get("/mcp/templates/{tenant}")
+def tenant_word_templates(tenant: str, request: Request):
+    from word_templates import list_word_templates
+
+    _require_tenant(request, tenant)
+    return {"templates": list_word_templates(tenant)}
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Comparaison faible (RFC 9110) : W/"x" et "x" désignent la même version
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _artifact_response(record: dict, request: Request, immutable: bool) -> Response:
+    """Téléchargement avec revalidation (ETag / If-None-Match -> 304) et reprise (Range -> 206)."""
+    try:
+        stat = os.stat(record["path"])
+    except OSError:
+        raise HTTPException(status_code=404, detail="Fichier introuvable")
+    etag = f'"{record["id"]}-{stat.st_size}-{stat.st_mtime_ns}"'
+    headers = {
+        "ETag": etag,
+        # Une URL par id désigne toujours le même contenu ; un simple nom peut être réutilisé
+        "Cache-Control": "private, max-age=31536000, immutable" if immutable else "private, no-cache",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    # FileResponse gère Range / If-Range (206, 416) avec l'ETag ci-dessus
+    return FileResponse(path=record["path"], filename=record["name"], media_type=record["mime_type"],
+                        headers=headers, stat_result=stat)
+
+
+@app.get("/mcp/download/{artifact_id}/{filename}")
+def download_artifact(artifact_id: str, filename: str, request: Request):
+    # Le nom n'est là que pour l'URL : seul l'id (aléatoire, 128 bits) désigne le fichier
+    found = get_registry().get(artifact_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Fichier introuvable")
+    return _artifact_response(found, request, immutable=True)
+
+
 @app.get("/mcp/download/{filename}")
-def download_file(filename: str):
-    # Sécuriser contre path traversal et rechercher le fichier dans l'espace de travail
-    if os.path.sep in filename or filename.startswith(".."):
-        raise HTTPException(status_code=400, detail="Invalid filename")
-    found = _find_file_by_basename(filename)
+def download_file(filename: str, request: Request, session_id: Optional[str] = None):
+    # Anciennes URL par nom de fichier : un même nom existe dans plusieurs sessions,
+    # la recherche n'a de sens qu'à l'intérieur de la session indiquée
+    if session_id is None:
+        raise HTTPException(status_code=410, detail="URL obsolète : utilisez /mcp/download/{id}/{nom}")
+    found = get_registry().resolve(filename, session_id)
     if not found:
         raise HTTPException(status_code=404, detail="Fichier introuvable")
-    return FileResponse(path=found, filename=filename, media_type='application/octet-stream')
+    return _artifact_response(found, request, immutable=False)
 
 
 
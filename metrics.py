@@ -0,0 +1,365 @@
+# metrics.py
+"""
+Métriques du chemin critique, exposées au format texte Prometheus sur `/metrics`.
+
+Implémentation minimale, sans dépendance : compteurs et histogrammes à
+buckets fixes, une recherche dichotomique et un verrou par observation.
+Le coût (quelques microsecondes) permet de les laisser actives en production.
+
+Les valeurs sont tenues par chaque processus et chaque série porte le label
+`worker` (numéro du worker, sinon pid). Avec plusieurs workers, `/metrics`
+n'est servi que par l'un d'eux : si METRICS_MULTIPROC_DIR est défini (le
+maître de `start_server` le crée), chaque worker y écrit un instantané de ses
+séries toutes les METRICS_SNAPSHOT_INTERVAL secondes et `/metrics` fusionne
+ces instantanés avec ses propres valeurs. Toutes les séries de tous les
+workers apparaissent alors à chaque collecte, quel que soit le worker qui
+répond. Un worker relancé reprend son numéro et repart de zéro, ce que
+Prometheus traite comme une remise à zéro de compteur.
+"""
+import os
+import copy
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Répertoire partagé des instantanés des workers (vide : valeurs du seul processus qui répond)
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", "5"))
+
+# Secondes : de la milliseconde (lecture d'historique) à la minute (run complet de l'agent)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STEP_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+TOKEN_BUCKETS = (0, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _worker() -> str:
+    # Numéro stable d'un worker de `start_server` (séries bornées malgré les redémarrages), sinon pid
+    return os.environ.get("SERVER_WORKER_INDEX") or str(os.getpid())
+
+
+def _format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = ("worker",) + tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series: dict = {}
+
+    def _key(self, labels: tuple) -> tuple:
+        return (_worker(),) + tuple(str(v) for v in labels)
+
+    def snapshot(self) -> list:
+        """Séries du processus, sérialisables en JSON : [[clé, valeur], ...]."""
+        with self._lock:
+            return [[list(key), copy.deepcopy(value)] for key, value in self._series.items()]
+
+    def render(self, others: tuple = ()) -> list:
+        """Séries du processus, suivies de celles des instantanés des autres workers."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = list(self._series.items())
+        for snapshot in others:
+            series.extend((tuple(key), value) for key, value in snapshot.get(self.name, ()))
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        """Valeur courante pour ce processus."""
+        with self._lock:
+            return self._series.get(self._key(labels), 0.0)
+
+    def _render_series(self, key, value) -> list:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [compteurs par bucket (+Inf en dernier), somme, nombre]
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def _render_series(self, key, value) -> list:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# --- Métriques de l'application ---
+STAGE_SECONDS = Histogram(
+    "agent_stage_duration_seconds",
+    "Durée des étapes du traitement d'un message",
+    ("stage",),
+)
+LLM_CALL_SECONDS = Histogram(
+    "agent_llm_call_duration_seconds",
+    "Durée d'un appel au LLM",
+    ("mode",),
+)
+TOOL_SECONDS = Histogram(
+    "agent_tool_forward_duration_seconds",
+    "Durée d'exécution du forward d'un outil",
+    ("tool",),
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Durée totale des requêtes HTTP",
+    ("method", "path", "status"),
+)
+STEPS_PER_RUN = Histogram(
+    "agent_steps_per_run",
+    "Nombre d'étapes par exécution de l'agent",
+    (),
+    buckets=STEP_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "agent_llm_tokens_total",
+    "Tokens consommés par les appels au LLM",
+    ("direction",),
+)
+TOOL_ERRORS = Counter(
+    "agent_tool_errors_total",
+    "Appels d'outil terminés en erreur (exception ou message d'erreur)",
+    ("tool",),
+)
+MEMORY_TOKENS_SAVED = Histogram(
+    "agent_memory_tokens_saved_per_run",
+    "Tokens d'entrée économisés par run grâce à la compaction de la mémoire de l'agent",
+    ("mode",),
+    buckets=TOKEN_BUCKETS,
+)
+TRACES_DROPPED = Counter(
+    "tracing_traces_dropped_total",
+    "Traces abandonnées (file d'export pleine)",
+)
+TRACE_EXPORT_ERRORS = Counter(
+    "tracing_export_errors_total",
+    "Lots de traces dont l'export a échoué",
+)
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total",
+    "Requêtes de conversation refusées par le contrôle d'admission",
+    ("reason",),
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "admission_wait_seconds",
+    "Attente avant admission (tour précédent de la session, puis place libre)",
+)
+DOCUMENT_CACHE_REQUESTS = Counter(
+    "document_cache_requests_total",
+    "Consultations du cache de documents générés (hit : aucun rendu)",
+    ("format", "result"),
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    "response_cache_requests_total",
+    "Consultations du cache de réponses (tours sans contexte ni outil)",
+    ("result",),
+)
+SEARCH_REQUESTS = Counter(
+    "web_search_requests_total",
+    "Recherches web : servies par le cache, regroupées avec une recherche en cours, ou lancées",
+    ("result",),
+)
+
+REGISTRY = (
+    STAGE_SECONDS, LLM_CALL_SECONDS, TOOL_SECONDS, REQUEST_SECONDS,
+    STEPS_PER_RUN, LLM_TOKENS, TOOL_ERRORS, MEMORY_TOKENS_SAVED, TRACES_DROPPED, TRACE_EXPORT_ERRORS,
+    ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS, DOCUMENT_CACHE_REQUESTS, RESPONSE_CACHE_REQUESTS, SEARCH_REQUESTS,
+)
+
+
+def stage(name: str):
+    """`with stage("history_load"): ...` mesure une étape du traitement."""
+    return STAGE_SECONDS.time(name)
+
+
+def record_tokens(input_tokens: Optional[int], output_tokens: Optional[int]):
+    if input_tokens:
+        LLM_TOKENS.inc("input", amount=input_tokens)
+    if output_tokens:
+        LLM_TOKENS.inc("output", amount=output_tokens)
+
+
+def instrument_model(model):
+    """Mesure les appels `generate` / `generate_stream` d'un modèle smolagents (durée, tokens)."""
+    generate = model.generate
+    generate_stream = getattr(model, "generate_stream", None)
+
+    def timed_generate(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            message = generate(*args, **kwargs)
+        finally:
+            LLM_CALL_SECONDS.observe(time.perf_counter() - started, "generate")
+        usage = getattr(message, "token_usage", None)
+        if usage is not None:
+            record_tokens(usage.input_tokens, usage.output_tokens)
+        return message
+
+    def timed_generate_stream(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            for delta in generate_stream(*args, **kwargs):
+                usage = getattr(delta, "token_usage", None)
+                if usage is not None:
+                    record_tokens(usage.input_tokens, usage.output_tokens)
+                yield delta
+        finally:
+            LLM_CALL_SECONDS.observe(time.perf_counter() - started, "stream")
+
+    model.generate = timed_generate
+    if generate_stream is not None:
+        model.generate_stream = timed_generate_stream
+    return model
+
+
+def instrument_tool(tool):
+    """Mesure le `forward` d'un outil et compte ses erreurs (les outils renvoient « Erreur … »)."""
+    forward = tool.forward
+    name = tool.name
+
+    def timed_forward(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            output = forward(*args, **kwargs)
+        except Exception:
+            TOOL_ERRORS.inc(name)
+            raise
+        finally:
+            TOOL_SECONDS.observe(time.perf_counter() - started, name)
+        if isinstance(output, str) and output.startswith("Erreur"):
+            TOOL_ERRORS.inc(name)
+        return output
+
+    tool.forward = timed_forward
+    return tool
+
+
+# --- Instantanés partagés entre workers ---
+_snapshot_thread: Optional[threading.Thread] = None
+_snapshot_lock = threading.Lock()
+
+
+def _snapshot_path(worker: str) -> str:
+    return os.path.join(METRICS_MULTIPROC_DIR, f"worker-{worker}.json")
+
+
+def write_snapshot():
+    """Écrit les séries du processus dans METRICS_MULTIPROC_DIR (remplacement atomique)."""
+    if not METRICS_MULTIPROC_DIR:
+        return
+    path = _snapshot_path(_worker())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({metric.name: metric.snapshot() for metric in REGISTRY}, f)
+    os.replace(tmp_path, path)
+
+
+def _read_snapshots() -> list:
+    """Instantanés des autres workers."""
+    own = os.path.basename(_snapshot_path(_worker()))
+    snapshots = []
+    try:
+        names = os.listdir(METRICS_MULTIPROC_DIR)
+    except FileNotFoundError:
+        return snapshots
+    for name in sorted(names):
+        if name == own or not (name.startswith("worker-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(METRICS_MULTIPROC_DIR, name), "r", encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            # Worker arrêté entre-temps ou fichier illisible : ignoré pour cette collecte
+            continue
+    return snapshots
+
+
+def _snapshot_forever(interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot()
+        except Exception as e:
+            print(f"⚠️ Instantané des métriques impossible: {e}")
+
+
+def start_snapshots(interval: float = METRICS_SNAPSHOT_INTERVAL):
+    """Lance l'écriture périodique des instantanés (un seul thread par processus)."""
+    global _snapshot_thread
+    with _snapshot_lock:
+        if _snapshot_thread is not None or not METRICS_ENABLED or not METRICS_MULTIPROC_DIR or interval <= 0:
+            return
+        os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+        write_snapshot()
+        _snapshot_thread = threading.Thread(target=_snapshot_forever, args=(interval,),
+                                            name="metrics-snapshot", daemon=True)
+        _snapshot_thread.start()
+
+
+def render_metrics() -> str:
+    others = tuple(_read_snapshots()) if METRICS_MULTIPROC_DIR else ()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render(others))
+    return "\n".join(lines) + "\n"
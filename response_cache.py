@@ -0,0 +1,138 @@
+# response_cache.py
+"""
+Cache des réponses de l'agent pour les tours déterministes (opt-in).
+
+Deux niveaux :
+  - exact : message normalisé (casse, accents, ponctuation, espaces) + hash des
+    instructions de l'agent ;
+  - sémantique (optionnel) : similarité cosinus entre embeddings locaux
+    (sentence-transformers), au-dessus d'un seuil configurable.
+
+Entrées bornées en nombre (LRU) et en durée (TTL). Seuls les tours sans appel
+d'outil et sans contexte de conversation sont mis en cache : une réponse qui a
+généré un fichier ou envoyé un email ne doit jamais être rejouée.
+"""
+import os
+import re
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import RESPONSE_CACHE_REQUESTS
+
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "")
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))
+
+
+def normalize_message(message: str) -> str:
+    text = unicodedata.normalize("NFKD", message.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def _load_embedder(model_name: str):
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        print("⚠️ sentence-transformers n'est pas installé : cache sémantique désactivé")
+        return None
+    model = SentenceTransformer(model_name)
+    return lambda text: model.encode(text, normalize_embeddings=True).tolist()
+
+
+class ResponseCache:
+    def __init__(self, instructions: str = "", ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 embed=None, similarity_threshold: float = RESPONSE_CACHE_SIMILARITY):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self._instructions_hash = hashlib.sha256(instructions.encode("utf-8")).hexdigest()[:16]
+        # clé -> {"output", "expires_at", "vector"}
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _key(self, message: str) -> str:
+        return f"{self._instructions_hash}:{normalize_message(message)}"
+
+    def _evict_expired(self, now: float):
+        expired = [k for k, e in self._entries.items() if e["expires_at"] <= now]
+        for k in expired:
+            del self._entries[k]
+
+    def get(self, message: str) -> Optional[str]:
+        key = self._key(message)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                RESPONSE_CACHE_REQUESTS.inc("hit")
+                return entry["output"]
+
+        if self.embed is not None:
+            vector = self.embed(normalize_message(message))
+            with self._lock:
+                self._evict_expired(now)
+                best_key, best_score = None, self.similarity_threshold
+                for k, e in self._entries.items():
+                    if e["vector"] is None:
+                        continue
+                    score = sum(a * b for a, b in zip(vector, e["vector"]))
+                    if score >= best_score:
+                        best_key, best_score = k, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    RESPONSE_CACHE_REQUESTS.inc("hit")
+                    return self._entries[best_key]["output"]
+
+        with self._lock:
+            self.misses += 1
+        RESPONSE_CACHE_REQUESTS.inc("miss")
+        return None
+
+    def put(self, message: str, output: str):
+        vector = self.embed(normalize_message(message)) if self.embed is not None else None
+        with self._lock:
+            self._entries[self._key(message)] = {
+                "output": output,
+                "expires_at": time.time() + self.ttl,
+                "vector": vector,
+            }
+            self._entries.move_to_end(self._key(message))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def create_response_cache(instructions: str) -> Optional[ResponseCache]:
+    """Retourne le cache configuré par l'environnement, ou None s'il est désactivé."""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    embed = _load_embedder(RESPONSE_CACHE_EMBEDDING_MODEL) if RESPONSE_CACHE_EMBEDDING_MODEL else None
+    return ResponseCache(instructions=instructions, embed=embed)
@@ -0,0 +1,83 @@
+# router.py
+"""
+Routage des messages avant l'agent.
+
+La plupart des messages sont des questions simples : ils partent vers une
+seule complétion du LLM, sans schéma d'outil dans le prompt. Seuls les
+messages qui expriment une intention de génération de fichier ou d'envoi
+d'email passent par le `ToolCallingAgent`, avec uniquement les outils utiles.
+
+Les demandes de recherche (« cherche sur internet… », « actualités… »)
+passent aussi par l'agent, avec l'outil `web_search`.
+
+Une demande de fichier peut s'étaler sur deux tours : l'agent pose une
+question de clarification, l'utilisateur répond « oui, vas-y » ou précise sa
+demande sans répéter les mots-clés. Si le tour précédent demandait un fichier
+et n'en a produit aucun, la demande est considérée comme toujours en cours et
+la réponse repart vers l'agent, avec les outils des deux messages.
+"""
+import os
+from typing import Optional
+
+
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+
+KEYWORDS_FILES = [
+    "génère", "genere", "crée", "cree", "produis", "exporte",
+    "fichier", "pdf", "word", "docx", "excel", "xlsx", "envoie", "envoyer", "mail"
+]
+
+KEYWORDS_SEARCH = [
+    "cherche", "internet", "sur le web", "en ligne", "actualité", "dernières nouvelles", "récent",
+]
+
+# Mots-clés qui désignent un outil précis
+TOOL_KEYWORDS = {
+    "BuildPDF": ["pdf"],
+    "BuildWord": ["word", "docx", "lettre", "cv", "courrier"],
+    "BuildWordBatch": ["publipostage", "lettres", "courriers"],
+    "BuildExcelPro": ["excel", "xlsx", "tableur", "feuille de calcul"],
+    "send_mail": ["mail", "envoie", "envoyer", "destinataire"],
+    "send_mail_batch": ["campagne", "publipostage", "en masse", "destinataires"],
+    "web_search": KEYWORDS_SEARCH,
+}
+
+
+def user_explicitly_requested_file(message: str) -> bool:
+    msg = message.lower()
+    return any(k in msg for k in KEYWORDS_FILES)
+
+
+def user_requested_search(message: str) -> bool:
+    msg = message.lower()
+    return any(k in msg for k in KEYWORDS_SEARCH)
+
+
+def _pending_request(history: Optional[list]) -> str:
+    """Message du tour précédent s'il demandait un fichier resté sans résultat, sinon ""."""
+    if not history or len(history) < 2:
+        return ""
+    user, assistant = history[-2], history[-1]
+    if user.get("role") != "user" or assistant.get("role") != "assistant" or assistant.get("file_path"):
+        return ""
+    previous = str(user.get("content", ""))
+    return previous if user_explicitly_requested_file(previous) else ""
+
+
+def route_message(message: str, history: Optional[list] = None) -> Optional[list]:
+    """
+    Retourne None pour une réponse directe sans agent, sinon la liste des
+    noms d'outils à proposer à l'agent. `history` (historique de la session)
+    permet de reconnaître la réponse à une question de clarification.
+    """
+    if not FAST_PATH_ENABLED:
+        return list(TOOL_KEYWORDS)
+    if not user_explicitly_requested_file(message):
+        pending = _pending_request(history)
+        if not pending:
+            return ["web_search"] if user_requested_search(message) else None
+        message = f"{pending}\n{message}"
+    msg = message.lower()
+    tools = [name for name, keywords in TOOL_KEYWORDS.items() if any(k in msg for k in keywords)]
+    # Intention de fichier sans format précis ("crée-moi un fichier") : tous les outils de fichier
+    return tools or [name for name in TOOL_KEYWORDS if name != "web_search"]
@@ -0,0 +1,184 @@
+# search_cache.py
+"""
+Recherche web DuckDuckGo avec cache partagé entre sessions.
+
+`CachedSearchTool` remplace `DuckDuckGoSearchTool` (même nom `web_search`,
+mêmes entrées) :
+  - requêtes normalisées (casse, accents, ponctuation, espaces) : « Prix du
+    cuivre ? » et « prix du CUIVRE » partagent la même entrée ;
+  - résultats gardés en mémoire, bornés en nombre (LRU) et en durée (TTL) ;
+  - requêtes identiques simultanées regroupées : une seule recherche réseau,
+    les autres attendent son résultat ;
+  - recherches réseau sérialisées derrière la limite de débit de DuckDuckGo.
+Les échecs (aucun résultat, erreur réseau) ne sont pas mis en cache.
+
+SEARCH_MODE :
+  - online (défaut) : DuckDuckGo, avec le cache ;
+  - offline : uniquement les résultats enregistrés dans SEARCH_FIXTURES, sans
+    réseau (tests, banc d'essai) ;
+  - record : comme online, et chaque nouveau résultat est ajouté à SEARCH_FIXTURES.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional
+
+from smolagents import Tool
+
+from metrics import SEARCH_REQUESTS
+from response_cache import normalize_message
+
+
+SEARCH_MODE = os.getenv("SEARCH_MODE", "online").lower()
+SEARCH_FIXTURES = os.getenv("SEARCH_FIXTURES", "search_fixtures.json")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "500"))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "10"))
+# Requêtes par seconde vers DuckDuckGo (0 : pas de limite)
+SEARCH_RATE_LIMIT = float(os.getenv("SEARCH_RATE_LIMIT", "1.0"))
+
+
+class SearchCache:
+    def __init__(self, mode: str = SEARCH_MODE, fixtures_path: str = SEARCH_FIXTURES,
+                 ttl: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_MAX_ENTRIES,
+                 backend=None):
+        self.mode = mode
+        self.fixtures_path = fixtures_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._backend = backend
+        # requête normalisée -> (résultat, expiration)
+        self._entries: OrderedDict = OrderedDict()
+        # requête normalisée -> Future de la recherche en cours
+        self._in_flight: dict = {}
+        self._lock = threading.Lock()
+        self._backend_lock = threading.Lock()
+        self._fixtures: Optional[dict] = None
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def _get_backend(self):
+        # Import de ddgs et création du client au premier appel réseau seulement
+        if self._backend is None:
+            from smolagents import DuckDuckGoSearchTool
+
+            self._backend = DuckDuckGoSearchTool(max_results=SEARCH_MAX_RESULTS,
+                                                 rate_limit=SEARCH_RATE_LIMIT or None)
+        return self._backend
+
+    def _load_fixtures(self) -> dict:
+        if self._fixtures is None:
+            try:
+                with open(self.fixtures_path, "r", encoding="utf-8") as f:
+                    self._fixtures = {normalize_message(q): r for q, r in json.load(f).items()}
+            except FileNotFoundError:
+                self._fixtures = {}
+        return self._fixtures
+
+    def _record_fixture(self, key: str, result: str):
+        with self._backend_lock:
+            fixtures = self._load_fixtures()
+            fixtures[key] = result
+            tmp_path = f"{self.fixtures_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(fixtures, f, ensure_ascii=False, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.fixtures_path)
+
+    def _fetch(self, query: str, key: str) -> str:
+        if self.mode == "offline":
+            result = self._load_fixtures().get(key)
+            if result is None:
+                raise LookupError(f"Aucun résultat enregistré hors ligne pour « {query} » ({self.fixtures_path}).")
+            return result
+        backend = self._get_backend()
+        # Une recherche réseau à la fois : la limite de débit de l'outil n'est pas thread-safe
+        with self._backend_lock:
+            result = backend.forward(query)
+        if self.mode == "record":
+            self._record_fixture(key, result)
+        return result
+
+    def search(self, query: str) -> str:
+        key = normalize_message(query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                SEARCH_REQUESTS.inc("hit")
+                return entry[0]
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            SEARCH_REQUESTS.inc("coalesced")
+            return future.result()
+
+        SEARCH_REQUESTS.inc("miss")
+        try:
+            result = self._fetch(query, key)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        with self._lock:
+            self._entries[key] = (result, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.coalesced + self.misses
+            return {
+                "mode": self.mode,
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+
+_search_cache: Optional[SearchCache] = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    """Cache de recherche du processus, partagé par tous les agents et sessions."""
+    global _search_cache
+    if _search_cache is None:
+        with _search_cache_lock:
+            if _search_cache is None:
+                _search_cache = SearchCache()
+    return _search_cache
+
+
+class CachedSearchTool(Tool):
+    name = "web_search"
+    description = ("Performs a duckduckgo web search based on your query (think a Google search) "
+                   "then returns the top search results.")
+    inputs = {"query": {"type": "string", "description": "The search query to perform."}}
+    output_type = "string"
+
+    def __init__(self, cache: Optional[SearchCache] = None):
+        super().__init__()
+        self.cache = cache
+
+    def forward(self, query: str) -> str:
+        return (self.cache or get_search_cache()).search(query)
@@ -1,30 +1,209 @@
 #!/usr/bin/env python3
 """
 Script pour démarrer le serveur MCP facilement
+
+  - SERVER_MODE=dev (défaut) : un seul processus avec rechargement automatique ;
+  - SERVER_MODE=prod : processus maître + WEB_CONCURRENCY workers uvicorn.
+
+En production, le maître importe les bibliothèques lourdes (smolagents,
+litellm, reportlab, openpyxl…) puis crée les workers par fork : ils partagent
+ces modules déjà chargés. Chaque worker importe ensuite `mcp_server` et
+construit son propre agent au démarrage. Sur SIGTERM/SIGINT, le maître
+transmet le signal, les workers terminent les requêtes en cours (au plus
+GRACEFUL_TIMEOUT secondes) puis s'arrêtent ; un worker qui meurt est relancé.
+
+L'état en mémoire est propre à chaque worker : contrôle d'admission (la
+sérialisation par session suppose un routage collant, voir `admission`),
+caches et métriques. L'historique reste cohérent : le cache de chaque worker
+est revalidé à chaque lecture. Les métriques de tous les workers sont servies
+par chacun d'eux : le maître crée METRICS_MULTIPROC_DIR (répertoire
+temporaire par défaut), où les workers déposent leurs instantanés.
 """
 import uvicorn
 import sys
 import os
+import time
+import glob
+import shutil
+import signal
+import socket
+import tempfile
+import importlib
 
-if __name__ == "__main__":
+
+SERVER_MODE = os.getenv("SERVER_MODE", "dev").lower()
+HOST = os.getenv("HOST", "127.0.0.1" if SERVER_MODE == "dev" else "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+
+PRELOAD_MODULES = (
+    "smolagents",
+    "litellm",
+    "reportlab.platypus",
+    "openpyxl",
+    "docx",
+    "sib_api_v3_sdk",
+    "fastapi",
+)
+
+
+def preload():
+    started = time.perf_counter()
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"⚠️ Préchargement de {name} impossible: {e}")
+    print(f"📦 Modules préchargés en {time.perf_counter() - started:.1f}s")
+
+
+def run_dev():
     print("🚀 Démarrage du serveur MCP Agent IA...")
-    print("📍 Le serveur sera accessible à: http://127.0.0.1:8000")
-    print("📚 Documentation API: http://127.0.0.1:8000/docs")
-    print("💚 Endpoint de santé: http://127.0.0.1:8000/health")
+    print(f"📍 Le serveur sera accessible à: http://{HOST}:{PORT}")
+    print(f"📚 Documentation API: http://{HOST}:{PORT}/docs")
+    print(f"💚 Endpoint de santé: http://{HOST}:{PORT}/health")
     print("\n⚠️  Appuyez sur Ctrl+C pour arrêter le serveur\n")
-    
+    uvicorn.run(
+        "mcp_server:app",
+        host=HOST,
+        port=PORT,
+        reload=True,
+        log_level=LOG_LEVEL
+    )
+
+
+def _serve_worker(sock: socket.socket, index: int, resume_jobs: bool):
+    """Corps d'un worker (processus enfant) : un serveur uvicorn sur le socket partagé."""
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGALRM):
+        signal.signal(sig, signal.SIG_DFL)
+    # Groupe de processus séparé : Ctrl+C n'atteint que le maître, qui transmet un seul SIGTERM
+    os.setpgid(0, 0)
+    os.environ["SERVER_WORKER_INDEX"] = str(index)
+    os.environ["JOBS_RESUME"] = "true" if resume_jobs else "false"
+    config = uvicorn.Config(
+        "mcp_server:app",
+        log_level=LOG_LEVEL,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.children: dict = {}  # pid -> index du worker
+        self.stopping = False
+        self.sock = None
+
+    def _spawn(self, index: int, resume_jobs: bool = False):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _serve_worker(self.sock, index, resume_jobs)
+            except BaseException as e:
+                print(f"❌ Worker {index} arrêté sur erreur: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+
+    def _stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        print(f"\n🛑 Arrêt demandé : drainage des requêtes en cours ({GRACEFUL_TIMEOUT}s max)...")
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # Filet de sécurité si un worker ne rend pas la main
+        signal.alarm(GRACEFUL_TIMEOUT + 5)
+
+    def _kill(self, signum, frame):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        self.sock = socket.socket(socket.AF_INET6 if ":" in HOST else socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((HOST, PORT))
+        self.sock.listen(2048)
+        self.sock.set_inheritable(True)
+
+        preload()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGALRM, self._kill)
+
+        print(f"🚀 Serveur MCP Agent IA : http://{HOST}:{PORT} ({self.workers} workers, maître {os.getpid()})")
+        for index in range(self.workers):
+            # Seul le premier worker relance les travaux interrompus au démarrage
+            self._spawn(index, resume_jobs=index == 0)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            print(f"⚠️ Worker {index} (pid {pid}) terminé (statut {status}), redémarrage...")
+            time.sleep(1)
+            self._spawn(index)
+        self.sock.close()
+        print("👋 Serveur arrêté. Au revoir !")
+
+
+def _metrics_dir() -> str:
+    """Répertoire des instantanés de métriques des workers, vidé au démarrage ; retourne celui à supprimer."""
+    directory = os.getenv("METRICS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        # Instantanés d'une exécution précédente (workers qui n'existent plus)
+        for path in glob.glob(os.path.join(directory, "worker-*.json")):
+            os.remove(path)
+        return ""
+    directory = tempfile.mkdtemp(prefix="agent-metrics-")
+    # Hérité par les workers, avant qu'ils n'importent `metrics`
+    os.environ["METRICS_MULTIPROC_DIR"] = directory
+    return directory
+
+
+def run_prod():
+    created = _metrics_dir()
+    try:
+        _run_prod()
+    finally:
+        if created:
+            shutil.rmtree(created, ignore_errors=True)
+
+
+def _run_prod():
+    if not hasattr(os, "fork"):
+        # Pas de fork (Windows) : workers uvicorn classiques, sans préchargement partagé
+        uvicorn.run("mcp_server:app", host=HOST, port=PORT, workers=WEB_CONCURRENCY,
+                    log_level=LOG_LEVEL, timeout_graceful_shutdown=GRACEFUL_TIMEOUT)
+        return
+    Supervisor(WEB_CONCURRENCY).run()
+
+
+if __name__ == "__main__":
     try:
-        uvicorn.run(
-            "mcp_server:app",
-            host="127.0.0.1",
-            port=8000,
-            reload=True,
-            log_level="info"
-        )
+        if SERVER_MODE == "prod":
+            run_prod()
+        else:
+            run_dev()
     except KeyboardInterrupt:
         print("\n\n👋 Serveur arrêté. Au revoir !")
         sys.exit(0)
     except Exception as e:
         print(f"\n❌ Erreur lors du démarrage: {e}")
         sys.exit(1)
-
@@ -0,0 +1,146 @@
+# streaming.py
+"""
+Traduction du mode streaming de smolagents (`agent.run(..., stream=True)`) en
+événements simples, prêts à être envoyés en Server-Sent Events :
+
+  - "step"        : fin d'une étape de l'agent (numéro, durée, erreur éventuelle)
+  - "tool_call"   : un outil va être appelé, avec un libellé lisible
+  - "tool_result" : observation renvoyée par l'outil
+  - "delta"       : morceau de texte de la réponse finale, au fil de la génération
+"""
+import re
+import json
+from typing import Iterator, Optional
+
+from smolagents.agents import ToolOutput
+from smolagents.memory import ActionStep, FinalAnswerStep, ToolCall
+from smolagents.models import ChatMessageStreamDelta
+
+
+TOOL_LABELS = {
+    "BuildPDF": "génération du PDF…",
+    "BuildWord": "génération du document Word…",
+    "BuildWordBatch": "génération des lettres Word…",
+    "BuildExcelPro": "génération du fichier Excel…",
+    "send_mail": "envoi de l'email…",
+    "send_mail_batch": "envoi groupé des emails…",
+    "web_search": "recherche sur le web…",
+}
+
+# Taille maximale d'une observation renvoyée au client
+MAX_OBSERVATION_CHARS = 500
+
+_ANSWER_PREFIX = re.compile(r'"answer"\s*:\s*"')
+
+
+class FinalAnswerDeltas:
+    """
+    Extrait au fil de l'eau le texte de la réponse finale.
+
+    Avec un `ToolCallingAgent`, la réponse finale arrive comme arguments JSON
+    de l'outil `final_answer` ({"answer": "..."}), découpés en fragments.
+    On décode la chaîne partielle à chaque fragment et on n'émet que la partie
+    nouvelle.
+    """
+
+    def __init__(self):
+        self._arguments = {}
+        self._names = {}
+        self._emitted = {}
+
+    def feed(self, delta: ChatMessageStreamDelta) -> str:
+        if delta.content:
+            return delta.content
+        text = ""
+        for call in delta.tool_calls or []:
+            index = call.index or 0
+            if call.function is not None:
+                if call.function.name:
+                    self._names[index] = call.function.name
+                if call.function.arguments:
+                    self._arguments[index] = self._arguments.get(index, "") + call.function.arguments
+            if self._names.get(index) == "final_answer":
+                text += self._new_text(index)
+        return text
+
+    def reset(self):
+        self._arguments.clear()
+        self._names.clear()
+        self._emitted.clear()
+
+    def _new_text(self, index: int) -> str:
+        decoded = self._decode_partial(self._arguments.get(index, ""))
+        if decoded is None:
+            return ""
+        # Le chemin du fichier ("texte||chemin") est envoyé dans l'événement final, pas en delta
+        decoded = decoded.split("||", 1)[0]
+        if decoded.endswith("|"):
+            decoded = decoded[:-1]
+        already = self._emitted.get(index, 0)
+        self._emitted[index] = len(decoded)
+        return decoded[already:]
+
+    @staticmethod
+    def _decode_partial(arguments: str) -> Optional[str]:
+        match = _ANSWER_PREFIX.search(arguments)
+        if match is None:
+            return None
+        raw = arguments[match.end():]
+        # Retirer le guillemet fermant et une éventuelle séquence d'échappement incomplète
+        end = re.search(r'(?<!\\)(?:\\\\)*"', raw)
+        if end is not None:
+            raw = raw[:end.end() - 1]
+        for cut in range(0, min(6, len(raw)) + 1):
+            try:
+                return json.loads('"' + raw[:len(raw) - cut] + '"')
+            except ValueError:
+                continue
+        return None
+
+
+def iter_agent_events(agent, message: str, next_item=next) -> Iterator[dict]:
+    """
+    Exécute `agent` en mode streaming et produit des événements {"event", "data"}.
+    Le dernier événement est {"event": "answer", "data": {"output": ...}}.
+    `next_item` permet à l'appelant de faire avancer le flux dans un contexte donné.
+    """
+    deltas = FinalAnswerDeltas()
+    stream = agent.run(message, stream=True)
+    try:
+        while True:
+            try:
+                item = next_item(stream)
+            except StopIteration:
+                break
+
+            if isinstance(item, ChatMessageStreamDelta):
+                text = deltas.feed(item)
+                if text:
+                    yield {"event": "delta", "data": {"text": text}}
+            elif isinstance(item, ToolCall):
+                if item.name == "final_answer":
+                    continue
+                yield {"event": "tool_call", "data": {
+                    "id": item.id,
+                    "name": item.name,
+                    "label": TOOL_LABELS.get(item.name, f"appel de l'outil {item.name}…"),
+                }}
+            elif isinstance(item, ToolOutput):
+                if item.is_final_answer:
+                    continue
+                yield {"event": "tool_result", "data": {
+                    "id": item.id,
+                    "name": item.tool_call.name,
+                    "observation": (item.observation or "")[:MAX_OBSERVATION_CHARS],
+                }}
+            elif isinstance(item, ActionStep):
+                deltas.reset()
+                yield {"event": "step", "data": {
+                    "step": item.step_number,
+                    "duration": item.timing.duration if item.timing else None,
+                    "error": str(item.error) if item.error else None,
+                }}
+            elif isinstance(item, FinalAnswerStep):
+                yield {"event": "answer", "data": {"output": item.output}}
+    finally:
+        stream.close()
@@ -0,0 +1,169 @@
+# tool_scheduler.py
+"""
+Exécution des appels d'outils émis dans une même étape de l'agent.
+
+« Génère le PDF et le Word et envoie-le par mail » produit en une étape
+BuildPDF, BuildWord et send_mail. Les documents ne dépendent pas l'un de
+l'autre : ils sont générés en parallèle sur l'executor borné des outils
+(`TOOL_EXECUTOR_WORKERS`). L'envoi d'un mail passe après les documents de
+l'étape qu'il joint ; s'il joint un fichier qu'on ne sait pas rattacher à un
+appel précis, il attend tous les documents de l'étape.
+
+Les résultats sont rendus au modèle dans l'ordre des appels, quel que soit
+l'ordre dans lequel les outils ont terminé.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextvars import copy_context
+from typing import Optional
+
+from rich.panel import Panel
+from rich.text import Text
+from smolagents import ToolCallingAgent
+from smolagents.agent_types import AgentAudio, AgentImage
+from smolagents.memory import ToolCall
+from smolagents.monitoring import LogLevel
+from smolagents.agents import ToolOutput
+
+
+TOOL_EXECUTOR_WORKERS = int(os.getenv("TOOL_EXECUTOR_WORKERS", "4"))
+
+# Outils qui produisent un fichier -> argument portant son nom (sans extension)
+PRODUCER_TOOLS = {
+    "BuildWord": "filename",
+    "BuildWordBatch": None,  # archive dont le nom n'est pas connu à l'avance
+    "BuildPDF": "name",
+    "BuildExcelPro": "name",
+}
+# Outils qui consomment un fichier produit -> argument portant son chemin
+CONSUMER_TOOLS = {
+    "send_mail": "attachment_path",
+    "send_mail_batch": "attachment_path",
+}
+
+_tool_executor: Optional[ThreadPoolExecutor] = None
+_tool_executor_lock = threading.Lock()
+
+
+def get_tool_executor() -> ThreadPoolExecutor:
+    """Executor des `forward` d'outils, partagé par la boucle asynchrone et les agents synchrones."""
+    global _tool_executor
+    if _tool_executor is None:
+        with _tool_executor_lock:
+            if _tool_executor is None:
+                _tool_executor = ThreadPoolExecutor(
+                    max_workers=TOOL_EXECUTOR_WORKERS, thread_name_prefix="tool-forward"
+                )
+    return _tool_executor
+
+
+def _stem(value) -> str:
+    return os.path.splitext(os.path.basename(str(value or "").strip()))[0].lower()
+
+
+def output_stem(tool_name: str, arguments) -> str:
+    """Nom (sans extension) du fichier que produira l'appel, "" s'il n'est pas connu d'avance."""
+    key = PRODUCER_TOOLS.get(tool_name)
+    return _stem(arguments.get(key)) if key and isinstance(arguments, dict) else ""
+
+
+def attachment_stem(tool_name: str, arguments) -> Optional[str]:
+    """Nom (sans extension) de la pièce jointe de l'appel ; None s'il n'en consomme aucune."""
+    key = CONSUMER_TOOLS.get(tool_name)
+    attachment = arguments.get(key) if key and isinstance(arguments, dict) else None
+    return _stem(attachment) if attachment else None
+
+
+def match_producers(stem: str, producers: dict) -> set:
+    """
+    Producteurs `{id: (nom_outil, arguments)}` dont dépend une pièce jointe :
+    ceux qui produisent ce fichier, sinon tous (fichier non rattaché à un appel précis).
+    """
+    matching = {key for key, (name, arguments) in producers.items()
+                if stem and output_stem(name, arguments) == stem}
+    return matching or set(producers)
+
+
+def _dependencies(calls: list) -> list:
+    """Pour chaque appel, les indices des appels de l'étape qui doivent le précéder."""
+    producers = {i: call for i, call in enumerate(calls) if call[0] in PRODUCER_TOOLS}
+    depends = []
+    for name, arguments in calls:
+        stem = attachment_stem(name, arguments)
+        depends.append(set() if stem is None else match_producers(stem, producers))
+    return depends
+
+
+def plan_waves(calls: list) -> list:
+    """
+    Découpe les appels `[(nom, arguments), ...]` en vagues d'indices : les appels
+    d'une vague sont indépendants et peuvent tourner en parallèle, chaque vague
+    attend la précédente. L'ordre des appels est conservé dans chaque vague.
+    """
+    depends = _dependencies(calls)
+    levels = [0] * len(calls)
+    # Les consommateurs ne produisent rien : une passe suffit
+    for i, deps in enumerate(depends):
+        if deps:
+            levels[i] = 1 + max(levels[d] for d in deps)
+    waves = [[] for _ in range(max(levels, default=-1) + 1)]
+    for i, level in enumerate(levels):
+        waves[level].append(i)
+    return waves
+
+
+class ParallelToolCallingAgent(ToolCallingAgent):
+    """
+    `ToolCallingAgent` dont les appels d'outils d'une même étape sont ordonnancés par `plan_waves`.
+    `_run_tool_call` reprend le traitement d'un appel de `ToolCallingAgent.process_tool_calls`
+    (smolagents 1.26), qui n'est pas exposé séparément.
+    """
+
+    def _run_tool_call(self, tool_call: ToolCall) -> ToolOutput:
+        arguments = tool_call.arguments or {}
+        self.logger.log(Panel(Text(f"Calling tool: '{tool_call.name}' with arguments: {arguments}")),
+                        level=LogLevel.INFO)
+        result = self.execute_tool_call(tool_call.name, arguments)
+        if type(result) in (AgentImage, AgentAudio):
+            # Comme upstream : le média est gardé dans l'état de l'agent, le modèle ne voit que son nom
+            observation_name = "image.png" if type(result) is AgentImage else "audio.mp3"
+            self.state[observation_name] = result
+            observation = f"Stored '{observation_name}' in memory."
+        else:
+            observation = str(result).strip()
+        self.logger.log(f"Observations: {observation.replace('[', '|')}", level=LogLevel.INFO)
+        return ToolOutput(id=tool_call.id, output=result, is_final_answer=tool_call.name == "final_answer",
+                          observation=observation, tool_call=tool_call)
+
+    def process_tool_calls(self, chat_message, memory_step):
+        calls = []
+        for chat_tool_call in chat_message.tool_calls:
+            tool_call = ToolCall(name=chat_tool_call.function.name, arguments=chat_tool_call.function.arguments,
+                                 id=chat_tool_call.id)
+            yield tool_call
+            calls.append(tool_call)
+
+        outputs = [None] * len(calls)
+        for wave in plan_waves([(call.name, call.arguments) for call in calls]):
+            if len(wave) == 1:
+                outputs[wave[0]] = self._run_tool_call(calls[wave[0]])
+                yield outputs[wave[0]]
+                continue
+            # Contexte copié : session courante et trace suivent l'outil dans son thread
+            futures = {
+                get_tool_executor().submit(copy_context().run, self._run_tool_call, calls[i]): i
+                for i in wave
+            }
+            try:
+                for future in as_completed(futures):
+                    outputs[futures[future]] = future.result()
+                    yield outputs[futures[future]]
+            except BaseException:
+                # Laisser finir les outils déjà lancés avant de remonter l'erreur de l'étape
+                wait(futures)
+                raise
+
+        memory_step.tool_calls = calls
+        observations = "\n".join(output.observation for output in outputs)
+        memory_step.observations = (memory_step.observations or "") + observations
@@ -1,37 +1,131 @@
 from smolagents import Tool
-from docx import Document
-from docx.shared import Pt, Inches, Cm
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.style import WD_STYLE_TYPE
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import cm
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from openpyxl.worksheet.table import Table, TableStyleInfo
-from openpyxl.chart import BarChart, Reference
-from openpyxl.drawing.image import Image
+# python-docx, reportlab, openpyxl et le SDK Brevo sont importés au premier
+# `forward` de l'outil qui les utilise : démarrer le serveur ne les charge pas.
 
 # from email.mime.text import MIMEText
 # from email.mime.multipart import MIMEMultipart
 # from email.mime.base import MIMEBase
 # from email import encoders
 # import smtplib
-import sib_api_v3_sdk
-from sib_api_v3_sdk.rest import ApiException
-import base64
+import csv
+import html
+import itertools
+import json
 import os
+import re
+import shutil
+import tempfile
+import zipfile
 import logging
+import warnings
 from typing import Optional
+from artifacts import ARTIFACTS_DIR, artifact_path, register_artifact, locate_artifact
+from document_cache import get_document_cache, document_key
+from mail_client import get_brevo_client, encode_attachment, batch_email_data, AttachmentTooLarge
 
 logger = logging.getLogger(__name__)
 
 
+# Au-delà de ce nombre de lignes, BuildExcelPro passe en mode écriture seule (streaming)
+EXCEL_STREAMING_THRESHOLD = int(os.getenv("EXCEL_STREAMING_THRESHOLD", "5000"))
+# Nombre de lignes échantillonnées pour calculer la largeur des colonnes
+EXCEL_WIDTH_SAMPLE_ROWS = int(os.getenv("EXCEL_WIDTH_SAMPLE_ROWS", "1000"))
+EXCEL_MAX_COLUMN_WIDTH = 60
+# Répertoires d'où `rows_path` peut être lu (en plus des artefacts), séparés par os.pathsep
+EXCEL_ROWS_DIRS = [d for d in os.getenv("EXCEL_ROWS_DIRS", "uploads").split(os.pathsep) if d]
+EXCEL_ROWS_EXTENSIONS = (".csv", ".jsonl")
+
+_INT_RE = re.compile(r"-?(?:0|[1-9]\d*)")
+_FLOAT_RE = re.compile(r"-?(?:0|[1-9]\d*)\.\d+")
+
+
+def _render_cached(tool_name: str, key_inputs: dict, file_path: str, render) -> bool:
+    """
+    Produit `file_path` avec `render()`, sauf si un document aux entrées
+    identiques est déjà en cache. Retourne True sur un hit (aucun rendu).
+    """
+    cache = get_document_cache()
+    ext = os.path.splitext(file_path)[1]
+    key = document_key(tool_name, key_inputs) if cache is not None else None
+    if cache is not None and cache.fetch(key, ext, file_path):
+        return True
+    # Le fichier existant peut être un lien vers le cache : ne jamais le réécrire en place
+    if os.path.lexists(file_path):
+        os.remove(file_path)
+    render()
+    if cache is not None:
+        cache.store(key, ext, file_path)
+    return False
+
+
+def _safe_rows_path(path: str) -> str:
+    """
+    Chemin fourni par le modèle : n'accepte qu'un fichier CSV ou JSONL situé
+    dans les artefacts ou un répertoire de dépôt (jamais `.env` ou un autre
+    fichier du serveur). Les liens symboliques sont résolus avant la vérification.
+    """
+    real = os.path.realpath(path)
+    if not real.lower().endswith(EXCEL_ROWS_EXTENSIONS):
+        raise ValueError(f"rows_path doit être un fichier {' ou '.join(EXCEL_ROWS_EXTENSIONS)}")
+    for root in [ARTIFACTS_DIR] + EXCEL_ROWS_DIRS:
+        root = os.path.realpath(root)
+        if os.path.commonpath([real, root]) == root:
+            return real
+    raise ValueError(f"rows_path doit se trouver dans {', '.join([ARTIFACTS_DIR] + EXCEL_ROWS_DIRS)}")
+
+
+def _csv_value(value: str):
+    # Mêmes types qu'avec `rows` : nombres en nombres, cellule vide en cellule vide.
+    # Les zéros en tête (codes postaux, téléphones) restent du texte.
+    value = value.strip()
+    if not value:
+        return None
+    if _INT_RE.fullmatch(value):
+        return int(value)
+    if _FLOAT_RE.fullmatch(value):
+        return float(value)
+    return value
+
+
+def _iter_rows_from_file(path: str, headers: list):
+    """Lit les lignes d'un fichier CSV ou JSONL, une par une."""
+    if path.lower().endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                row = json.loads(line)
+                # Objet JSON : valeurs dans l'ordre des en-têtes
+                yield [row.get(h) for h in headers] if isinstance(row, dict) else row
+    else:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            first = next(reader, None)
+            # La ligne d'en-tête du CSV n'est pas une donnée
+            if first is not None and [c.strip() for c in first] != [str(h).strip() for h in headers]:
+                yield [_csv_value(c) for c in first]
+            for row in reader:
+                yield [_csv_value(c) for c in row]
+
+
+def _column_widths(headers: list, sample_rows: list) -> list:
+    widths = [len(str(h)) for h in headers]
+    for row in sample_rows:
+        for i, value in enumerate(row):
+            length = len(str(value)) if value is not None else 0
+            if i >= len(widths):
+                widths.append(length)
+            elif length > widths[i]:
+                widths[i] = length
+    return [min(w + 2, EXCEL_MAX_COLUMN_WIDTH) for w in widths]
+
+
 class BuildExcelPro(Tool):
     name = "BuildExcelPro"
     description = (
-        "Crée un fichier Excel professionnel avec tableau, formules, graphiques et image."
+        "Crée un fichier Excel professionnel avec tableau, formules, graphiques et image. "
+        "Pour de gros volumes, passe un fichier CSV ou JSONL via `rows_path` plutôt que `rows`."
     )
 
     inputs = {
@@ -48,7 +142,12 @@ class BuildExcelPro(Tool):
         "rows": {
             "type": "array",
             "description": "Toutes les données ligne par ligne",
-            
+            "nullable": True,
+        },
+        "rows_path": {
+            "type": "string",
+            "description": "Chemin d'un fichier CSV ou JSONL contenant les lignes (gros volumes)",
+            "nullable": True,
         },
         # "chart": {
         #     "type": "boolean",
@@ -64,112 +163,336 @@ class BuildExcelPro(Tool):
 
     output_type = "string"
 
-    def forward(self, name, headers, rows, ):
+    def forward(self, name, headers, rows=None, rows_path=None):
         try:
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Feuille1"
-
-            # ---- EN-TÊTES ----
-            ws.append(headers)
-            for cell in ws[1]:
-                cell.font = Font(bold=True, color="FFFFFF")
-                cell.fill = PatternFill("solid", fgColor="4472C4")
-                cell.alignment = Alignment(horizontal="center")
-
-            # ---- LIGNES ----
-            for row in rows:
-                ws.append(row)
-
-            # ---- TABLE STYLE ----
-            last_row = ws.max_row
-            last_col = ws.max_column
-            table = Table(
-                displayName="Table1",
-                ref=f"A1:{chr(64 + last_col)}{last_row}"
-            )
-            style = TableStyleInfo(
-                name="TableStyleMedium9",
-                showFirstColumn=False,
-                showLastColumn=False,
-                showRowStripes=True,
-                showColumnStripes=False
-            )
-            table.tableStyleInfo = style
-            ws.add_table(table)
-
-            # ---- AUTO-WIDTH ----
-            for col in ws.columns:
-                max_length = max(len(str(c.value)) for c in col)
-                ws.column_dimensions[col[0].column_letter].width = max_length + 2
-
-            # ---- GRAPHIQUE ----
-            # if chart:
-            #     chart_obj = BarChart()
-            #     chart_obj.title = "Graphique des données"
-
-            #     data = Reference(ws, min_col=2, min_row=1,
-            #                     max_row=last_row, max_col=last_col)
-            #     chart_obj.add_data(data, titles_from_data=True)
-
-            #     cats = Reference(ws, min_col=1, min_row=2, max_row=last_row)
-            #     chart_obj.set_categories(cats)
-
-            #     ws.add_chart(chart_obj, f"{chr(66 + last_col)}2")
-
-            
+            file_name = artifact_path(f"{name}.xlsx")
+            if rows_path:
+                rows_path = _safe_rows_path(rows_path)
+                # Le fichier source est identifié par sa taille et sa date de modification
+                stat = os.stat(rows_path)
+                key_inputs = {"headers": headers, "rows_path": [rows_path, stat.st_size, stat.st_mtime_ns],
+                              "csv_values": "typed"}
+            else:
+                key_inputs = {"headers": headers, "rows": rows or []}
+
+            def render(rows=rows):
+                if rows_path:
+                    rows = _iter_rows_from_file(rows_path, headers)
+                elif rows is None:
+                    rows = []
+                # Itérateur (fichier, générateur) ou gros tableau : mode écriture seule
+                if not isinstance(rows, (list, tuple)) or len(rows) > EXCEL_STREAMING_THRESHOLD:
+                    self._build_streaming(file_name, headers, rows)
+                else:
+                    self._build_standard(file_name, headers, rows)
 
-            # ---- SAUVEGARDE ----
-            file_name = f"{name}.xlsx"
-            wb.save(file_name)
+            _render_cached(self.name, key_inputs, file_name, render)
+            register_artifact(file_name)
 
-            return f"Excel '{file_name}' généré avec succès !||{file_name}"
+            return f"Excel '{os.path.basename(file_name)}' généré avec succès !||{file_name}"
 
         except Exception as e:
             return f"Erreur Excel Pro : {e}"
 
+    @staticmethod
+    def _table(last_col: int, last_row: int):
+        from openpyxl.worksheet.table import Table, TableStyleInfo
+        from openpyxl.utils import get_column_letter
+
+        table = Table(
+            displayName="Table1",
+            ref=f"A1:{get_column_letter(last_col)}{last_row}"
+        )
+        style = TableStyleInfo(
+            name="TableStyleMedium9",
+            showFirstColumn=False,
+            showLastColumn=False,
+            showRowStripes=True,
+            showColumnStripes=False
+        )
+        table.tableStyleInfo = style
+        return table
+
+    def _build_standard(self, file_name, headers, rows):
+        from openpyxl import Workbook
+        from openpyxl.styles import Font, PatternFill, Alignment
+
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Feuille1"
+
+        # ---- EN-TÊTES ----
+        ws.append(headers)
+        for cell in ws[1]:
+            cell.font = Font(bold=True, color="FFFFFF")
+            cell.fill = PatternFill("solid", fgColor="4472C4")
+            cell.alignment = Alignment(horizontal="center")
+
+        # ---- LIGNES ----
+        for row in rows:
+            ws.append(row)
+
+        # ---- TABLE STYLE ----
+        ws.add_table(self._table(ws.max_column, ws.max_row))
+
+        # ---- AUTO-WIDTH ----
+        for col in ws.columns:
+            max_length = max(len(str(c.value)) for c in col)
+            ws.column_dimensions[col[0].column_letter].width = max_length + 2
+
+        # ---- GRAPHIQUE ----
+        # if chart:
+        #     chart_obj = BarChart()
+        #     chart_obj.title = "Graphique des données"
+
+        #     data = Reference(ws, min_col=2, min_row=1,
+        #                     max_row=last_row, max_col=last_col)
+        #     chart_obj.add_data(data, titles_from_data=True)
+
+        #     cats = Reference(ws, min_col=1, min_row=2, max_row=last_row)
+        #     chart_obj.set_categories(cats)
+
+        #     ws.add_chart(chart_obj, f"{get_column_letter(last_col + 2)}2")
+
+        # ---- SAUVEGARDE ----
+        wb.save(file_name)
+
+    def _build_streaming(self, file_name, headers, rows):
+        """
+        Mode écriture seule : les lignes sont écrites au fil de l'eau, sans garder
+        les cellules en mémoire. Les largeurs sont calculées sur un échantillon
+        des premières lignes, avant l'écriture (obligatoire en write-only).
+        """
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font, PatternFill, Alignment
+        from openpyxl.utils import get_column_letter
+        from openpyxl.worksheet.filters import AutoFilter
+        from openpyxl.worksheet.table import TableColumn
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Feuille1")
+
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, EXCEL_WIDTH_SAMPLE_ROWS))
+        widths = _column_widths(headers, sample)
+        for i, width in enumerate(widths, start=1):
+            ws.column_dimensions[get_column_letter(i)].width = width
+
+        # ---- EN-TÊTES ----
+        header_cells = []
+        for h in headers:
+            cell = WriteOnlyCell(ws, value=h)
+            cell.font = Font(bold=True, color="FFFFFF")
+            cell.fill = PatternFill("solid", fgColor="4472C4")
+            cell.alignment = Alignment(horizontal="center")
+            header_cells.append(cell)
+        ws.append(header_cells)
+
+        # ---- LIGNES ----
+        last_row = 1
+        last_col = len(headers)
+        for row in itertools.chain(sample, rows):
+            ws.append(row)
+            last_row += 1
+            if len(row) > last_col:
+                last_col = len(row)
+
+        # ---- TABLE STYLE ----
+        # En écriture seule, openpyxl ne peut pas relire les en-têtes : colonnes déclarées à la main
+        table = self._table(max(last_col, 1), last_row)
+        names = [str(h) for h in headers] + [f"Colonne{i}" for i in range(len(headers) + 1, last_col + 1)]
+        table.tableColumns = [TableColumn(id=i, name=n) for i, n in enumerate(names, start=1)]
+        table.autoFilter = AutoFilter(ref=table.ref)
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="In write-only mode you must add table columns manually")
+            ws.add_table(table)
+
+        # ---- SAUVEGARDE ----
+        wb.save(file_name)
+
+
+# --- Moteur PDF ---
+# Styles construits une seule fois par processus (getSampleStyleSheet est coûteux)
+_pdf_styles = None
+
+_PDF_HEADING = re.compile(r"^(#{1,3})\s+(.*)$")
+_PDF_BULLET = re.compile(r"^\s*[-*•]\s+(.*)$")
+_PDF_NUMBERED = re.compile(r"^\s*(\d+)[.)]\s+(.*)$")
+_PDF_TABLE_SEPARATOR = re.compile(r"^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?$")
+_PDF_BOLD = re.compile(r"\*\*(.+?)\*\*")
+_PDF_ITALIC = re.compile(r"(?<![*\w])\*(?!\s)(.+?)(?<!\s)\*(?![*\w])")
+
+
+def get_pdf_styles() -> dict:
+    global _pdf_styles
+    if _pdf_styles is None:
+        from reportlab.lib import colors
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.platypus import TableStyle as PdfTableStyle
+
+        sample = getSampleStyleSheet()
+        body = sample["BodyText"]
+        _pdf_styles = {
+            "title": sample["Title"],
+            "h1": sample["Heading1"],
+            "h2": sample["Heading2"],
+            "h3": sample["Heading3"],
+            "body": body,
+            "bullet": ParagraphStyle("PdfBullet", parent=body, leftIndent=18, bulletIndent=6, spaceBefore=0, spaceAfter=2),
+            "cell": ParagraphStyle("PdfCell", parent=body, fontSize=9, leading=11, spaceBefore=0, spaceAfter=0),
+            "table": PdfTableStyle([
+                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+                ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#1F4E78")),
+                ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+                ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ]),
+        }
+    return _pdf_styles
+
+
+def _pdf_inline(text: str) -> str:
+    """Échappe le texte pour reportlab et convertit **gras** et *italique*."""
+    text = html.escape(text, quote=False)
+    text = _PDF_BOLD.sub(r"<b>\1</b>", text)
+    return _PDF_ITALIC.sub(r"<i>\1</i>", text)
+
+
+def _pdf_table(lines: list, styles: dict, width: float):
+    from reportlab.lib import colors
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.platypus import Paragraph, Table as PdfTable
+
+    rows = []
+    for line in lines:
+        if _PDF_TABLE_SEPARATOR.match(line.strip()):
+            continue
+        cells = [cell.strip() for cell in line.strip().strip("|").split("|")]
+        rows.append(cells)
+    columns = max(len(row) for row in rows)
+    header_style = ParagraphStyle("PdfHeaderCell", parent=styles["cell"], textColor=colors.white)
+    data = [
+        [Paragraph(_pdf_inline(cell), header_style if i == 0 else styles["cell"]) for cell in row]
+        + [""] * (columns - len(row))
+        for i, row in enumerate(rows)
+    ]
+    table = PdfTable(data, colWidths=[width / columns] * columns, repeatRows=1)
+    table.setStyle(styles["table"])
+    return table
+
+
+def iter_pdf_flowables(content: str, styles: dict, width: float):
+    """
+    Découpe le contenu en flowables, ligne par ligne : un paragraphe reportlab
+    par ligne (et non un seul paragraphe géant), ce qui garde une mise en page
+    linéaire en la longueur du texte.
+
+    Balisage léger reconnu : titres `#`, `##`, `###` ; listes `- item` et
+    `1. item` ; tableaux `| a | b |` ; **gras** et *italique*.
+    """
+    from reportlab.platypus import Paragraph, Spacer
+
+    table_lines = []
+    for line in content.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("|"):
+            table_lines.append(stripped)
+            continue
+        if table_lines:
+            yield _pdf_table(table_lines, styles, width)
+            table_lines = []
+
+        if not stripped:
+            yield Spacer(1, 6)
+            continue
+        heading = _PDF_HEADING.match(stripped)
+        if heading:
+            yield Paragraph(_pdf_inline(heading.group(2)), styles[f"h{len(heading.group(1))}"])
+            continue
+        bullet = _PDF_BULLET.match(line)
+        if bullet:
+            yield Paragraph(_pdf_inline(bullet.group(1)), styles["bullet"], bulletText="•")
+            continue
+        numbered = _PDF_NUMBERED.match(line)
+        if numbered:
+            yield Paragraph(_pdf_inline(numbered.group(2)), styles["bullet"], bulletText=f"{numbered.group(1)}.")
+            continue
+        yield Paragraph(_pdf_inline(stripped), styles["body"])
+    if table_lines:
+        yield _pdf_table(table_lines, styles, width)
+
 
 class BuildPDF(Tool):
     name = "BuildPDF"
-    description = "Génère un PDF professionnel avec titre, contenu, marges et styles optimisés."
+    description = (
+        "Génère un PDF professionnel avec titre, contenu, marges et styles optimisés. "
+        "Le contenu accepte un balisage léger : titres (#, ##, ###), listes (- item, 1. item), "
+        "tableaux (| a | b |), **gras** et *italique*."
+    )
 
     inputs = {
         "name": {"type": "string", "description": "Nom du fichier PDF sans extension"},
         "title": {"type": "string", "description": "Titre du PDF"},
-        "content": {"type": "string", "description": "Texte du PDF"},
+        "content": {"type": "string", "description": "Texte du PDF (balisage léger accepté)"},
     }
     output_type = "string"
 
     def forward(self, name: str, title: str, content: str) -> str:
         try:
-            file_name = f"{name}.pdf"
-            styles = getSampleStyleSheet()
-            style_title = styles["Title"]
-            style_body = styles["BodyText"]
-
-            doc = SimpleDocTemplate(
-                file_name,
-                pagesize=A4,
-                leftMargin=2*cm,
-                rightMargin=2*cm,
-                topMargin=2*cm,
-                bottomMargin=2*cm
-            )
+            file_name = artifact_path(f"{name}.pdf")
 
-            story = [
-                Paragraph(title, style_title),
-                Spacer(1, 12),
-                Paragraph(content.replace("\n", "<br/>"), style_body)
-            ]
+            def render():
+                from reportlab.lib.pagesizes import A4
+                from reportlab.lib.units import cm
+                from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 
-            doc.build(story)
+                styles = get_pdf_styles()
 
-            return f"PDF '{file_name}' généré avec succès||{file_name}"
+                doc = SimpleDocTemplate(
+                    file_name,
+                    pagesize=A4,
+                    leftMargin=2*cm,
+                    rightMargin=2*cm,
+                    topMargin=2*cm,
+                    bottomMargin=2*cm
+                )
+
+                story = [Paragraph(_pdf_inline(title), styles["title"]), Spacer(1, 12)]
+                story.extend(iter_pdf_flowables(content, styles, doc.width))
+
+                doc.build(story)
+
+            # "engine" : les PDF rendus par l'ancien moteur (paragraphe unique) ne sont pas réutilisés
+            key_inputs = {"title": title, "content": content, "engine": "flowables"}
+            _render_cached(self.name, key_inputs, file_name, render)
+            register_artifact(file_name)
+
+            return f"PDF '{os.path.basename(file_name)}' généré avec succès||{file_name}"
 
         except Exception as e:
             return f"Erreur PDF : {str(e)}"
 
 
+def _letter_values(title, recipient, sender, date, subject, body, closing=None, signature=None) -> dict:
+    from word_templates import DEFAULT_CLOSING
+
+    return {
+        "title": title,
+        "recipient": recipient,
+        "sender": sender,
+        "date": date,
+        "subject": subject,
+        "body": body,
+        "closing": closing or DEFAULT_CLOSING,
+        # Signature par défaut : première ligne des coordonnées de l'expéditeur
+        "signature": signature or (sender or "").strip().split("\n")[0],
+    }
+
+
+def _safe_filename(filename: str) -> str:
+    return "".join(c for c in filename if c.isalnum() or c in (' ', '-', '_')).rstrip()
+
+
 class BuildWord(Tool):
     name = "BuildWord"
     description = (
@@ -185,84 +508,99 @@ class BuildWord(Tool):
         "date": {"type": "string", "description": "Date (ex: 'Paris, le 23 décembre 2025')"},
         "subject": {"type": "string", "description": "Objet de la lettre"},
         "body": {"type": "string", "description": "Corps complet de la lettre en texte brut (paragraphes séparés par \\n\\n). Tu peux inclure des listes avec - item"},
-        "filename": {"type": "string", "description": "Nom du fichier sans extension (ex: 'Lettre_Motivation_Jonathan')"}
+        "filename": {"type": "string", "description": "Nom du fichier sans extension (ex: 'Lettre_Motivation_Jonathan')"},
+        "closing": {"type": "string", "description": "Formule de politesse (par défaut : formule classique)", "nullable": True},
+        "signature": {"type": "string", "description": "Signature (par défaut : première ligne des coordonnées)", "nullable": True},
+        "template": {"type": "string", "description": "Modèle Word '<tenant>/<nom>' (par défaut : lettre standard)", "nullable": True},
     }
 
     output_type = "string"
 
-    def forward(self, title: str, recipient: str, sender: str, date: str, subject: str, body: str, filename: str):
+    def forward(self, title: str, recipient: str, sender: str, date: str, subject: str, body: str, filename: str,
+                closing: Optional[str] = None, signature: Optional[str] = None, template: Optional[str] = None):
+        from word_templates import get_word_template
+
         try:
-            doc = Document()
-
-            # === Configuration page professionnelle (format lettre française) ===
-            section = doc.sections[0]
-            section.top_margin = Cm(2.5)
-            section.bottom_margin = Cm(2.5)
-            section.left_margin = Cm(2.5)
-            section.right_margin = Cm(2.5)
-
-            # === Style global ===
-            style = doc.styles['Normal']
-            font = style.font
-            font.name = 'Arial'
-            font.size = Pt(11)
-
-            # === En-tête : Vos coordonnées (aligné à droite) ===
-            p = doc.add_paragraph(sender)
-            p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-
-            # === Destinataire (aligné à gauche) ===
-            doc.add_paragraph(recipient)
-
-            # === Date (aligné à gauche ou droite selon norme) ===
-            doc.add_paragraph(date)
-
-            # === Objet ===
-            p = doc.add_paragraph()
-            p.add_run('Objet : ').bold = True
-            p.add_run(subject)
-
-            doc.add_paragraph()  # Espace
-
-            # === Titre centré ===
-            title_p = doc.add_paragraph(title)
-            title_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            title_run = title_p.runs[0]
-            title_run.font.size = Pt(16)
-            title_run.bold = True
-
-            doc.add_paragraph()  # Espace
-
-            # === Corps de la lettre ===
-            paragraphs = body.split('\n\n')
-            for para_text in paragraphs:
-                para_text = para_text.strip()
-                if para_text.startswith('- '):
-                    # Liste à puces
-                    items = para_text.split('\n- ')
-                    for i, item in enumerate(items):
-                        if i == 0 and not item.startswith('- '):
-                            item = item[2:] if item.startswith('- ') else item
-                        p = doc.add_paragraph(item.strip('- '), style='List Bullet')
-                else:
-                    doc.add_paragraph(para_text)
+            file_path = artifact_path(f"{_safe_filename(filename)}.docx")
+            word_template = get_word_template(template)
+            values = _letter_values(title, recipient, sender, date, subject, body, closing, signature)
+            _render_cached(
+                self.name,
+                {**values, "template": word_template.digest},
+                file_path,
+                lambda: word_template.render(values, file_path),
+            )
+            register_artifact(file_path)
 
-            # === Formule de politesse ===
-            doc.add_paragraph()
-            doc.add_paragraph("Je vous prie d’agréer, Madame, Monsieur, l’expression de mes salutations distinguées.")
+            return f"Fichier Word professionnel créé avec succès : {os.path.basename(file_path)} || {file_path}"
 
-            doc.add_paragraph()  # Espace signature
-            doc.add_paragraph("Jonathan Zadi")
+        except Exception as e:
+            return f"Erreur lors de la création du document Word : {str(e)}"
 
-            # === Sauvegarde ===
-            safe_filename = "".join(c for c in filename if c.isalnum() or c in (' ', '-', '_')).rstrip()
-            file_path = f"{safe_filename}.docx"
-            doc.save(file_path)
 
-            return f"Fichier Word professionnel créé avec succès : {os.path.abspath(file_path)} || {os.path.abspath(file_path)}"
+class BuildWordBatch(Tool):
+    name = "BuildWordBatch"
+    description = (
+        "Publipostage : génère en un seul appel une lettre Word (.docx) par destinataire "
+        "à partir d'un même modèle, et les regroupe dans une archive .zip."
+    )
+
+    inputs = {
+        "letters": {
+            "type": "array",
+            "description": (
+                "Une entrée par lettre : objet avec recipient, subject, body, filename "
+                "et éventuellement title, sender, date, closing, signature (qui remplacent `common`)"
+            ),
+        },
+        "common": {
+            "type": "object",
+            "description": "Champs communs à toutes les lettres (ex: sender, date, title, closing, signature)",
+            "nullable": True,
+        },
+        "template": {"type": "string", "description": "Modèle Word '<tenant>/<nom>' (par défaut : lettre standard)", "nullable": True},
+        "archive_name": {"type": "string", "description": "Nom de l'archive .zip sans extension", "nullable": True},
+    }
+
+    output_type = "string"
+
+    def forward(self, letters: list, common: Optional[dict] = None, template: Optional[str] = None,
+                archive_name: Optional[str] = None):
+        from word_templates import render_many
+
+        try:
+            if not letters:
+                return "Erreur : aucune lettre à générer."
+            archive_path = artifact_path(f"{_safe_filename(archive_name or 'Publipostage')}.zip")
+            work_dir = tempfile.mkdtemp(prefix="publipostage_")
+            try:
+                jobs, names = [], []
+                for i, letter in enumerate(letters, start=1):
+                    fields = {**(common or {}), **letter}
+                    values = {
+                        **fields,
+                        **_letter_values(
+                            fields.get("title", ""), fields.get("recipient", ""), fields.get("sender", ""),
+                            fields.get("date", ""), fields.get("subject", ""), fields.get("body", ""),
+                            fields.get("closing"), fields.get("signature"),
+                        ),
+                    }
+                    name = _safe_filename(str(fields.get("filename") or "")) or f"Lettre_{i}"
+                    names.append(f"{name}_{i}.docx" if f"{name}.docx" in names else f"{name}.docx")
+                    jobs.append((values, os.path.join(work_dir, f"{i:05d}.docx")))
+
+                paths = render_many(template, jobs)
+                with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                    for path, name in zip(paths, names):
+                        archive.write(path, name)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            register_artifact(archive_path)
+
+            return f"{len(paths)} lettre(s) Word générée(s) dans '{os.path.basename(archive_path)}'||{archive_path}"
 
         except Exception as e:
-            return f"Erreur lors de la création du document Word : {str(e)}"
+            return f"Erreur lors du publipostage Word : {str(e)}"
 
 
 # class SendMail(Tool):
@@ -381,6 +719,7 @@ class SendMail(Tool):
         is_html: bool = False,
         attachment_path: Optional[str] = None
     ) -> str:
+        from sib_api_v3_sdk.rest import ApiException
 
         try:
             api_key = os.getenv("BREVO_API_KEY")
@@ -389,13 +728,6 @@ class SendMail(Tool):
             if not api_key:
                 return "Erreur : clé API Brevo manquante."
 
-            configuration = sib_api_v3_sdk.Configuration()
-            configuration.api_key['api-key'] = api_key
-
-            api_instance = sib_api_v3_sdk.TransactionalEmailsApi(
-                sib_api_v3_sdk.ApiClient(configuration)
-            )
-
             email_data = {
                 "to": [{"email": recipient_email}],
                 "subject": subject,
@@ -404,21 +736,99 @@ class SendMail(Tool):
                 "textContent": message if not is_html else None,
             }
 
-            # 📎 Pièce jointe
-            if attachment_path and os.path.isfile(attachment_path):
-                with open(attachment_path, "rb") as f:
-                    encoded = base64.b64encode(f.read()).decode()
-
-                email_data["attachment"] = [{
-                    "content": encoded,
-                    "name": os.path.basename(attachment_path)
-                }]
+            # 📎 Pièce jointe (encodée par blocs, taille plafonnée) ; un simple nom de fichier
+            # désigne le dernier document de ce nom généré dans la session
+            attachment_path = locate_artifact(attachment_path) if attachment_path else None
+            if attachment_path:
+                email_data["attachment"] = [encode_attachment(attachment_path)]
 
-            api_instance.send_transac_email(email_data)
+            get_brevo_client(api_key).send(email_data)
 
             return f"📧 Email envoyé avec succès à {recipient_email}"
 
+        except AttachmentTooLarge as e:
+            return f"Erreur : {e}"
         except ApiException as e:
             return f"Erreur Brevo API : {e}"
         except Exception as e:
             return f"Erreur lors de l'envoi de l'email : {e}"
+
+
+class SendMailBatch(Tool):
+    name = "send_mail_batch"
+    description = (
+        "Envoie en un seul appel un email personnalisé à de nombreux destinataires via Brevo "
+        "(campagne, publipostage). Chaque destinataire peut avoir son propre sujet et son propre message."
+    )
+
+    inputs = {
+        "recipients": {
+            "type": "array",
+            "description": "Liste d'objets {\"email\": ..., \"subject\": (optionnel), \"message\": (optionnel)}",
+        },
+        "subject": {"type": "string", "description": "Sujet par défaut"},
+        "message": {"type": "string", "description": "Message par défaut (HTML ou texte)"},
+        "is_html": {"type": "boolean", "description": "Messages HTML ?", "nullable": True},
+        "attachment_path": {"type": "string", "description": "Fichier joint commun à tous les emails", "nullable": True}
+    }
+
+    output_type = "string"
+
+    def forward(
+        self,
+        recipients: list,
+        subject: str,
+        message: str,
+        is_html: bool = False,
+        attachment_path: Optional[str] = None
+    ) -> str:
+        from sib_api_v3_sdk.rest import ApiException
+
+        try:
+            api_key = os.getenv("BREVO_API_KEY")
+            sender_email = os.getenv("SENDER_EMAIL", "no-reply@agent-ia.com")
+
+            if not api_key:
+                return "Erreur : clé API Brevo manquante."
+            if not recipients:
+                return "Erreur : aucun destinataire."
+
+            def as_html(text: str) -> str:
+                return text if is_html else html.escape(text).replace("\n", "<br/>")
+
+            # Le contenu de chaque version est injecté via ses params
+            entries = []
+            for r in recipients:
+                if isinstance(r, str):
+                    r = {"email": r}
+                entries.append({
+                    "email": r["email"],
+                    "subject": r.get("subject"),
+                    "params": {"message": as_html(r.get("message") or message)},
+                })
+
+            attachment = None
+            attachment_path = locate_artifact(attachment_path) if attachment_path else None
+            if attachment_path:
+                # Encodée une seule fois pour tous les destinataires
+                attachment = encode_attachment(attachment_path)
+
+            client = get_brevo_client(api_key)
+            payloads = batch_email_data(
+                sender={"email": sender_email, "name": "candidAI"},
+                recipients=entries,
+                subject=subject,
+                html_template="{{ params.message }}",
+                attachment=attachment,
+            )
+            for payload in payloads:
+                client.send(payload)
+
+            return f"📧 {len(entries)} email(s) envoyé(s) avec succès en {len(payloads)} appel(s) Brevo"
+
+        except AttachmentTooLarge as e:
+            return f"Erreur : {e}"
+        except ApiException as e:
+            return f"Erreur Brevo API : {e}"
+        except Exception as e:
+            return f"Erreur lors de l'envoi groupé : {e}"
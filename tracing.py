@@ -0,0 +1,429 @@
+# tracing.py
+"""
+Traces des conversations, exportées en arrière-plan.
+
+Le chemin de la requête ne fait qu'ajouter la trace terminée dans une file
+bornée (`put_nowait`) : si la file est pleine, la trace est abandonnée et
+comptée. Un thread exporte les traces par lots (TRACING_BATCH_SIZE traces ou
+toutes les TRACING_FLUSH_INTERVAL secondes). Un backend lent ou injoignable
+ne peut donc jamais ralentir `/mcp/chat`.
+
+Chaque trace porte des spans enfants : une par étape de l'agent et une par
+appel d'outil (rattaché à l'étape pendant laquelle il s'est exécuté).
+
+Exporteurs (TRACING_EXPORTER) :
+  - "langfuse" : API d'ingestion Langfuse, appelée directement en HTTP (sans
+    le SDK `langfuse`) ; un lot est découpé en envois d'au plus
+    TRACING_MAX_BATCH_BYTES, un événement trop gros est tronqué ;
+  - "file"     : fichier JSONL local (TRACING_FILE), pour les environnements hors ligne ;
+  - "none"     : aucune trace.
+Par défaut : "langfuse" si les clés sont définies, sinon "none".
+"""
+import os
+import json
+import time
+import uuid
+import queue
+import base64
+import random
+import threading
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+from metrics import TRACES_DROPPED, TRACE_EXPORT_ERRORS
+
+
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1.0"))
+TRACING_QUEUE_SIZE = int(os.getenv("TRACING_QUEUE_SIZE", "1000"))
+TRACING_BATCH_SIZE = int(os.getenv("TRACING_BATCH_SIZE", "50"))
+TRACING_FLUSH_INTERVAL = float(os.getenv("TRACING_FLUSH_INTERVAL", "2.0"))
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+# Taille maximale des entrées / sorties recopiées dans une span
+TRACING_MAX_FIELD_CHARS = int(os.getenv("TRACING_MAX_FIELD_CHARS", "4000"))
+# Limites de l'API d'ingestion Langfuse (octets JSON) : par envoi et par événement
+TRACING_MAX_BATCH_BYTES = int(os.getenv("TRACING_MAX_BATCH_BYTES", str(2_500_000)))
+TRACING_MAX_EVENT_BYTES = int(os.getenv("TRACING_MAX_EVENT_BYTES", str(1_000_000)))
+
+# Trace du tour en cours : les outils (y compris dans les threads de l'executor) y ajoutent leurs spans
+current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def _clip(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value[:TRACING_MAX_FIELD_CHARS]
+    if isinstance(value, dict):
+        return {k: _clip(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_clip(v) for v in value]
+    if isinstance(value, (int, float, bool)):
+        return value
+    return str(value)[:TRACING_MAX_FIELD_CHARS]
+
+
+class Trace:
+    def __init__(self, tracer: "Tracer", name: str, session_id: Optional[str] = None,
+                 input=None, metadata: Optional[dict] = None):
+        self._tracer = tracer
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.session_id = session_id
+        self.input = _clip(input)
+        self.output = None
+        self.metadata = dict(metadata or {})
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+        self.spans: list = []
+        self._ended = False
+
+    def update(self, output=None, metadata: Optional[dict] = None):
+        if output is not None:
+            self.output = _clip(output)
+        if metadata:
+            self.metadata.update(metadata)
+
+    def add_span(self, name: str, start_time: float, end_time: float, kind: str = "span",
+                 input=None, output=None, metadata: Optional[dict] = None, error: Optional[str] = None):
+        # list.append est atomique : appel possible depuis les threads des outils
+        self.spans.append({
+            "id": uuid.uuid4().hex,
+            "name": name,
+            "kind": kind,
+            "start_time": start_time,
+            "end_time": end_time,
+            "input": _clip(input),
+            "output": _clip(output),
+            "metadata": metadata or {},
+            "error": error,
+            "parent_id": None,
+        })
+
+    def end(self, error: Optional[str] = None):
+        if self._ended:
+            return
+        self._ended = True
+        self.end_time = time.time()
+        if error:
+            self.error = error
+        self._link_spans()
+        self._tracer.submit(self)
+
+    def _link_spans(self):
+        # Un appel d'outil est rattaché à l'étape de l'agent pendant laquelle il s'est exécuté
+        steps = [s for s in self.spans if s["kind"] == "step"]
+        for span in self.spans:
+            if span["kind"] == "step":
+                continue
+            for step in steps:
+                if step["start_time"] <= span["start_time"] <= step["end_time"]:
+                    span["parent_id"] = step["id"]
+                    break
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "session_id": self.session_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "input": self.input,
+            "output": self.output,
+            "metadata": self.metadata,
+            "error": self.error,
+            "spans": self.spans,
+        }
+
+
+class _UnsampledTrace(Trace):
+    """Trace non retenue par l'échantillonnage : même interface, rien n'est exporté."""
+
+    def update(self, output=None, metadata: Optional[dict] = None):
+        pass
+
+    def add_span(self, *args, **kwargs):
+        pass
+
+    def end(self, error: Optional[str] = None):
+        pass
+
+
+# --- Exporteurs ---
+class FileExporter:
+    def __init__(self, path: str = TRACING_FILE):
+        self.path = path
+
+    def export(self, traces: list):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for trace in traces:
+                f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+
+
+class LangfuseExporter:
+    """Envoie les traces par lots à l'API d'ingestion de Langfuse (`POST /api/public/ingestion`)."""
+
+    def __init__(self, host: Optional[str] = None, public_key: Optional[str] = None,
+                 secret_key: Optional[str] = None, timeout: float = 10.0,
+                 max_batch_bytes: int = TRACING_MAX_BATCH_BYTES, max_event_bytes: int = TRACING_MAX_EVENT_BYTES):
+        host = host or os.getenv("LANGFUSE_HOST", "https://cloud.langfuse.com")
+        public_key = public_key or os.getenv("LANGFUSE_PUBLIC_KEY", "")
+        secret_key = secret_key or os.getenv("LANGFUSE_SECRET_KEY", "")
+        self.url = host.rstrip("/") + "/api/public/ingestion"
+        self.timeout = timeout
+        self.max_batch_bytes = max_batch_bytes
+        self.max_event_bytes = max_event_bytes
+        credentials = base64.b64encode(f"{public_key}:{secret_key}".encode()).decode()
+        self.headers = {"Authorization": f"Basic {credentials}", "Content-Type": "application/json"}
+
+    @staticmethod
+    def _events(trace: Trace) -> list:
+        events = [{
+            "id": uuid.uuid4().hex,
+            "timestamp": _iso(trace.end_time),
+            "type": "trace-create",
+            "body": {
+                "id": trace.id,
+                "timestamp": _iso(trace.start_time),
+                "name": trace.name,
+                "sessionId": trace.session_id,
+                "input": trace.input,
+                "output": trace.output,
+                "metadata": {**trace.metadata, **({"error": trace.error} if trace.error else {})},
+            },
+        }]
+        for span in trace.spans:
+            events.append({
+                "id": uuid.uuid4().hex,
+                "timestamp": _iso(span["end_time"]),
+                "type": "span-create",
+                "body": {
+                    "id": span["id"],
+                    "traceId": trace.id,
+                    "parentObservationId": span["parent_id"],
+                    "name": span["name"],
+                    "startTime": _iso(span["start_time"]),
+                    "endTime": _iso(span["end_time"]),
+                    "input": span["input"],
+                    "output": span["output"],
+                    "metadata": {**span["metadata"], "kind": span["kind"]},
+                    "level": "ERROR" if span["error"] else "DEFAULT",
+                    "statusMessage": span["error"],
+                },
+            })
+        return events
+
+    def _encode(self, event: dict) -> Optional[bytes]:
+        """Événement en JSON, champs volumineux retirés s'il dépasse max_event_bytes (None : abandonné)."""
+        data = json.dumps(event, ensure_ascii=False).encode("utf-8")
+        if len(data) <= self.max_event_bytes:
+            return data
+        body = dict(event["body"])
+        for key in ("input", "output", "metadata"):
+            if body.get(key) is not None:
+                body[key] = f"[tronqué : événement de {len(data)} octets]"
+        data = json.dumps({**event, "body": body}, ensure_ascii=False).encode("utf-8")
+        return data if len(data) <= self.max_event_bytes else None
+
+    def _post(self, events: list):
+        request = urllib.request.Request(
+            self.url, data=b'{"batch":[' + b",".join(events) + b"]}", headers=self.headers, method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def export(self, traces: list):
+        # Envois successifs d'au plus max_batch_bytes : une trace volumineuse ne fait pas rejeter tout le lot
+        envelope = len(b'{"batch":[]}')
+        chunks, chunk, size = [], [], envelope
+        for trace in traces:
+            for event in self._events(trace):
+                data = self._encode(event)
+                if data is None:
+                    print(f"⚠️ Événement de trace {event['type']} abandonné (trop volumineux)")
+                    continue
+                if chunk and size + len(data) + 1 > self.max_batch_bytes:
+                    chunks.append(chunk)
+                    chunk, size = [], envelope
+                chunk.append(data)
+                size += len(data) + 1
+        if chunk:
+            chunks.append(chunk)
+        error = None
+        for chunk in chunks:
+            try:
+                self._post(chunk)
+            except Exception as e:
+                # Les autres envois partent quand même ; l'échec est signalé à la fin
+                error = error or e
+        if error is not None:
+            raise error
+
+
+class Tracer:
+    def __init__(self, exporter=None, sample_rate: float = TRACING_SAMPLE_RATE,
+                 queue_size: int = TRACING_QUEUE_SIZE, batch_size: int = TRACING_BATCH_SIZE,
+                 flush_interval: float = TRACING_FLUSH_INTERVAL):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and self.sample_rate > 0
+
+    def start_trace(self, name: str, session_id: Optional[str] = None, input=None,
+                    metadata: Optional[dict] = None) -> Trace:
+        if not self.enabled or random.random() >= self.sample_rate:
+            return _UnsampledTrace(self, name)
+        return Trace(self, name, session_id=session_id, input=input, metadata=metadata)
+
+    def submit(self, trace: Trace):
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            TRACES_DROPPED.inc()
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="tracing-export", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._export(batch)
+
+    def _export(self, batch: list):
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            TRACE_EXPORT_ERRORS.inc()
+            print(f"⚠️ Export des traces impossible ({len(batch)} perdue(s)): {e}")
+
+    def flush(self, timeout: float = 5.0):
+        """Exporte ce qui reste dans la file (arrêt du serveur)."""
+        deadline = time.monotonic() + timeout
+        batch = []
+        while time.monotonic() < deadline:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._export(batch)
+                batch = []
+        if batch:
+            self._export(batch)
+
+
+def _create_exporter():
+    # Lu au premier usage : le .env est chargé après l'import des modules par mcp_server
+    has_keys = os.getenv("LANGFUSE_PUBLIC_KEY") and os.getenv("LANGFUSE_SECRET_KEY")
+    exporter = os.getenv("TRACING_EXPORTER", "langfuse" if has_keys else "none").lower()
+    if exporter == "langfuse":
+        return LangfuseExporter()
+    if exporter == "file":
+        return FileExporter()
+    return None
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer(_create_exporter())
+    return _tracer
+
+
+@contextmanager
+def trace(name: str, session_id: Optional[str] = None, input=None, metadata: Optional[dict] = None):
+    """Trace un bloc : `with trace("chat", session_id, input=...) as t: ... t.update(output=...)`."""
+    current = get_tracer().start_trace(name, session_id=session_id, input=input, metadata=metadata)
+    token = current_trace.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(error=f"{type(e).__name__}: {e}")
+        raise
+    else:
+        current.end()
+    finally:
+        current_trace.reset(token)
+
+
+def record_agent_steps(current: Trace, steps):
+    """Ajoute une span par étape (`ActionStep`) de la mémoire d'un agent smolagents."""
+    for step in steps:
+        timing = getattr(step, "timing", None)
+        if timing is None or not hasattr(step, "step_number"):
+            continue
+        usage = getattr(step, "token_usage", None)
+        current.add_span(
+            f"step {step.step_number}",
+            timing.start_time,
+            timing.end_time or time.time(),
+            kind="step",
+            input=None,
+            output=getattr(step, "observations", None),
+            metadata={
+                "tool_calls": [call.name for call in (getattr(step, "tool_calls", None) or [])],
+                **({"input_tokens": usage.input_tokens, "output_tokens": usage.output_tokens} if usage else {}),
+            },
+            error=str(step.error) if getattr(step, "error", None) else None,
+        )
+
+
+def trace_tool(tool):
+    """Ajoute une span par appel du `forward` de l'outil à la trace en cours."""
+    forward = tool.forward
+    name = tool.name
+
+    def traced_forward(*args, **kwargs):
+        current = current_trace.get()
+        if current is None:
+            return forward(*args, **kwargs)
+        started = time.time()
+        error = None
+        output = None
+        try:
+            output = forward(*args, **kwargs)
+            if isinstance(output, str) and output.startswith("Erreur"):
+                error = output
+            return output
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current.add_span(name, started, time.time(), kind="tool", input=kwargs, output=output, error=error)
+
+    tool.forward = traced_forward
+    return tool
@@ -0,0 +1,361 @@
+# word_templates.py
+"""
+Moteur de modèles Word (.docx) pour BuildWord.
+
+Un modèle est un .docx déjà mis en forme qui contient des champs `{{nom}}`.
+Il est compilé une seule fois par processus : les parties du paquet sans
+champ (styles, thème, polices…) sont gardées telles quelles en octets, seules
+les parties qui contiennent des champs (document, en-têtes, pieds de page)
+sont analysées. Une génération copie ces quelques arbres XML, remplit les
+champs et réécrit l'archive, sans recréer ni reconfigurer de `Document()`.
+
+Syntaxe :
+  - `{{champ}}` : remplacé par la valeur (les sauts de ligne deviennent des
+    retours à la ligne) ;
+  - paragraphe réduit à `{{champ}}` et valeur sur plusieurs paragraphes
+    (séparés par une ligne vide) : un paragraphe Word par bloc, les lignes
+    `- item` deviennent des puces ;
+  - `{{#each liste}}` … `{{/each}}` (chacun dans son propre paragraphe) :
+    bloc répété pour chaque élément (dict) de `liste`.
+
+Modèles disponibles : "lettre" (intégré) et ceux déposés par les tenants
+dans WORD_TEMPLATES_DIR/<tenant>/<nom>.docx, référencés par "<tenant>/<nom>".
+Un tenant ne voit que ses propres modèles : la requête en cours fixe
+`artifacts.current_tenant` (clé d'API du serveur MCP), les références vers un
+autre tenant sont traitées comme des modèles inconnus.
+"""
+import io
+import os
+import re
+import copy
+import hashlib
+import zipfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from docx import Document
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from docx.shared import Pt, Cm
+from docx.text.run import Run
+from lxml import etree
+
+from artifacts import current_tenant
+
+
+WORD_TEMPLATES_DIR = os.getenv("WORD_TEMPLATES_DIR", "word_templates")
+WORD_BATCH_WORKERS = int(os.getenv("WORD_BATCH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# En dessous de ce nombre de lettres, le publipostage reste dans le processus courant
+WORD_BATCH_MIN_PARALLEL = int(os.getenv("WORD_BATCH_MIN_PARALLEL", "20"))
+# Taille maximale d'un modèle déposé (octets)
+WORD_TEMPLATE_MAX_BYTES = int(os.getenv("WORD_TEMPLATE_MAX_BYTES", str(5 * 1024 * 1024)))
+
+DEFAULT_TEMPLATE = "lettre"
+DEFAULT_CLOSING = "Je vous prie d’agréer, Madame, Monsieur, l’expression de mes salutations distinguées."
+
+_FIELD = re.compile(r"\{\{\s*([\w.-]+)\s*\}\}")
+_EACH_START = re.compile(r"^\{\{#each\s+([\w.-]+)\s*\}\}$")
+_EACH_END = "{{/each}}"
+_NAME = re.compile(r"^[\w-]+$")
+
+
+class TemplateNotFound(LookupError):
+    pass
+
+
+def _build_default_template() -> bytes:
+    """Modèle de lettre française, même mise en page que l'ancien BuildWord."""
+    doc = Document()
+    section = doc.sections[0]
+    section.top_margin = Cm(2.5)
+    section.bottom_margin = Cm(2.5)
+    section.left_margin = Cm(2.5)
+    section.right_margin = Cm(2.5)
+
+    font = doc.styles['Normal'].font
+    font.name = 'Arial'
+    font.size = Pt(11)
+
+    doc.add_paragraph("{{sender}}").alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    doc.add_paragraph("{{recipient}}")
+    doc.add_paragraph("{{date}}")
+    p = doc.add_paragraph()
+    p.add_run('Objet : ').bold = True
+    p.add_run("{{subject}}")
+    doc.add_paragraph()
+
+    title_p = doc.add_paragraph()
+    title_p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    title_run = title_p.add_run("{{title}}")
+    title_run.font.size = Pt(16)
+    title_run.bold = True
+    doc.add_paragraph()
+
+    doc.add_paragraph("{{body}}")
+    doc.add_paragraph()
+    doc.add_paragraph("{{closing}}")
+    doc.add_paragraph()
+    doc.add_paragraph("{{signature}}")
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+class WordTemplate:
+    """Modèle .docx compilé : parties statiques en octets, parties à champs pré-analysées."""
+
+    def __init__(self, data: bytes):
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        self._static = {}
+        self._templated = {}
+        self._order = []
+        try:
+            archive = zipfile.ZipFile(io.BytesIO(data))
+        except zipfile.BadZipFile:
+            raise ValueError("le fichier n'est pas un document Word (.docx)") from None
+        with archive:
+            if "word/document.xml" not in archive.namelist():
+                raise ValueError("le fichier n'est pas un document Word (.docx)")
+            for info in archive.infolist():
+                blob = archive.read(info)
+                self._order.append(info.filename)
+                if info.filename.endswith(".xml") and b"{{" in blob:
+                    self._templated[info.filename] = parse_xml(blob)
+                else:
+                    self._static[info.filename] = blob
+        # Style de puce résolu une fois, à la compilation (il faut le paquet complet)
+        try:
+            self.bullet_style_id = Document(io.BytesIO(data)).styles["List Bullet"].style_id
+        except KeyError:
+            self.bullet_style_id = None
+
+    def render(self, values: dict, dest: str):
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name in self._order:
+                if name in self._templated:
+                    root = copy.deepcopy(self._templated[name])
+                    self._fill(root, values)
+                    blob = etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+                else:
+                    blob = self._static[name]
+                archive.writestr(name, blob)
+        os.replace(tmp, dest)
+
+    # --- Remplissage ---
+    def _fill(self, root, values: dict):
+        body = root.find(qn("w:body"))
+        if body is not None:
+            self._expand_each(body, values)
+        for p in list(root.iter(qn("w:p"))):
+            self._fill_paragraph(p, values)
+
+    def _expand_each(self, container, values: dict):
+        children = list(container)
+        i = 0
+        while i < len(children):
+            match = _EACH_START.match(_paragraph_text(children[i]).strip()) if children[i].tag == qn("w:p") else None
+            if match is None:
+                i += 1
+                continue
+            end = next(
+                (j for j in range(i + 1, len(children))
+                 if children[j].tag == qn("w:p") and _paragraph_text(children[j]).strip() == _EACH_END),
+                None,
+            )
+            if end is None:
+                raise ValueError(f"bloc {{{{#each {match.group(1)}}}}} sans {{{{/each}}}}")
+            block = children[i + 1:end]
+            anchor = children[end]
+            for item in values.get(match.group(1)) or []:
+                scope = {**values, **item} if isinstance(item, dict) else {**values, "item": item}
+                for element in block:
+                    clone = copy.deepcopy(element)
+                    for p in [clone] if clone.tag == qn("w:p") else list(clone.iter(qn("w:p"))):
+                        self._fill_paragraph(p, scope)
+                    anchor.addprevious(clone)
+            for element in [children[i], *block, anchor]:
+                container.remove(element)
+            i = end + 1
+
+    def _fill_paragraph(self, p, values: dict):
+        text = _paragraph_text(p)
+        if "{{" not in text:
+            return
+        whole = _FIELD.fullmatch(text.strip())
+        if whole is not None:
+            value = _as_text(values.get(whole.group(1)))
+            if "\n\n" in value or value.lstrip().startswith("- "):
+                self._expand_text_block(p, value)
+                return
+        runs = p.findall(qn("w:r"))
+        if not runs:
+            return
+        # Champ contenu dans un seul run : remplacement sur place, la mise en forme est conservée
+        for r in runs:
+            r_text = _run_text(r)
+            if _FIELD.search(r_text):
+                Run(r, None).text = _substitute(r_text, values)
+        # Champ réparti sur plusieurs runs (édition dans Word) : fusion dans le premier run
+        remaining = "".join(_run_text(r) for r in runs)
+        if _FIELD.search(remaining):
+            Run(runs[0], None).text = _substitute(remaining, values)
+            for r in runs[1:]:
+                p.remove(r)
+
+    def _expand_text_block(self, p, value: str):
+        anchor = p
+        for block in value.split("\n\n"):
+            block = block.strip()
+            if not block:
+                continue
+            if block.startswith("- "):
+                items = [line.strip()[2:] if line.strip().startswith("- ") else line.strip()
+                         for line in block.split("\n")]
+                for item in items:
+                    anchor = self._insert_like(anchor, p, item, bullet=True)
+            else:
+                anchor = self._insert_like(anchor, p, block)
+        p.getparent().remove(p)
+
+    def _insert_like(self, anchor, prototype, text: str, bullet: bool = False):
+        clone = copy.deepcopy(prototype)
+        runs = clone.findall(qn("w:r"))
+        for r in runs[1:]:
+            clone.remove(r)
+        run = runs[0] if runs else clone.add_r()
+        Run(run, None).text = text
+        if bullet and self.bullet_style_id:
+            clone.get_or_add_pPr().style = self.bullet_style_id
+        anchor.addnext(clone)
+        return clone
+
+
+def _run_text(r) -> str:
+    return "".join(t.text or "" for t in r.iter(qn("w:t")))
+
+
+def _paragraph_text(p) -> str:
+    return "".join(_run_text(r) for r in p.iter(qn("w:r")))
+
+
+def _as_text(value) -> str:
+    return "" if value is None else str(value)
+
+
+def _substitute(text: str, values: dict) -> str:
+    return _FIELD.sub(lambda m: _as_text(values.get(m.group(1))), text)
+
+
+# --- Registre des modèles ---
+_templates: dict = {}
+_templates_lock = threading.Lock()
+
+
+def _template_path(reference: str) -> str:
+    tenant, _, name = reference.partition("/")
+    if not name or not _NAME.match(tenant) or not _NAME.match(name):
+        raise TemplateNotFound(f"modèle inconnu '{reference}' (format attendu : <tenant>/<nom>)")
+    return os.path.join(WORD_TEMPLATES_DIR, tenant, f"{name}.docx")
+
+
+def get_word_template(reference: Optional[str] = None, scoped: bool = True) -> WordTemplate:
+    """
+    Retourne le modèle compilé ("lettre" par défaut), rechargé si son fichier a changé.
+    `scoped` : seuls les modèles du tenant courant (`current_tenant`) sont accessibles.
+    """
+    reference = reference or DEFAULT_TEMPLATE
+    if reference == DEFAULT_TEMPLATE:
+        version = None
+    else:
+        path = _template_path(reference)
+        if scoped and reference.partition("/")[0] != current_tenant.get():
+            # Même réponse qu'un modèle absent : rien n'est révélé des autres tenants
+            raise TemplateNotFound(f"modèle inconnu '{reference}'")
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise TemplateNotFound(f"modèle inconnu '{reference}'") from None
+        version = (stat.st_size, stat.st_mtime_ns)
+
+    cached = _templates.get(reference)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _templates_lock:
+        cached = _templates.get(reference)
+        if cached is None or cached[0] != version:
+            if version is None:
+                data = _build_default_template()
+            else:
+                with open(path, "rb") as f:
+                    data = f.read()
+            cached = _templates[reference] = (version, WordTemplate(data))
+    return cached[1]
+
+
+def register_word_template(tenant: str, name: str, data: bytes) -> str:
+    """Enregistre (ou remplace) le modèle d'un tenant et retourne sa référence."""
+    reference = f"{tenant}/{name}"
+    path = _template_path(reference)
+    if len(data) > WORD_TEMPLATE_MAX_BYTES:
+        raise ValueError(f"modèle trop volumineux (maximum {WORD_TEMPLATE_MAX_BYTES} octets)")
+    WordTemplate(data)  # Refuse un fichier invalide avant de l'écrire
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    with _templates_lock:
+        _templates.pop(reference, None)
+    return reference
+
+
+def list_word_templates(tenant: str) -> list:
+    directory = os.path.join(WORD_TEMPLATES_DIR, tenant)
+    if not _NAME.match(tenant) or not os.path.isdir(directory):
+        return []
+    return sorted(f"{tenant}/{name[:-5]}" for name in os.listdir(directory) if name.endswith(".docx"))
+
+
+# --- Publipostage ---
+_batch_pool: Optional[ProcessPoolExecutor] = None
+_batch_pool_lock = threading.Lock()
+
+
+def _render_one(reference: Optional[str], values: dict, dest: str) -> str:
+    # Chaque processus du pool compile le modèle une fois, puis le réutilise ;
+    # l'accès du tenant a été vérifié par `render_many` avant la répartition
+    get_word_template(reference, scoped=False).render(values, dest)
+    return dest
+
+
+def _render_chunk(reference: Optional[str], jobs: list) -> list:
+    return [_render_one(reference, values, dest) for values, dest in jobs]
+
+
+def render_many(reference: Optional[str], jobs: list) -> list:
+    """
+    Génère une lettre par couple (valeurs, chemin) et retourne les chemins.
+    Les gros lots sont répartis par paquets sur un pool de WORD_BATCH_WORKERS processus.
+    """
+    global _batch_pool
+    get_word_template(reference)  # Modèle introuvable ou invalide : erreur immédiate
+    if len(jobs) < WORD_BATCH_MIN_PARALLEL or WORD_BATCH_WORKERS <= 1:
+        return _render_chunk(reference, jobs)
+    if _batch_pool is None:
+        with _batch_pool_lock:
+            if _batch_pool is None:
+                # Pas de fork d'un processus qui a des threads : forkserver, sinon spawn
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                _batch_pool = ProcessPoolExecutor(max_workers=WORD_BATCH_WORKERS, mp_context=context)
+    size = max(1, len(jobs) // (WORD_BATCH_WORKERS * 4))
+    chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+    paths = []
+    for chunk_paths in _batch_pool.map(_render_chunk, [reference] * len(chunks), chunks):
+        paths.extend(chunk_paths)
+    return paths